@@ -1,5 +1,8 @@
 import csv
 import os
+import time
+from contextlib import nullcontext
+from imo_vmdb.analysis.population import clear_estimates
 from imo_vmdb.csv_import.magnitudes import MagnitudesParser
 from imo_vmdb.csv_import.rate import RateParser
 from imo_vmdb.csv_import.radiant import RadiantParser
@@ -8,12 +11,19 @@ from imo_vmdb.csv_import.session import SessionParser
 from imo_vmdb.model.radiant import Storage as RadiantStorage
 from imo_vmdb.model.shower import Storage as ShowerStorage
 from imo_vmdb.model.sky import Sky
-from imo_vmdb.normalizer import create_rate_magn
+from imo_vmdb.normalizer import create_rate_magn, discard_counts, DirtySessions, Selection
 from imo_vmdb.normalizer.magnitude import MagnitudeNormalizer
-from imo_vmdb.normalizer.rate import RateNormalizer
+from imo_vmdb.normalizer.progress import Checkpoints
+from imo_vmdb.normalizer.rate import RadiantNormalizer, RateNormalizer
 from imo_vmdb.normalizer.session import SessionNormalizer
+from imo_vmdb.normalizer.work import WorkQueue
 from pathlib import Path
-from imo_vmdb.db import create_tables
+from imo_vmdb.db import analyze_tables, clear_imported_tables, create_partitions, create_tables, \
+    create_normalize_tables, DBException, vacuum
+
+# tables of the imported and of the normalized observations
+_IMPORTED_TABLES = ('imported_session', 'imported_rate', 'imported_magnitude')
+_OBSERVATION_TABLES = ('rate', 'magnitude', 'magnitude_detail', 'rate_magnitude')
 
 
 class CSVFileException(Exception):
@@ -76,44 +86,49 @@ class CSVImporter(object):
         """
         db_conn = self._db_conn
         logger = self._logger
+        create_normalize_tables(db_conn)
         cur = db_conn.cursor()
 
-        for file_path in file_list:
-
-            logger.info('Start parsing the data from file %s.' % file_path)
-
-            try:
-                with open(file_path, mode='r', encoding='utf-8-sig') as csv_file:
-                    self._parse_csv_file(csv_file, cur)
-            except FileNotFoundError:
-                self._log_critical('The file %s could not be found.' % file_path)
-                continue
-            except IsADirectoryError:
-                self._log_critical('The file %s is a directory.' % file_path)
-                continue
-            except PermissionError:
-                self._log_critical('File %s could not be opened.' % file_path)
-                continue
-            except CSVFileException:
-                self._log_critical('File %s seems not to be a valid CSV file.' % file_path)
-                continue
-            except CSVParserException:
-                self._log_critical('File %s is an unknown CSV file.' % file_path)
-                continue
-
-            logger.info(
-                'Parsing of file %s has finished.' % file_path
-            )
-
-        for csv_parser in self._active_parsers:
-            csv_parser.on_shutdown(cur)
-            if csv_parser.has_errors:
-                self.has_errors = True
+        # an import that replaces the imported records builds their indexes at the end
+        bulk_load = db_conn.bulk_load(_IMPORTED_TABLES) if self._do_delete else nullcontext()
+        with bulk_load:
+            for file_path in file_list:
+
+                logger.info('Start parsing the data from file %s.' % file_path)
+
+                try:
+                    with open(file_path, mode='r', encoding='utf-8-sig') as csv_file:
+                        self._parse_csv_file(csv_file, cur)
+                except FileNotFoundError:
+                    self._log_critical('The file %s could not be found.' % file_path)
+                    continue
+                except IsADirectoryError:
+                    self._log_critical('The file %s is a directory.' % file_path)
+                    continue
+                except PermissionError:
+                    self._log_critical('File %s could not be opened.' % file_path)
+                    continue
+                except CSVFileException:
+                    self._log_critical('File %s seems not to be a valid CSV file.' % file_path)
+                    continue
+                except CSVParserException:
+                    self._log_critical('File %s is an unknown CSV file.' % file_path)
+                    continue
+
+                logger.info(
+                    'Parsing of file %s has finished.' % file_path
+                )
+
+            for csv_parser in self._active_parsers:
+                csv_parser.on_shutdown(cur)
+                if csv_parser.has_errors:
+                    self.has_errors = True
 
         logger.info(
             'Parsing of the files has finished. %s of %s records imported, %s discarded.' %
             (self.counter_write, self.counter_read, self.counter_read - self.counter_write)
         )
+        _log_statement_stats(logger, db_conn)
 
     def _log_critical(self, msg):
         self._logger.critical(msg)
@@ -170,25 +185,31 @@ class CSVImporter(object):
         return csv_parser
 
 
-def cleanup(db_conn, logger):
+def cleanup(db_conn, logger, do_vacuum=False, do_analyze=False):
     """
     Remove all previously imported data, if any, while preserving normalized data in the database.
 
     This function takes an existing database connection and a logger object as parameters. It removes all
-    previously imported data from the database, leaving normalized data intact.
+    previously imported data from the database, leaving normalized data intact. The tables are truncated,
+    or with SQLite, created again (see :func:`imo_vmdb.db.clear_imported_tables`).
 
     :param db_conn: An open database connection implementing DB-API 2.0.
     :param logger: A logger object used to log errors, warnings, and additional information.
     :type logger: logging.Logger
+    :param do_vacuum: If True, commit and return the free space of a SQLite database file. Default is False.
+    :type do_vacuum: bool
+    :param do_analyze: If True, update the statistics of the query planner. Default is False.
+    :type do_analyze: bool
     :return: An integer indicating the result of the operation. 0 for success, other values for errors.
     :rtype: int
     """
     logger.info('Starting cleaning up the database.')
-    cur = db_conn.cursor()
-    cur.execute(db_conn.convert_stmt('DELETE FROM imported_magnitude'))
-    cur.execute(db_conn.convert_stmt('DELETE FROM imported_rate'))
-    cur.execute(db_conn.convert_stmt('DELETE FROM imported_session'))
-    cur.close()
+    clear_imported_tables(db_conn)
+    if do_vacuum and vacuum(db_conn):
+        logger.info('The free space of the database file has been released.')
+    if do_analyze:
+        analyze_tables(db_conn)
+        logger.info('The statistics of the query planner have been updated.')
     logger.info('Cleanup of the database completed.')
 
     return 0
@@ -219,57 +240,352 @@ def initdb(db_conn, logger):
     return int(csv_import.has_errors)
 
 
-def normalize(db_conn, logger):
+def normalize(db_conn, logger, processes=1, distributed=False, lease_time=600, unit_size=10000,
+              incremental=False, checkpoint=None, resume=False, showers=None, period_start=None, period_end=None,
+              session_ids=None):
     """
     Establish relationships between imported records and enrich observations with additional information.
 
     This function takes an existing database connection and a logger object as parameters. It establishes
     relationships between the imported records in the database, enriching observations with additional information.
 
+    The observations are normalized in ranges of sessions. If more than one process is requested, the
+    session ranges are computed in a process pool while this process writes the results. The results,
+    counters and log messages are the same as with a single process.
+
+    In distributed mode, this function is the coordinator: after normalizing the sessions, it writes
+    work units of about `unit_size` records to the table `normalize_work` and commits. Any number of
+    workers (see :func:`normalize_worker`) on any host may then claim units. The coordinator processes
+    units as well, waits until all units are done and finally creates the rate magnitude relationship.
+
     :param db_conn: An open database connection implementing DB-API 2.0.
     :param logger: A logger object used to log errors, warnings, and additional information.
     :type logger: logging.Logger
+    :param processes: Number of processes used to compute the normalized observations. Default is 1.
+    :type processes: int
+    :param distributed: If True, distribute the work via the work queue. Default is False.
+    :type distributed: bool
+    :param lease_time: Seconds a work unit may take until it is claimed by another worker. Default is 600.
+    :type lease_time: int
+    :param unit_size: Approximate number of records of a work unit. Default is 10000.
+    :type unit_size: int
+    :param incremental: If True, only normalize the sessions changed by imports since the last
+        normalization, with the same result as a full normalization. In addition, normalized records
+        are removed, if their imported records have been deleted by an import (option `do_delete`)
+        and not imported again. Cannot be combined with distributed mode. Default is False.
+    :type incremental: bool
+    :param checkpoint: If set, commit after about this number of sessions of each stage and after
+        each stage, and record the progress in the table `normalize_progress`. Default is None.
+    :type checkpoint: int
+    :param resume: If True, resume an aborted normalization with checkpoints after its last
+        committed session range. The other options must be the same as in the aborted run.
+        Default is False.
+    :type resume: bool
+    :param showers: If set, only normalize the observations of these showers, given as IAU codes.
+        The code `SPO` selects the sporadic meteors. Default is None.
+    :type showers: list of str
+    :param period_start: If set, only normalize the sessions with observations of the selected showers
+        that end after this time, given as datetime or string `YYYY-MM-DD[ HH:MM[:SS]]`. Default is None.
+    :param period_end: If set, only normalize the sessions with observations of the selected showers
+        that start before this time. Default is None.
+    :param session_ids: If set, only normalize these sessions. Default is None.
+    :type session_ids: list of int
     :return: An integer indicating the result of the operation. 0 for success, 1 for errors.
     :rtype: int
     """
-    logger.info('Starting normalization of the sessions.')
-    sn = SessionNormalizer(db_conn, logger)
-    sn.run()
+    targeted = showers or period_start is not None or period_end is not None or session_ids
+    if incremental and distributed:
+        raise ValueError('An incremental normalization cannot be distributed.')
+    if targeted and (incremental or distributed):
+        raise ValueError('A targeted normalization can neither be incremental nor distributed.')
+    if targeted and (checkpoint is not None or resume):
+        raise ValueError('A targeted normalization has no checkpoints.')
+    if distributed and (checkpoint is not None or resume):
+        raise ValueError('A distributed normalization commits each work unit, it has no checkpoints.')
+
+    create_normalize_tables(db_conn)
+    checkpoints = None
+    progress = {}
+    if checkpoint is not None or resume:
+        checkpoints = Checkpoints(db_conn, checkpoint or 1000)
+        if resume:
+            progress = checkpoints.load()
+            if progress:
+                logger.info('Resuming the aborted normalization.')
+            else:
+                logger.info('There is no normalization to be resumed, starting a new one.')
+        if not progress:
+            checkpoints.start()
+    if not incremental and not targeted and not progress:
+        _clear_discards(db_conn)
+
+    dirty = DirtySessions(db_conn)
+    session_filter = None
+    dirty_session_ids = None
+    iau_codes = None
+    if incremental:
+        session_filter = dirty
+        iau_codes = dirty.iau_codes()
+        if iau_codes:
+            logger.info('The reference data of the showers %s have been changed.' % ', '.join(iau_codes))
+            dirty.mark_unnormalized_rates()
+        dirty_session_ids = dirty.session_ids()
+        logger.info('%s sessions have been changed since the last normalization.' % len(dirty_session_ids))
+    elif targeted:
+        session_filter = Selection(db_conn, showers, period_start, period_end, session_ids)
+        logger.info('%s sessions have been selected.' % len(session_filter.session_ids or []))
+
+    if not _stage_done(progress, 'session'):
+        logger.info('Starting normalization of the sessions.')
+        sn = SessionNormalizer(db_conn, logger, session_filter)
+        sn.run()
+        logger.info(
+            'The normalisation of the sessions has been completed. %s of %s records written, %s discarded.' %
+            (sn.counter_write, sn.counter_read, sn.counter_discard)
+        )
+        if sn.counter_delete > 0:
+            logger.info('%s sessions that are no longer imported have been removed.' % sn.counter_delete)
+        _checkpoint_done(checkpoints, 'session')
+
+    radiant_storage = RadiantStorage(db_conn)
+    radiants = radiant_storage.load()
+    shower_storage = ShowerStorage(db_conn)
+    shower_map = shower_storage.load(radiants)
+    sky = Sky()
+
+    if distributed:
+        has_errors = _coordinate(db_conn, logger, sky, shower_map, processes, lease_time, unit_size)
+    else:
+        # a full normalization rewrites the observations, their indexes are built at the end; not
+        # with checkpoints, whose commits would leave the tables without indexes after a failure
+        bulk_load = nullcontext()
+        if session_filter is None and checkpoints is None:
+            bulk_load = db_conn.bulk_load(_OBSERVATION_TABLES)
+        with bulk_load:
+            has_errors = _normalize_observations(
+                db_conn, logger, sky, shower_map, processes, session_filter, checkpoints, progress
+            )
+
+    if iau_codes and _stage_done(progress, 'radiant'):
+        # the sessions of the rates deleted by the radiant update have been marked before
+        dirty_session_ids = dirty.session_ids()
+    elif iau_codes:
+        logger.info('Start updating the radiants of the rates of changed showers.')
+        radn = RadiantNormalizer(db_conn, logger, sky, shower_map, session_filter)
+        radn.run()
+        logger.info(
+            'The radiants have been updated. %s of %s records written, %s discarded.' %
+            (radn.counter_write, radn.counter_read, radn.counter_discard)
+        )
+        _log_discard_counts(logger, 'rate', radn.discard_counts)
+        dirty.mark(radn.session_ids)
+        dirty_session_ids = sorted(set(dirty_session_ids) | radn.session_ids)
+        has_errors = has_errors or radn.has_errors
+        _checkpoint_done(checkpoints, 'radiant')
+
+    logger.info('Start creating rate magnitude relationship.')
+    create_rate_magn(db_conn, session_filter)
+    logger.info('The relationship between rate and magnitude was created.')
+    clear_estimates(db_conn)
+    if not targeted:
+        dirty.clear(dirty_session_ids, iau_codes)
+    if checkpoints is not None:
+        checkpoints.finish()
     logger.info(
-        'The normalisation of the sessions has been completed. %s of %s records written, %s discarded.' %
-        (sn.counter_write, sn.counter_read, sn.counter_discard)
+        'Astronomy memo: %s hits, %s misses, hit rate %.1f%%.' %
+        (sky.memo.hits, sky.memo.misses, 100.0 * sky.memo.hit_rate)
     )
+    _log_statement_stats(logger, db_conn)
+    logger.info('Normalisation completed.')
+
+    return int(has_errors)
+
+
+def normalize_worker(db_conn, logger, processes=1, lease_time=600, poll_interval=10):
+    """
+    Process work units of a distributed normalization until all units are done.
 
-    logger.info('Start of normalization the rates.')
+    A worker claims the units written by the coordinator (see :func:`normalize`), normalizes the rates
+    or magnitudes of their sessions and commits the result of each unit. If a claimed unit is not
+    completed within `lease_time` seconds, for example because the worker has been terminated, the
+    unit is claimed again by another worker. The worker returns as soon as all units are done, or
+    immediately, if there are no units.
+
+    :param db_conn: An open database connection implementing DB-API 2.0.
+    :param logger: A logger object used to log errors, warnings, and additional information.
+    :type logger: logging.Logger
+    :param processes: Number of processes used to compute the normalized observations. Default is 1.
+    :type processes: int
+    :param lease_time: Seconds a work unit may take until it is claimed by another worker. Default is 600.
+    :type lease_time: int
+    :param poll_interval: Seconds to wait for units claimed by other workers. Default is 10.
+    :type poll_interval: float
+    :return: An integer indicating the result of the operation. 0 for success, 1 for errors.
+    :rtype: int
+    """
     radiant_storage = RadiantStorage(db_conn)
     radiants = radiant_storage.load()
     shower_storage = ShowerStorage(db_conn)
     showers = shower_storage.load(radiants)
-    sky = Sky()
-    rn = RateNormalizer(db_conn, logger, sky, showers)
-    rn.run()
-    logger.info(
-        'The normalisation of the rates has been completed. %s of %s records written, %s discarded.' %
-        (rn.counter_write, rn.counter_read, rn.counter_discard)
+    queue = WorkQueue(db_conn, lease_time)
+    logger.info('Worker %s started.' % queue.worker_id)
+    has_errors = _process_work_units(db_conn, logger, queue, Sky(), showers, processes, poll_interval)
+    _log_statement_stats(logger, db_conn)
+    logger.info('Worker %s completed.' % queue.worker_id)
+
+    return int(has_errors)
+
+
+def _normalize_observations(db_conn, logger, sky, showers, processes, session_filter, checkpoints, progress):
+    has_errors = False
+    if not _stage_done(progress, 'rate'):
+        logger.info('Start of normalization the rates.')
+        rn = RateNormalizer(
+            db_conn, logger, sky, showers, processes, session_filter=session_filter, checkpoints=checkpoints
+        )
+        rn.run(resume_after=_resume_after(progress, 'rate'))
+        logger.info(
+            'The normalisation of the rates has been completed. %s of %s records written, %s discarded.' %
+            (rn.counter_write, rn.counter_read, rn.counter_discard)
+        )
+        _log_discard_counts(logger, 'rate', rn.discard_counts)
+        _checkpoint_done(checkpoints, 'rate')
+        has_errors = rn.has_errors
+
+    if not _stage_done(progress, 'magnitude'):
+        logger.info('Start of normalization the magnitudes.')
+        mn = MagnitudeNormalizer(
+            db_conn, logger, sky, processes, session_filter=session_filter, checkpoints=checkpoints
+        )
+        mn.run(resume_after=_resume_after(progress, 'magnitude'))
+        logger.info(
+            'The normalisation of the magnitudes has been completed. %s of %s records written, %s discarded.' %
+            (mn.counter_write, mn.counter_read, mn.counter_discard)
+        )
+        _log_discard_counts(logger, 'magnitude', mn.discard_counts)
+        _checkpoint_done(checkpoints, 'magnitude')
+        has_errors = has_errors or mn.has_errors
+
+    return has_errors
+
+
+def _log_discard_counts(logger, stage, counts):
+    if not counts:
+        return
+
+    logger.error(
+        '%s %s records discarded (%s). The discarded records are listed in the table normalize_discard.' %
+        (sum(counts.values()), stage, ', '.join('%s: %s' % item for item in sorted(counts.items())))
     )
 
-    logger.info('Start of normalization the magnitudes.')
-    mn = MagnitudeNormalizer(db_conn, logger, sky)
-    mn.run()
+
+def _log_statement_stats(logger, db_conn):
+    stats = db_conn.statement_stats()
     logger.info(
-        'The normalisation of the magnitudes has been completed. %s of %s records written, %s discarded.' %
-        (mn.counter_write, mn.counter_read, mn.counter_discard)
+        'Statements: %s converted, %s reused, %s prepared with %s executions.' %
+        (stats['converted'], stats['reused'], stats['prepared'], stats['executed'])
     )
 
-    logger.info('Start creating rate magnitude relationship.')
-    create_rate_magn(db_conn)
-    logger.info('The relationship between rate and magnitude was created.')
-    logger.info('Normalisation completed.')
 
-    if rn.has_errors:
-        return 1
+def _clear_discards(db_conn):
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt('DELETE FROM normalize_discard'))
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
 
-    if mn.has_errors:
-        return 1
 
-    return 0
+def _stage_done(progress, stage):
+    return progress.get(stage, (None, False))[1]
+
+
+def _resume_after(progress, stage):
+    return progress.get(stage, (None, False))[0]
+
+
+def _checkpoint_done(checkpoints, stage):
+    if checkpoints is not None:
+        checkpoints.done(stage)
+
+
+def _coordinate(db_conn, logger, sky, showers, processes, lease_time, unit_size):
+    if db_conn.partitioned:
+        # the workers should not race to create the same partitions
+        create_partitions(db_conn, _imported_years(db_conn))
+    queue = WorkQueue(db_conn, lease_time)
+    rate_units = queue.fill(
+        'rate',
+        RateNormalizer(db_conn, logger, sky, showers, chunk_size=unit_size).session_ranges()
+    )
+    magn_units = queue.fill(
+        'magnitude',
+        MagnitudeNormalizer(db_conn, logger, sky, chunk_size=unit_size).session_ranges()
+    )
+    logger.info('%s rate and %s magnitude work units queued.' % (rate_units, magn_units))
+
+    _process_work_units(db_conn, logger, queue, sky, showers, processes, 1.0)
+
+    has_errors = False
+    for stage in ('rate', 'magnitude'):
+        counter_read, counter_write, counter_discard = queue.counters(stage)
+        logger.info(
+            'The distributed normalisation of the %s records has been completed. '
+            '%s of %s records written, %s discarded.' %
+            (stage, counter_write, counter_read, counter_discard)
+        )
+        if counter_discard > 0:
+            _log_discard_counts(logger, stage, discard_counts(db_conn, stage))
+            has_errors = True
+
+    return has_errors
+
+
+def _imported_years(db_conn):
+    years = set()
+    for table in ('imported_rate', 'imported_magnitude'):
+        stmt = 'SELECT DISTINCT CAST(extract(year FROM "start") AS integer) FROM %s' % table
+        for column_names, rows in db_conn.stream(stmt):
+            years.update(row[0] for row in rows)
+
+    return years
+
+
+def _process_work_units(db_conn, logger, queue, sky, showers, processes, poll_interval):
+    has_errors = False
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            if queue.count_unfinished() == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        if 'rate' == unit.stage:
+            normalizer = RateNormalizer(db_conn, logger, sky, showers, processes)
+        else:
+            normalizer = MagnitudeNormalizer(db_conn, logger, sky, processes)
+
+        try:
+            normalizer.run(unit.session_range)
+        except DBException:
+            queue.release(unit)
+            raise
+
+        counters = (normalizer.counter_read, normalizer.counter_write, normalizer.counter_discard)
+        if not queue.complete(unit, *counters):
+            logger.warning(
+                'The claim of work unit %s has expired and the unit has been claimed by another worker. '
+                'The result has been discarded.' % unit.id
+            )
+            continue
+
+        logger.info(
+            'Work unit %s (%s, sessions %s to %s) completed. %s of %s records written, %s discarded.' %
+            (unit.id, unit.stage, unit.first_session_id, unit.last_session_id,
+             counters[1], counters[0], counters[2])
+        )
+        if normalizer.has_errors:
+            has_errors = True
+
+    return has_errors
@@ -3,11 +3,14 @@ import sys
 
 _COMMANDS = {
     'cleanup':    ('imo_vmdb.command.cleanup',    'main'),
+    'db':         ('imo_vmdb.command.db',         'main'),
     'export':     ('imo_vmdb.command.export',     'main'),
     'initdb':     ('imo_vmdb.command.initdb',     'main'),
     'import_csv': ('imo_vmdb.command.import_csv', 'main'),
     'normalize':  ('imo_vmdb.command.normalize',  'main'),
+    'population_index': ('imo_vmdb.command.population_index', 'main'),
     'web_server': ('imo_vmdb.webui.server',       'main'),
+    'zhr':        ('imo_vmdb.command.zhr',        'main'),
 }
 
 
@@ -16,9 +19,14 @@ def usage():
 Valid commands are:
     initdb      ... Initializes the database.
     cleanup     ... Removes data that are no longer needed.
+    db indexes  ... Reports, creates or drops the indexes of the database.
+    db partitions ... Reports or detaches the yearly partitions (PostgreSQL).
+    db generations ... Reports or rolls back the generations of the database.
     import_csv  ... Imports CSV files.
     normalize   ... Normalize and analyze meteor observations.
     export      ... Export data as CSV.
+    zhr         ... Compute a ZHR profile of a shower.
+    population_index ... Estimate the population index of a shower.
     web_server  ... Start the web server (Web UI and REST API).''')
 
 
@@ -0,0 +1,38 @@
+import math
+import numpy as np
+
+
+def mid_solar_longitude(sl_start, sl_end):
+    """
+    Return the solar longitude in the middle of each observation, in degrees.
+
+    The solar longitude of an observation may wrap at 360 degrees.
+    """
+    sl_end = np.where(sl_end < sl_start, sl_end + 360.0, sl_end)
+    return np.mod((sl_start + sl_end) / 2.0, 360.0)
+
+
+def solar_longitude_bins(sl, bin_width):
+    """
+    Assign solar longitudes to bins of `bin_width` degrees.
+
+    :return: Tuple of the numbers of the bins with observations, ascending, and the index of the bin of
+        each solar longitude in these numbers. A bin `b` starts at `b * bin_width`.
+    :raises ValueError: If the bin width is not greater than 0.
+    """
+    if not bin_width > 0:
+        raise ValueError('The bin width must be greater than 0.')
+
+    bin_ids, index = np.unique(np.floor(np.asarray(sl) / bin_width).astype(np.int64), return_inverse=True)
+    return bin_ids, index.reshape(-1)
+
+
+def round_value(value, digits=4):
+    """
+    Return a NumPy number as a rounded float for JSON and CSV output, NaN as None.
+    """
+    value = float(value)
+    if math.isnan(value):
+        return None
+
+    return round(value, digits)
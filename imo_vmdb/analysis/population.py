@@ -0,0 +1,264 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from imo_vmdb.analysis import mid_solar_longitude, round_value, solar_longitude_bins
+from imo_vmdb.db import create_normalize_tables, DBException, parse_period, period_filter
+
+
+class Magnitudes(object):
+    """
+    Magnitude distributions of the magnitude observations of a shower, ordered by solar longitude.
+
+    Only the magnitude classes `m <= lim_mag - offset` of an observation are used, where `lim_mag` is
+    the limiting magnitude of the observation derived from its rates. Below the truncation magnitude
+    `k = floor(lim_mag - offset)`, the number of meteors of a magnitude class decreases by the
+    population index r per magnitude, so `j = k - m` is geometrically distributed with the parameter
+    `1 / r`. Each observation is reduced to the number of meteors `freq` and the sum `j_sum` of `j`
+    over its meteors, which are sufficient for the maximum-likelihood estimate of r.
+
+    The arrays have one element per observation: `id`, `sl` (solar longitude of the middle of the
+    observation in degrees), `freq` and `j_sum`.
+    """
+
+    def __init__(self, rows=(), offset=1.0):
+        """
+        :param rows: Tuples of the ID, the solar longitudes of the start and end, the limiting magnitude,
+            the magnitude class and the number of meteors of this class of the observations.
+        :param offset: Magnitudes fainter than the limiting magnitude minus this offset are not used.
+        """
+        rows = list(rows)
+        columns = list(zip(*rows)) if rows else [()] * 6
+        obs_ids = np.array(columns[0], dtype=np.int64)
+        sl_start = np.array(columns[1], dtype=np.float64)
+        sl_end = np.array(columns[2], dtype=np.float64)
+        lim_mag = np.array(columns[3], dtype=np.float64)
+        magn = np.array(columns[4], dtype=np.float64)
+        freq = np.array(columns[5], dtype=np.float64)
+
+        j = np.floor(lim_mag - offset) - magn
+        used = j >= 0
+        self.id, index = np.unique(obs_ids[used], return_inverse=True)
+        index = index.reshape(-1)
+        n = len(self.id)
+        self.freq = np.bincount(index, freq[used], n)
+        self.j_sum = np.bincount(index, freq[used] * j[used], n)
+        sl = np.zeros(n)
+        sl[index] = mid_solar_longitude(sl_start[used], sl_end[used])
+        order = np.argsort(sl, kind='stable')
+        self.sl = sl[order]
+        for name in ('id', 'freq', 'j_sum'):
+            setattr(self, name, getattr(self, name)[order])
+
+    def __len__(self):
+        return len(self.id)
+
+    @classmethod
+    def load(cls, db_conn, shower, period_start=None, period_end=None, min_lim_mag=None, offset=1.0):
+        """
+        Load the magnitude distributions of a shower.
+
+        Observations without a limiting magnitude are not used. The truncation at the limiting magnitude
+        is part of the statement, so only the used magnitude classes are read.
+
+        :param db_conn: An open database connection.
+        :param shower: IAU code of the shower.
+        :param period_start: Optional start of the time period. Only observations starting at or after
+            this time are loaded.
+        :param period_end: Optional end of the time period. Only observations ending at or before this
+            time are loaded. The dates are parsed by :func:`imo_vmdb.db.parse_period`.
+        :param min_lim_mag: Optional minimum limiting magnitude.
+        :param offset: Magnitudes fainter than the limiting magnitude minus this offset are not used.
+            Default is 1.
+        :rtype: Magnitudes
+        :raises ValueError: If a date is invalid.
+        """
+        conditions = [
+            'm.shower = %(shower)s',
+            'm.lim_mag IS NOT NULL',
+            'd.magn <= m.lim_mag - %(offset)s',
+            'd.freq > 0',
+        ]
+        params = {'shower': shower, 'offset': offset}
+        for key, column, op, value in (
+            ('period_start', 'm.period_start', '>=', period_start),
+            ('period_end', 'm.period_end', '<=', period_end),
+        ):
+            if value is not None:
+                column, params[key] = period_filter(column, value, db_conn.epoch_columns)
+                conditions.append('%s %s %%(%s)s' % (column, op, key))
+        if min_lim_mag is not None:
+            conditions.append('m.lim_mag >= %(min_lim_mag)s')
+            params['min_lim_mag'] = min_lim_mag
+
+        rows = []
+        for column_names, batch in db_conn.stream('''
+            SELECT m.id, m.sl_start, m.sl_end, m.lim_mag, d.magn, d.freq
+            FROM magnitude AS m
+            INNER JOIN magnitude_detail AS d ON d.id = m.id
+            WHERE %s
+        ''' % ' AND '.join(conditions), params):
+            rows.extend(batch)
+
+        return cls(rows, offset)
+
+
+def fit_r(freq, j_sum):
+    """
+    Return the maximum-likelihood estimate of the population index.
+
+    The arguments may be arrays of the same shape, the estimates are then computed element-wise.
+    The estimate is `1 + freq / j_sum`, or NaN if `j_sum` is 0.
+
+    :param freq: Number of meteors.
+    :param j_sum: Sum of the magnitude differences to the truncation magnitude of the meteors.
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+    j_sum = np.asarray(j_sum, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(j_sum > 0, 1.0 + freq / j_sum, np.nan)
+
+
+def r_profile(magnitudes, bin_width=1.0, bootstrap=1000, confidence=0.95, processes=1, seed=0):
+    """
+    Estimate the population index in bins of solar longitude.
+
+    The confidence interval of a bin is computed by resampling its observations `bootstrap` times.
+    The bins are distributed over `processes` processes. Each bin has its own random generator
+    derived from `seed`, so the result does not depend on the number of processes.
+
+    :param magnitudes: The magnitude distributions.
+    :type magnitudes: Magnitudes
+    :param bin_width: Width of the bins in degrees of solar longitude. Default is 1.
+    :param bootstrap: Number of bootstrap resamples. With 0, no confidence interval is computed.
+        Default is 1000.
+    :param confidence: Confidence level of the interval. Default is 0.95.
+    :param processes: Number of processes computing the bins. Default is 1.
+    :param seed: Seed of the random generators. Default is 0.
+    :return: List of dictionaries with the keys `sl_start`, `sl_end`, `sl` (mean solar longitude),
+        `count`, `freq`, `r`, `r_lower` and `r_upper` for each bin with observations.
+    :rtype: list
+    :raises ValueError: If an argument is invalid.
+    """
+    if not 0 < confidence < 1:
+        raise ValueError('The confidence level must be between 0 and 1.')
+    if bootstrap < 0:
+        raise ValueError('The number of bootstrap resamples must not be negative.')
+    bin_ids, index = solar_longitude_bins(magnitudes.sl, bin_width)
+    if len(magnitudes) == 0:
+        return []
+
+    n_bins = len(bin_ids)
+    count = np.bincount(index, minlength=n_bins)
+    freq = np.bincount(index, magnitudes.freq, n_bins)
+    j_sum = np.bincount(index, magnitudes.j_sum, n_bins)
+    sl = np.bincount(index, magnitudes.sl, n_bins) / count
+    r = fit_r(freq, j_sum)
+
+    order = np.argsort(index, kind='stable')
+    bounds = np.cumsum(count)[:-1]
+    tasks = [
+        (obs_freq, obs_j_sum, bootstrap, confidence, bin_seed)
+        for obs_freq, obs_j_sum, bin_seed in zip(
+            np.split(magnitudes.freq[order], bounds),
+            np.split(magnitudes.j_sum[order], bounds),
+            np.random.SeedSequence(seed).spawn(n_bins),
+        )
+    ]
+    if processes > 1 and bootstrap > 0:
+        with ProcessPoolExecutor(processes) as executor:
+            intervals = list(executor.map(_bootstrap, tasks, chunksize=max(1, n_bins // (4 * processes))))
+    else:
+        intervals = [_bootstrap(task) for task in tasks]
+
+    return [{
+        'sl_start': round_value(bin_ids[i] * bin_width),
+        'sl_end': round_value((bin_ids[i] + 1) * bin_width),
+        'sl': round_value(sl[i]),
+        'count': int(count[i]),
+        'freq': round_value(freq[i], 1),
+        'r': round_value(r[i]),
+        'r_lower': round_value(intervals[i][0]),
+        'r_upper': round_value(intervals[i][1]),
+    } for i in range(n_bins)]
+
+
+def estimate_r(db_conn, shower, bin_width=1.0, period_start=None, period_end=None, min_lim_mag=None, offset=1.0,
+               bootstrap=1000, confidence=0.95, processes=1, seed=0):
+    """
+    Estimate the population index of a shower in bins of solar longitude.
+
+    The result is stored in the table `r_estimate` and returned from there for the same shower and
+    arguments until the next normalization. The arguments are described in :class:`Magnitudes` and
+    :func:`r_profile`; `processes` does not change the result.
+
+    :param db_conn: An open database connection.
+    :param shower: IAU code of the shower.
+    :rtype: list
+    :raises ValueError: If a date is invalid.
+    """
+    # the same period in another notation has the same key
+    period_start = None if period_start is None else str(parse_period(period_start))
+    period_end = None if period_end is None else str(parse_period(period_end))
+    cache_key = '|'.join(str(value) for value in (
+        shower, float(bin_width), period_start, period_end, min_lim_mag, float(offset), int(bootstrap),
+        float(confidence), seed
+    ))
+    create_normalize_tables(db_conn)
+    column_names = ('sl_start', 'sl_end', 'sl', 'count', 'freq', 'r', 'r_lower', 'r_upper')
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt('''
+            SELECT %s FROM r_estimate WHERE cache_key = %%(cache_key)s ORDER BY sl_start
+        ''' % ', '.join(column_names)), {'cache_key': cache_key})
+        rows = cur.fetchall()
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    if rows:
+        return [dict(zip(column_names, row)) for row in rows]
+
+    magnitudes = Magnitudes.load(db_conn, shower, period_start, period_end, min_lim_mag, offset)
+    profile = r_profile(magnitudes, bin_width, bootstrap, confidence, processes, seed)
+    try:
+        cur = db_conn.cursor()
+        cur.executemany(db_conn.convert_stmt('''
+            INSERT INTO r_estimate (cache_key, %s) VALUES (%%(cache_key)s, %s)
+        ''' % (', '.join(column_names), ', '.join('%%(%s)s' % c for c in column_names))), [
+            dict(b, cache_key=cache_key) for b in profile
+        ])
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return profile
+
+
+def clear_estimates(db_conn):
+    """
+    Remove the stored estimates of the population index, e.g. after a normalization.
+    """
+    create_normalize_tables(db_conn)
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt('DELETE FROM r_estimate'))
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+
+def _bootstrap(task):
+    # confidence interval of the estimate of a bin, resampling its observations
+    freq, j_sum, bootstrap, confidence, seed = task
+    if bootstrap == 0:
+        return np.nan, np.nan
+
+    rng = np.random.default_rng(seed)
+    n = len(freq)
+    weights = rng.multinomial(n, np.full(n, 1.0 / n), size=bootstrap)
+    r = fit_r(weights @ freq, weights @ j_sum)
+    r = r[~np.isnan(r)]
+    if len(r) == 0:
+        return np.nan, np.nan
+
+    alpha = (1.0 - confidence) / 2.0
+    return np.quantile(r, alpha), np.quantile(r, 1.0 - alpha)
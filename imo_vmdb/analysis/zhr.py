@@ -0,0 +1,192 @@
+import re
+import numpy as np
+from imo_vmdb.analysis import mid_solar_longitude, round_value, solar_longitude_bins
+from imo_vmdb.db import DBException, period_filter
+
+WEIGHTINGS = ('time', 'equal')
+
+_iau_code_pattern = re.compile('^[A-Z0-9]{3,6}$')
+
+
+class Rates(object):
+    """
+    Normalized rate observations of a shower as NumPy arrays, ordered by solar longitude.
+
+    The arrays have one element per observation: `id`, `session_id`, `sl` (solar longitude of the
+    middle of the observation in degrees), `freq`, `t_eff`, `f`, `lim_mag` and `rad_alt` (degrees).
+    """
+
+    def __init__(self, rows=()):
+        rows = list(rows)
+        columns = list(zip(*rows)) if rows else [()] * 9
+        self.id = np.array(columns[0], dtype=np.int64)
+        self.session_id = np.array(columns[1], dtype=np.int64)
+        sl_start = np.array(columns[2], dtype=np.float64)
+        sl_end = np.array(columns[3], dtype=np.float64)
+        self.freq = np.array(columns[4], dtype=np.float64)
+        self.t_eff = np.array(columns[5], dtype=np.float64)
+        self.f = np.array(columns[6], dtype=np.float64)
+        self.lim_mag = np.array(columns[7], dtype=np.float64)
+        self.rad_alt = np.array(columns[8], dtype=np.float64)
+        self.sl = mid_solar_longitude(sl_start, sl_end)
+        order = np.argsort(self.sl, kind='stable')
+        for name in ('id', 'session_id', 'sl', 'freq', 't_eff', 'f', 'lim_mag', 'rad_alt'):
+            setattr(self, name, getattr(self, name)[order])
+
+    def __len__(self):
+        return len(self.id)
+
+    @classmethod
+    def load(cls, db_conn, shower, period_start=None, period_end=None, min_rad_alt=20.0, min_lim_mag=None,
+             max_f=None):
+        """
+        Load the rates of a shower that pass the cuts.
+
+        The cuts are part of the statement, so only the selected rates are read.
+
+        :param db_conn: An open database connection.
+        :param shower: IAU code of the shower.
+        :param period_start: Optional start of the time period. Only rates starting at or after this time are loaded.
+        :param period_end: Optional end of the time period. Only rates ending at or before this time are loaded.
+            The dates are parsed by :func:`imo_vmdb.db.parse_period`.
+        :param min_rad_alt: Minimum radiant altitude in degrees. Default is 20. Rates with the radiant
+            below the horizon are never loaded.
+        :param min_lim_mag: Optional minimum limiting magnitude.
+        :param max_f: Optional maximum correction factor for the field of view obstruction.
+        :rtype: Rates
+        :raises ValueError: If a date is invalid.
+        """
+        conditions = ['r.shower = %(shower)s', 'r.t_eff > 0', 'r.rad_alt > 0']
+        params = {'shower': shower}
+        for key, column, op, value in (
+            ('period_start', 'r.period_start', '>=', period_start),
+            ('period_end', 'r.period_end', '<=', period_end),
+        ):
+            if value is not None:
+                column, params[key] = period_filter(column, value, db_conn.epoch_columns)
+                conditions.append('%s %s %%(%s)s' % (column, op, key))
+        for key, column, op, value in (
+            ('min_rad_alt', 'r.rad_alt', '>=', min_rad_alt),
+            ('min_lim_mag', 'r.lim_mag', '>=', min_lim_mag),
+            ('max_f', 'r.f', '<=', max_f),
+        ):
+            if value is not None:
+                conditions.append('%s %s %%(%s)s' % (column, op, key))
+                params[key] = value
+
+        rows = []
+        for column_names, batch in db_conn.stream('''
+            SELECT r.id, r.session_id, r.sl_start, r.sl_end, r.freq, r.t_eff, r.f, r.lim_mag, r.rad_alt
+            FROM rate AS r
+            WHERE %s
+        ''' % ' AND '.join(conditions), params):
+            rows.extend(batch)
+
+        return cls(rows)
+
+
+def population_index(db_conn, shower):
+    """
+    Return the population index r of a shower from the table `shower`.
+
+    :raises ValueError: If the shower is unknown or has no population index.
+    """
+    if not _iau_code_pattern.match(shower or ''):
+        raise ValueError('%s is not a valid shower code.' % shower)
+
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt('SELECT r FROM shower WHERE iau_code = %(shower)s'), {'shower': shower})
+        row = cur.fetchone()
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    if row is None:
+        raise ValueError('The shower %s is unknown.' % shower)
+    if row[0] is None:
+        raise ValueError('The shower %s has no population index.' % shower)
+
+    return float(row[0])
+
+
+def corrected_time(rates, r, gamma=1.0):
+    """
+    Return the effective observing time of each rate corrected to standard conditions.
+
+    The corrected time is `t_eff * sin(rad_alt)^gamma / (f * r^(6.5 - lim_mag))` in hours,
+    so that the ZHR of an observation is `freq` divided by its corrected time.
+    """
+    return (
+        rates.t_eff * np.power(np.sin(np.radians(rates.rad_alt)), gamma) /
+        (rates.f * np.power(r, 6.5 - rates.lim_mag))
+    )
+
+
+def observation_zhr(rates, r, gamma=1.0):
+    """
+    Return the zenithal hourly rate of each rate observation.
+
+    :param rates: The rates.
+    :type rates: Rates
+    :param r: Population index of the shower.
+    :param gamma: Exponent of the zenith correction. Default is 1.
+    :rtype: numpy.ndarray
+    """
+    return rates.freq / corrected_time(rates, r, gamma)
+
+
+def zhr_profile(rates, r, bin_width=1.0, weighting='time', gamma=1.0):
+    """
+    Return the ZHR profile of rates in bins of solar longitude.
+
+    With the weighting `time`, the ZHR of a bin is the number of meteors divided by the sum of the
+    corrected observing times, and its error is the ZHR divided by the square root of the number of
+    meteors. With the weighting `equal`, the ZHR of a bin is the mean of the ZHR of its observations,
+    and its error is the standard error of the mean.
+
+    :param rates: The rates.
+    :type rates: Rates
+    :param r: Population index of the shower.
+    :param bin_width: Width of the bins in degrees of solar longitude. Default is 1.
+    :param weighting: `time` or `equal`. Default is `time`.
+    :param gamma: Exponent of the zenith correction. Default is 1.
+    :return: List of dictionaries with the keys `sl_start`, `sl_end`, `sl` (mean solar longitude),
+        `count`, `freq`, `t_eff`, `zhr` and `zhr_error` for each bin with observations.
+    :rtype: list
+    :raises ValueError: If the bin width or the weighting is invalid.
+    """
+    if weighting not in WEIGHTINGS:
+        raise ValueError('The weighting must be one of %s.' % ', '.join(WEIGHTINGS))
+    bin_ids, index = solar_longitude_bins(rates.sl, bin_width)
+    if len(rates) == 0:
+        return []
+
+    n_bins = len(bin_ids)
+    count = np.bincount(index, minlength=n_bins)
+    freq = np.bincount(index, rates.freq, n_bins)
+    t_eff = np.bincount(index, rates.t_eff, n_bins)
+    sl = np.bincount(index, rates.sl, n_bins) / count
+    if 'time' == weighting:
+        t_corr = np.bincount(index, corrected_time(rates, r, gamma), n_bins)
+        zhr = freq / t_corr
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zhr_error = np.where(freq > 0, zhr / np.sqrt(freq), np.nan)
+    else:
+        zhr_obs = observation_zhr(rates, r, gamma)
+        zhr = np.bincount(index, zhr_obs, n_bins) / count
+        variance = np.bincount(index, (zhr_obs - zhr[index]) ** 2, n_bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zhr_error = np.where(count > 1, np.sqrt(variance / (count - 1) / count), np.nan)
+
+    return [{
+        'sl_start': round_value(bin_ids[i] * bin_width),
+        'sl_end': round_value((bin_ids[i] + 1) * bin_width),
+        'sl': round_value(sl[i]),
+        'count': int(count[i]),
+        'freq': int(freq[i]),
+        't_eff': round_value(t_eff[i]),
+        'zhr': round_value(zhr[i]),
+        'zhr_error': round_value(zhr_error[i]),
+    } for i in range(n_bins)]
+
@@ -8,6 +8,10 @@ from imo_vmdb.db import DBAdapter, DBException
 def main(command_args):
     parser = OptionParser(usage='cleanup [options]')
     parser.add_option('-c', action='store', dest='config_file', help='path to config file')
+    parser.add_option('--vacuum', action='store_true', dest='vacuum', default=False,
+                      help='release the free space of the database file (SQLite)')
+    parser.add_option('--analyze', action='store_true', dest='analyze', default=False,
+                      help='update the statistics of the query planner')
     options, args = parser.parse_args(command_args)
     config = config_factory(options, parser)
     logger_factory = LoggerFactory(config)
@@ -15,7 +19,7 @@ def main(command_args):
 
     try:
         db_conn = DBAdapter(config['database'])
-        result = imo_vmdb.cleanup(db_conn, logger)
+        result = imo_vmdb.cleanup(db_conn, logger, options.vacuum, options.analyze)
         db_conn.commit()
         db_conn.close()
     except DBException as e:
@@ -0,0 +1,130 @@
+import sys
+from optparse import OptionParser
+
+from werkzeug.datastructures import MultiDict
+
+from imo_vmdb.command import config_factory
+from imo_vmdb.db import analyze_tables, create_indexes, DBAdapter, DBException, detach_partitions, drop_indexes, \
+    existing_indexes, existing_partitions, explain, index_catalog
+from imo_vmdb.generations import Generations
+from imo_vmdb.webui.api import magnitudes_query, rates_query
+
+# typical requests of the REST API, whose query plans are reported
+_API_QUERIES = (
+    ('rates of a shower in a period', rates_query, [
+        ('shower', 'PER'), ('period_start', '2020-08-01 00:00:00'), ('period_end', '2020-08-31 23:59:59'),
+    ]),
+    ('rates of a shower in a range of solar longitude', rates_query, [
+        ('shower', 'PER'), ('sl_min', '139.0'), ('sl_max', '141.0'),
+    ]),
+    ('rates with a minimum limiting magnitude', rates_query, [('lim_magn_min', '6.0')]),
+    ('rates of sessions', rates_query, [('session_id', '1'), ('session_id', '2')]),
+    ('magnitudes of a shower in a period', magnitudes_query, [
+        ('shower', 'PER'), ('period_start', '2020-08-01 00:00:00'), ('period_end', '2020-08-31 23:59:59'),
+    ]),
+    ('magnitudes of a shower in a range of solar longitude', magnitudes_query, [
+        ('shower', 'PER'), ('sl_min', '139.0'), ('sl_max', '141.0'),
+    ]),
+    ('magnitudes with a minimum limiting magnitude', magnitudes_query, [('lim_magn_min', '6.0')]),
+    ('magnitudes of sessions', magnitudes_query, [('session_id', '1'), ('session_id', '2')]),
+)
+
+_SUBCOMMANDS = ('indexes', 'partitions', 'generations')
+
+
+def main(command_args):
+    parser = OptionParser(usage='db indexes|partitions|generations [options]')
+    parser.add_option('-c', action='store', dest='config_file', help='path to config file')
+    parser.add_option('--apply', action='store_true', dest='apply', default=False,
+                      help='create the missing indexes')
+    parser.add_option('--drop', action='store_true', dest='drop', default=False,
+                      help='drop the indexes; together with --apply, the indexes are rebuilt; '
+                           'together with --detach, the detached partitions are dropped')
+    parser.add_option('--analyze', action='store_true', dest='analyze', default=False,
+                      help='update the statistics of the query planner')
+    parser.add_option('--detach', action='store', dest='detach', type='int', default=None, metavar='YEAR',
+                      help='detach the partitions of a year')
+    parser.add_option('--rollback', action='store_true', dest='rollback', default=False,
+                      help='make the previous generation of the database the current one')
+    options, args = parser.parse_args(command_args)
+    if len(args) != 1 or args[0] not in _SUBCOMMANDS:
+        parser.error('Valid subcommands are %s.' % ', '.join(_SUBCOMMANDS))
+    config = config_factory(options, parser)
+
+    if 'generations' == args[0]:
+        try:
+            _generations(Generations.from_config(config), options)
+        except DBException as e:
+            print('A database error occured. %s' % str(e), file=sys.stderr)
+            sys.exit(100)
+        return
+
+    try:
+        db_conn = DBAdapter(config['database'])
+        if 'partitions' == args[0]:
+            _partitions(db_conn, options)
+        else:
+            _indexes(db_conn, options)
+        db_conn.close()
+    except DBException as e:
+        print('A database error occured. %s' % str(e), file=sys.stderr)
+        sys.exit(100)
+
+
+def _indexes(db_conn, options):
+    if options.drop:
+        for name in drop_indexes(db_conn):
+            print('Dropped index %s.' % name)
+    if options.apply:
+        for name in create_indexes(db_conn):
+            print('Created index %s.' % name)
+    if options.analyze:
+        analyze_tables(db_conn)
+        print('The statistics of the query planner have been updated.')
+    db_conn.commit()
+
+    existing = existing_indexes(db_conn)
+    print()
+    print('Indexes:')
+    for name, table, columns in index_catalog(db_conn):
+        status = 'present'
+        if name not in existing:
+            status = 'missing'
+        elif existing[name] != table:
+            status = 'on table %s' % existing[name]
+        print('    %s ON %s(%s): %s' % (name, table, ', '.join(columns), status))
+
+    for title, query, args in _API_QUERIES:
+        stmt, params = query(MultiDict(args), db_conn.epoch_columns)
+        print()
+        print('Query plan of the %s:' % title)
+        for line in explain(db_conn, stmt, params):
+            print('    %s' % line)
+
+
+def _partitions(db_conn, options):
+    if not db_conn.partitioned:
+        print('The tables are not partitioned.')
+        return
+
+    if options.detach is not None:
+        for name in detach_partitions(db_conn, options.detach, options.drop):
+            print('%s partition %s.' % ('Dropped' if options.drop else 'Detached', name))
+        db_conn.commit()
+
+    partitions = existing_partitions(db_conn)
+    print()
+    print('Partitions:')
+    for name in sorted(partitions):
+        print('    %s OF %s' % (name, partitions[name]))
+
+
+def _generations(generations, options):
+    if options.rollback:
+        print('Generation %s restored.' % generations.rollback())
+
+    names, current = generations.list()
+    print()
+    print('Generations:')
+    for name in names:
+        print('    %s%s' % (name, ' (current)' if name == current else ''))
@@ -5,7 +5,7 @@ from optparse import OptionParser
 from pathlib import Path
 
 from imo_vmdb.command import config_factory
-from imo_vmdb.db import DBAdapter, DBException
+from imo_vmdb.db import DBAdapter, DBException, ReplicaRouter
 
 _DATA_DIR = Path(os.path.dirname(os.path.realpath(__file__))).parent / 'data'
 
@@ -75,12 +75,20 @@ def _export_db(table, options, parser, out):
         raise
 
     try:
-        db_conn = DBAdapter(dict(config['database']))
+        if config.has_section('database_readonly'):
+            # the replica, or the primary while the replica lags
+            router = ReplicaRouter.from_config(config)
+            db_conn = router.checkout()
+        else:
+            router = None
+            db_conn = DBAdapter(dict(config['database']))
         cur = db_conn.cursor()
         cur.execute(f'SELECT * FROM {DB_TABLES[table]}')
         cols = [d[0] for d in cur.description]
         rows = cur.fetchall()
         db_conn.close()
+        if router is not None:
+            router.close()
     except DBException as e:
         print(f'Database error: {e}', file=sys.stderr)
         sys.exit(100)
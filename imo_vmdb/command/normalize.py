@@ -3,25 +3,69 @@ import imo_vmdb
 from optparse import OptionParser
 from imo_vmdb.command import config_factory, LoggerFactory
 from imo_vmdb.db import DBAdapter, DBException
+from imo_vmdb.generations import Generations
 
 
 def main(command_args):
     parser = OptionParser(usage='normalize [options]')
     parser.add_option('-c', action='store', dest='config_file', help='path to config file')
+    parser.add_option('-j', action='store', type='int', dest='processes', default=1,
+                      help='number of processes used to compute the observations')
+    parser.add_option('--incremental', action='store_true', dest='incremental', default=False,
+                      help='only normalize the sessions changed since the last normalization')
+    parser.add_option('--distributed', action='store_true', dest='distributed', default=False,
+                      help='queue the work in the database so that workers can process it')
+    parser.add_option('--worker', action='store_true', dest='worker', default=False,
+                      help='process the work queued by a distributed normalization')
+    parser.add_option('--lease-time', action='store', type='int', dest='lease_time', default=600,
+                      help='seconds until an unfinished work unit is claimed by another worker')
+    parser.add_option('--checkpoint', action='store', type='int', dest='checkpoint', default=None,
+                      help='commit after about this number of sessions so that the run can be resumed')
+    parser.add_option('--resume', action='store_true', dest='resume', default=False,
+                      help='resume an aborted normalization after its last checkpoint')
+    parser.add_option('--shower', action='append', dest='showers', default=None, metavar='IAU_CODE',
+                      help='only normalize the observations of this shower, SPO for sporadic meteors; repeatable')
+    parser.add_option('--from', action='store', dest='period_start', default=None, metavar='DATE',
+                      help='only normalize the sessions with observations ending after this date')
+    parser.add_option('--to', action='store', dest='period_end', default=None, metavar='DATE',
+                      help='only normalize the sessions with observations starting before this date')
+    parser.add_option('--session', action='append', type='int', dest='session_ids', default=None, metavar='ID',
+                      help='only normalize this session; repeatable')
+    parser.add_option('--shadow', action='store_true', dest='shadow', default=False,
+                      help='normalize a copy of the database, which replaces the database when completed')
     options, args = parser.parse_args(command_args)
+    targeted = options.showers or options.period_start or options.period_end or options.session_ids
+    if options.incremental and (options.distributed or options.worker):
+        parser.error('--incremental cannot be combined with --distributed or --worker')
+    if (options.checkpoint is not None or options.resume) and (options.distributed or options.worker):
+        parser.error('--checkpoint and --resume cannot be combined with --distributed or --worker')
+    if targeted and (options.incremental or options.distributed or options.worker):
+        parser.error('--shower, --from, --to and --session cannot be combined with --incremental, '
+                     '--distributed or --worker')
+    if targeted and (options.checkpoint is not None or options.resume):
+        parser.error('--shower, --from, --to and --session cannot be combined with --checkpoint or --resume')
+    if options.shadow and (options.distributed or options.worker or options.checkpoint is not None or options.resume):
+        parser.error('--shadow cannot be combined with --distributed, --worker, --checkpoint or --resume')
     config = config_factory(options, parser)
     logger_factory = LoggerFactory(config)
     logger = logger_factory.get_logger('normalize')
 
     try:
-        db_conn = DBAdapter(config['database'])
-        result = imo_vmdb.normalize(db_conn, logger)
-        db_conn.commit()
-        db_conn.close()
+        if options.shadow:
+            with Generations.from_config(config).shadow() as db_conn:
+                result = _normalize(db_conn, logger, options)
+            logger.info('The normalized copy has replaced the database.')
+        else:
+            db_conn = DBAdapter(config['database'])
+            result = _normalize(db_conn, logger, options)
+            db_conn.commit()
+            db_conn.close()
     except DBException as e:
         msg = 'A database error occured. %s' % str(e)
         print(msg, file=sys.stderr)
         sys.exit(100)
+    except ValueError as e:
+        parser.error(str(e))
 
     if result > 0:
         print('Errors occurred when normalizing.', file=sys.stderr)
@@ -29,3 +73,23 @@ def main(command_args):
             print('See log file %s for more information.' % logger_factory.log_file, file=sys.stderr)
 
     sys.exit(result)
+
+
+def _normalize(db_conn, logger, options):
+    if options.worker:
+        return imo_vmdb.normalize_worker(db_conn, logger, options.processes, options.lease_time)
+
+    return imo_vmdb.normalize(
+        db_conn,
+        logger,
+        options.processes,
+        distributed=options.distributed,
+        lease_time=options.lease_time,
+        incremental=options.incremental,
+        checkpoint=options.checkpoint,
+        resume=options.resume,
+        showers=options.showers,
+        period_start=options.period_start,
+        period_end=options.period_end,
+        session_ids=options.session_ids
+    )
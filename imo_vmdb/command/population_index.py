@@ -0,0 +1,69 @@
+import csv
+import sys
+from optparse import OptionParser
+
+from imo_vmdb.analysis.population import estimate_r
+from imo_vmdb.command import config_factory
+from imo_vmdb.db import DBAdapter, DBException
+
+
+def main(command_args):
+    parser = OptionParser(usage='population_index --shower <IAU code> [options]')
+    parser.add_option('-c', action='store', dest='config_file', help='path to config file')
+    parser.add_option('-o', action='store', dest='output_file', metavar='FILE',
+                      help='output file (default: stdout)')
+    parser.add_option('-j', action='store', type='int', dest='processes', default=1,
+                      help='number of processes used to compute the confidence intervals')
+    parser.add_option('--shower', action='store', dest='shower', default=None, metavar='IAU_CODE',
+                      help='IAU code of the shower')
+    parser.add_option('--bin', action='store', type='float', dest='bin_width', default=1.0,
+                      help='width of the bins in degrees of solar longitude (default: 1)')
+    parser.add_option('--offset', action='store', type='float', dest='offset', default=1.0,
+                      help='only use magnitudes up to the limiting magnitude minus this offset (default: 1)')
+    parser.add_option('--min-lim-mag', action='store', type='float', dest='min_lim_mag', default=None,
+                      help='minimum limiting magnitude')
+    parser.add_option('--bootstrap', action='store', type='int', dest='bootstrap', default=1000,
+                      help='number of bootstrap resamples of the confidence intervals, 0 for none (default: 1000)')
+    parser.add_option('--confidence', action='store', type='float', dest='confidence', default=0.95,
+                      help='confidence level of the intervals (default: 0.95)')
+    parser.add_option('--from', action='store', dest='period_start', default=None, metavar='DATE',
+                      help='only use observations starting at or after this date')
+    parser.add_option('--to', action='store', dest='period_end', default=None, metavar='DATE',
+                      help='only use observations ending at or before this date')
+    options, args = parser.parse_args(command_args)
+    if options.shower is None:
+        parser.error('--shower is required')
+    config = config_factory(options, parser)
+
+    try:
+        db_conn = DBAdapter(dict(config['database']))
+        profile = estimate_r(
+            db_conn,
+            options.shower.upper(),
+            bin_width=options.bin_width,
+            period_start=options.period_start,
+            period_end=options.period_end,
+            min_lim_mag=options.min_lim_mag,
+            offset=options.offset,
+            bootstrap=options.bootstrap,
+            confidence=options.confidence,
+            processes=options.processes
+        )
+        db_conn.commit()
+        db_conn.close()
+    except DBException as e:
+        print('Database error: %s' % e, file=sys.stderr)
+        sys.exit(100)
+    except ValueError as e:
+        parser.error(str(e))
+
+    column_names = ['sl_start', 'sl_end', 'sl', 'count', 'freq', 'r', 'r_lower', 'r_upper']
+    out = open(options.output_file, 'w', newline='', encoding='utf-8') \
+        if options.output_file else sys.stdout
+    try:
+        writer = csv.writer(out, delimiter=';')
+        writer.writerow(column_names)
+        writer.writerows([b[c] for c in column_names] for b in profile)
+    finally:
+        if options.output_file:
+            out.close()
@@ -0,0 +1,87 @@
+import csv
+import sys
+from optparse import OptionParser
+
+from imo_vmdb.analysis.zhr import observation_zhr, population_index, Rates, WEIGHTINGS, zhr_profile
+from imo_vmdb.command import config_factory
+from imo_vmdb.db import DBAdapter, DBException
+
+
+def main(command_args):
+    parser = OptionParser(usage='zhr --shower <IAU code> [options]')
+    parser.add_option('-c', action='store', dest='config_file', help='path to config file')
+    parser.add_option('-o', action='store', dest='output_file', metavar='FILE',
+                      help='output file (default: stdout)')
+    parser.add_option('--shower', action='store', dest='shower', default=None, metavar='IAU_CODE',
+                      help='IAU code of the shower')
+    parser.add_option('--bin', action='store', type='float', dest='bin_width', default=1.0,
+                      help='width of the bins in degrees of solar longitude (default: 1)')
+    parser.add_option('--weighting', action='store', type='choice', choices=list(WEIGHTINGS), dest='weighting',
+                      default='time', help='weighting of the observations of a bin: time or equal (default: time)')
+    parser.add_option('-r', action='store', type='float', dest='r', default=None,
+                      help='population index (default: the population index of the shower)')
+    parser.add_option('--gamma', action='store', type='float', dest='gamma', default=1.0,
+                      help='exponent of the zenith correction (default: 1)')
+    parser.add_option('--min-rad-alt', action='store', type='float', dest='min_rad_alt', default=20.0,
+                      help='minimum radiant altitude in degrees (default: 20)')
+    parser.add_option('--min-lim-mag', action='store', type='float', dest='min_lim_mag', default=None,
+                      help='minimum limiting magnitude')
+    parser.add_option('--max-f', action='store', type='float', dest='max_f', default=None,
+                      help='maximum correction factor for the field of view obstruction')
+    parser.add_option('--from', action='store', dest='period_start', default=None, metavar='DATE',
+                      help='only use observations starting at or after this date')
+    parser.add_option('--to', action='store', dest='period_end', default=None, metavar='DATE',
+                      help='only use observations ending at or before this date')
+    parser.add_option('--observations', action='store_true', dest='observations', default=False,
+                      help='write the ZHR of each observation instead of the profile')
+    options, args = parser.parse_args(command_args)
+    if options.shower is None:
+        parser.error('--shower is required')
+    config = config_factory(options, parser)
+
+    shower = options.shower.upper()
+    try:
+        db_conn = DBAdapter(dict(config['database']))
+        r = options.r if options.r is not None else population_index(db_conn, shower)
+        rates = Rates.load(
+            db_conn,
+            shower,
+            period_start=options.period_start,
+            period_end=options.period_end,
+            min_rad_alt=options.min_rad_alt,
+            min_lim_mag=options.min_lim_mag,
+            max_f=options.max_f
+        )
+        db_conn.close()
+        if options.observations:
+            zhr = observation_zhr(rates, r, options.gamma)
+            column_names = ['id', 'session_id', 'sl', 'freq', 't_eff', 'lim_mag', 'rad_alt', 'zhr']
+            rows = zip(
+                rates.id.tolist(),
+                rates.session_id.tolist(),
+                rates.sl.round(4).tolist(),
+                rates.freq.astype(int).tolist(),
+                rates.t_eff.tolist(),
+                rates.lim_mag.tolist(),
+                rates.rad_alt.round(2).tolist(),
+                zhr.round(4).tolist()
+            )
+        else:
+            profile = zhr_profile(rates, r, options.bin_width, options.weighting, options.gamma)
+            column_names = ['sl_start', 'sl_end', 'sl', 'count', 'freq', 't_eff', 'zhr', 'zhr_error']
+            rows = ([b[c] for c in column_names] for b in profile)
+    except DBException as e:
+        print('Database error: %s' % e, file=sys.stderr)
+        sys.exit(100)
+    except ValueError as e:
+        parser.error(str(e))
+
+    out = open(options.output_file, 'w', newline='', encoding='utf-8') \
+        if options.output_file else sys.stdout
+    try:
+        writer = csv.writer(out, delimiter=';')
+        writer.writerow(column_names)
+        writer.writerows(rows)
+    finally:
+        if options.output_file:
+            out.close()
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from imo_vmdb.db import DBException
 
 
 class ImportException(Exception):
@@ -9,12 +10,21 @@ class CsvParser(object):
 
     _required_columns = {'MFpm+zb9fU7GUP9A'}
 
+    # imported table and the column referencing the session, if the records belong to sessions
+    _imported_table = None
+    _session_column = 'session_id'
+    # reference table and the column of the shower code, if the records are reference data of showers
+    _reference_table = None
+    _shower_column = 'shower'
+
     def __init__(self, db_conn, logger, do_delete=False, try_repair=False, is_permissive=False):
         self._db_conn = db_conn
         self._logger = logger
         self._do_delete = do_delete
         self._is_permissive = is_permissive
         self._try_repair = try_repair
+        self._dirty_session_ids = set()
+        self._reference_snapshot = None
         self.column_names = ()
         self.has_errors = False
 
@@ -26,7 +36,110 @@ class CsvParser(object):
         pass
 
     def on_shutdown(self, cur):
-        pass
+        self._write_dirty_sessions(cur)
+        self._write_dirty_showers(cur)
+
+    def _mark_imported_sessions_dirty(self, cur):
+        """
+        Mark all sessions of the imported table as replaced, before the table is emptied.
+
+        An incremental normalization removes the normalized records of replaced sessions
+        that are not imported again.
+        """
+        if self._imported_table is None:
+            return
+
+        db_conn = self._db_conn
+        params = {'imported_table': self._imported_table}
+        try:
+            cur.execute(db_conn.convert_stmt('''
+                UPDATE normalize_dirty SET replaced = 1
+                WHERE imported_table = %%(imported_table)s AND session_id IN (SELECT %s FROM %s)
+            ''' % (self._session_column, self._imported_table)), params)
+            cur.execute(db_conn.convert_stmt('''
+                INSERT INTO normalize_dirty (session_id, imported_table, replaced)
+                SELECT DISTINCT %s, %%(imported_table)s, 1 FROM %s
+                WHERE %s NOT IN (
+                    SELECT session_id FROM normalize_dirty WHERE imported_table = %%(imported_table)s
+                )
+            ''' % (self._session_column, self._imported_table, self._session_column)), params)
+        except Exception as e:
+            raise DBException(str(e))
+
+    def _write_dirty_sessions(self, cur):
+        """
+        Store the sessions changed by this import, so that they can be normalized incrementally.
+        """
+        session_ids = self._dirty_session_ids
+        if not session_ids:
+            return
+
+        db_conn = self._db_conn
+        params = {'imported_table': self._imported_table}
+        try:
+            cur.execute(db_conn.convert_stmt(
+                'SELECT session_id FROM normalize_dirty WHERE imported_table = %(imported_table)s'
+            ), params)
+            session_ids = session_ids - set(row[0] for row in cur.fetchall())
+            cur.executemany(
+                db_conn.convert_stmt('''
+                    INSERT INTO normalize_dirty (session_id, imported_table, replaced)
+                    VALUES (%(session_id)s, %(imported_table)s, 0)
+                '''),
+                [dict(params, session_id=session_id) for session_id in sorted(session_ids)]
+            )
+        except Exception as e:
+            raise DBException(str(e))
+
+        self._dirty_session_ids = set()
+
+    def _read_references(self, cur):
+        try:
+            cur.execute(self._db_conn.convert_stmt('SELECT * FROM %s' % self._reference_table))
+            column_names = [desc[0] for desc in cur.description]
+            rows = cur.fetchall()
+        except Exception as e:
+            raise DBException(str(e))
+
+        key = column_names.index(self._shower_column)
+        references = {}
+        for row in rows:
+            references.setdefault(row[key], []).append(tuple(row))
+
+        return dict((iau_code, sorted(rows)) for iau_code, rows in references.items())
+
+    def _snapshot_references(self, cur):
+        """
+        Remember the reference data before the import, to find the showers changed by the import.
+        """
+        if self._reference_table is not None and self._reference_snapshot is None:
+            self._reference_snapshot = self._read_references(cur)
+
+    def _write_dirty_showers(self, cur):
+        """
+        Store the showers whose reference data has been changed by this import, so that the
+        radiants of their rates can be normalized incrementally.
+        """
+        if self._reference_snapshot is None:
+            return
+
+        db_conn = self._db_conn
+        before = self._reference_snapshot
+        after = self._read_references(cur)
+        iau_codes = set(
+            iau_code for iau_code in set(before) | set(after) if before.get(iau_code) != after.get(iau_code)
+        )
+        try:
+            cur.execute(db_conn.convert_stmt('SELECT iau_code FROM normalize_dirty_shower'))
+            iau_codes = iau_codes - set(row[0] for row in cur.fetchall())
+            cur.executemany(
+                db_conn.convert_stmt('INSERT INTO normalize_dirty_shower (iau_code) VALUES (%(iau_code)s)'),
+                [{'iau_code': iau_code} for iau_code in sorted(iau_codes)]
+            )
+        except Exception as e:
+            raise DBException(str(e))
+
+        self._reference_snapshot = None
 
     def _log_error(self, msg):
         self._logger.error(msg)
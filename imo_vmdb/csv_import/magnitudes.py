@@ -30,12 +30,14 @@ class MagnitudesParser(CsvParser):
         'mag 7'
     }
 
+    _imported_table = 'imported_magnitude'
+
     def __init__(self, *args, **kwars):
         super().__init__(*args, **kwars)
-        self._delete_stmt = self._db_conn.convert_stmt(
+        self._delete_stmt = self._db_conn.prepare(
             'DELETE FROM imported_magnitude WHERE id = %(id)s'
         )
-        self._insert_stmt = self._db_conn.convert_stmt('''
+        self._insert_stmt = self._db_conn.prepare('''
             INSERT INTO imported_magnitude (
                 id,
                 observer_id,
@@ -57,6 +59,7 @@ class MagnitudesParser(CsvParser):
 
     def on_start(self, cur):
         if self._do_delete:
+            self._mark_imported_sessions_dirty(cur)
             try:
                 cur.execute(self._db_conn.convert_stmt('DELETE FROM imported_magnitude'))
             except Exception as e:
@@ -124,11 +127,13 @@ class MagnitudesParser(CsvParser):
         }
 
         try:
-            cur.execute(self._delete_stmt, {'id': magn_id})
-            cur.execute(self._insert_stmt, record)
+            self._delete_stmt.execute(cur, {'id': magn_id})
+            self._insert_stmt.execute(cur, record)
         except Exception as e:
             raise DBException(str(e))
 
+        self._dirty_session_ids.add(session_id)
+
         return True
 
     @staticmethod
@@ -4,6 +4,8 @@ from imo_vmdb.db import DBException
 
 class RadiantParser(CsvParser):
 
+    _reference_table = 'radiant'
+
     _required_columns = {
         'shower',
         'ra',
@@ -14,10 +16,10 @@ class RadiantParser(CsvParser):
 
     def __init__(self, *args, **kwars):
         super().__init__(*args, **kwars)
-        self._delete_stmt = self._db_conn.convert_stmt(
+        self._delete_stmt = self._db_conn.prepare(
             'DELETE FROM radiant WHERE shower = %(shower)s AND "month" = %(month)s AND "day" = %(day)s'
         )
-        self._insert_stmt = self._db_conn.convert_stmt('''
+        self._insert_stmt = self._db_conn.prepare('''
             INSERT INTO radiant (
                 shower,
                 ra,
@@ -34,6 +36,7 @@ class RadiantParser(CsvParser):
         ''')
 
     def on_start(self, cur):
+        self._snapshot_references(cur)
         if self._do_delete:
             try:
                 cur.execute(self._db_conn.convert_stmt('DELETE FROM radiant'))
@@ -66,8 +69,8 @@ class RadiantParser(CsvParser):
         }
 
         try:
-            cur.execute(self._delete_stmt, {'shower': shower, 'month': month, 'day': day})
-            cur.execute(self._insert_stmt, record)
+            self._delete_stmt.execute(cur, {'shower': shower, 'month': month, 'day': day})
+            self._insert_stmt.execute(cur, record)
         except Exception as e:
             raise DBException(str(e))
 
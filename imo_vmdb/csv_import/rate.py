@@ -21,12 +21,14 @@ class RateParser(CsvParser):
         'number'
     }
 
+    _imported_table = 'imported_rate'
+
     def __init__(self, *args, **kwars):
         super().__init__(*args, **kwars)
-        self._delete_stmt = self._db_conn.convert_stmt(
+        self._delete_stmt = self._db_conn.prepare(
             'DELETE FROM imported_rate WHERE id = %(id)s'
         )
-        self._insert_stmt = self._db_conn.convert_stmt('''
+        self._insert_stmt = self._db_conn.prepare('''
             INSERT INTO imported_rate (
                 id,
                 observer_id,
@@ -60,6 +62,7 @@ class RateParser(CsvParser):
 
     def on_start(self, cur):
         if self._do_delete:
+            self._mark_imported_sessions_dirty(cur)
             try:
                 cur.execute(self._db_conn.convert_stmt('DELETE FROM imported_rate'))
             except Exception as e:
@@ -110,11 +113,13 @@ class RateParser(CsvParser):
         }
 
         try:
-            cur.execute(self._delete_stmt, {'id': rate_id})
-            cur.execute(self._insert_stmt, record)
+            self._delete_stmt.execute(cur, {'id': rate_id})
+            self._insert_stmt.execute(cur, record)
         except Exception as e:
             raise DBException(str(e))
 
+        self._dirty_session_ids.add(session_id)
+
         return True
 
     @staticmethod
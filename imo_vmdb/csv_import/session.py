@@ -15,12 +15,15 @@ class SessionParser(CsvParser):
         'country'
     }
 
+    _imported_table = 'imported_session'
+    _session_column = 'id'
+
     def __init__(self, *args, **kwars):
         super().__init__(*args, **kwars)
-        self._delete_stmt = self._db_conn.convert_stmt(
+        self._delete_stmt = self._db_conn.prepare(
             'DELETE FROM imported_session WHERE id = %(id)s'
         )
-        self._insert_stmt = self._db_conn.convert_stmt('''
+        self._insert_stmt = self._db_conn.prepare('''
             INSERT INTO imported_session (
                 id,
                 observer_id,
@@ -44,6 +47,7 @@ class SessionParser(CsvParser):
 
     def on_start(self, cur):
         if self._do_delete:
+            self._mark_imported_sessions_dirty(cur)
             try:
                 cur.execute(self._db_conn.convert_stmt('DELETE FROM imported_session'))
             except Exception as e:
@@ -77,11 +81,13 @@ class SessionParser(CsvParser):
         }
 
         try:
-            cur.execute(self._delete_stmt, {'id': session_id})
-            cur.execute(self._insert_stmt, record)
+            self._delete_stmt.execute(cur, {'id': session_id})
+            self._insert_stmt.execute(cur, record)
         except Exception as e:
             raise DBException(str(e))
 
+        self._dirty_session_ids.add(session_id)
+
         return True
 
     @staticmethod
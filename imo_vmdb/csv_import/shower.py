@@ -20,6 +20,9 @@ class ShowerParser(CsvParser):
         'Dec': 12,
     }
 
+    _reference_table = 'shower'
+    _shower_column = 'iau_code'
+
     _required_columns = {
         'id',
         'iau_code',
@@ -36,10 +39,10 @@ class ShowerParser(CsvParser):
 
     def __init__(self, *args, **kwars):
         super().__init__(*args, **kwars)
-        self._delete_stmt = self._db_conn.convert_stmt(
+        self._delete_stmt = self._db_conn.prepare(
             'DELETE FROM shower WHERE iau_code = %(iau_code)s'
         )
-        self._insert_stmt = self._db_conn.convert_stmt('''
+        self._insert_stmt = self._db_conn.prepare('''
             INSERT INTO shower (
                 id,
                 iau_code,
@@ -74,6 +77,7 @@ class ShowerParser(CsvParser):
         ''')
 
     def on_start(self, cur):
+        self._snapshot_references(cur)
         if self._do_delete:
             try:
                 cur.execute(self._db_conn.convert_stmt('DELETE FROM shower'))
@@ -120,8 +124,8 @@ class ShowerParser(CsvParser):
         }
 
         try:
-            cur.execute(self._delete_stmt, {'iau_code': iau_code})
-            cur.execute(self._insert_stmt, record)
+            self._delete_stmt.execute(cur, {'iau_code': iau_code})
+            self._insert_stmt.execute(cur, record)
         except Exception as e:
             raise DBException(str(e))
 
@@ -1,41 +1,880 @@
 import importlib
+import os
 import re
+import threading
+import time
 import warnings
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.request import pathname2url
 
 
 class DBException(Exception):
     pass
 
 
+# PRAGMA settings of the option `sqlite_profile`. `bulk` is meant for imports and normalizations,
+# `serving` for the web server. Both use a write-ahead log, so readers do not block the writer.
+SQLITE_PROFILES = {
+    'bulk': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': '-262144',
+        'mmap_size': '1073741824',
+        'temp_store': 'MEMORY',
+        'busy_timeout': '60000',
+    },
+    'serving': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': '-65536',
+        'mmap_size': '268435456',
+        'temp_store': 'MEMORY',
+        'busy_timeout': '5000',
+    },
+}
+
+# maximum number of statements memoized by `DBAdapter.convert_stmt`
+STATEMENT_CACHE_SIZE = 1000
+
+# Secondary indexes of the tables as tuples of the name, the table and the columns. Besides the
+# foreign keys, they support the filters of the REST API (see `_build_rate_conditions` and
+# `_build_magnitude_conditions` in `imo_vmdb.webui.api`), the analysis and the session ranges
+# of the normalization.
+INDEXES = (
+    ('rate_period_shower_key', 'rate', ('period_start', 'period_end', 'shower')),
+    ('rate_shower_sl_key', 'rate', ('shower', 'sl_start', 'sl_end')),
+    ('rate_sl_key', 'rate', ('sl_start', 'sl_end')),
+    ('rate_lim_mag_key', 'rate', ('lim_mag',)),
+    ('rate_session_key', 'rate', ('session_id',)),
+    ('magnitude_period_shower_key', 'magnitude', ('period_start', 'period_end', 'shower')),
+    ('magnitude_shower_sl_key', 'magnitude', ('shower', 'sl_start', 'sl_end')),
+    ('magnitude_sl_key', 'magnitude', ('sl_start', 'sl_end')),
+    ('magnitude_lim_mag_key', 'magnitude', ('lim_mag',)),
+    ('magnitude_session_key', 'magnitude', ('session_id',)),
+    ('fki_magnitude_detail_fk', 'magnitude_detail', ('id',)),
+    ('fki_rate_magnitude_magn_fk', 'rate_magnitude', ('magn_id',)),
+    ('imported_rate_order_key', 'imported_rate', ('session_id', 'shower', '"start"', '"end"')),
+    ('imported_magnitude_order_key', 'imported_magnitude', ('session_id', 'shower', '"start"', '"end"')),
+)
+
+# indexes of the generated columns of the option `timestamp_storage = epoch`
+EPOCH_INDEXES = (
+    ('rate_period_epoch_shower_key', 'rate', ('period_start_epoch', 'period_end_epoch', 'shower')),
+    ('magnitude_period_epoch_shower_key', 'magnitude', ('period_start_epoch', 'period_end_epoch', 'shower')),
+)
+
+# Generated columns of the option `timestamp_storage = epoch` as tuples of the timestamp column and the
+# column with its seconds since 1970-01-01. Comparisons and conversions of integers are much faster
+# than of the timestamps, which SQLite stores as text.
+EPOCH_COLUMNS = {
+    'rate': (('period_start', 'period_start_epoch'), ('period_end', 'period_end_epoch')),
+    'magnitude': (('period_start', 'period_start_epoch'), ('period_end', 'period_end_epoch')),
+    'imported_rate': (('"start"', 'start_epoch'), ('"end"', 'end_epoch')),
+    'imported_magnitude': (('"start"', 'start_epoch'), ('"end"', 'end_epoch')),
+}
+
+_timestamp_storages = ('text', 'epoch')
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Tables of the option `partitioning = year` (PostgreSQL only). They are range-partitioned by the year of
+# `period_start`, the partitions are named `<table>_y<year>` and are created by the normalization.
+PARTITIONED_TABLES = ('rate', 'magnitude', 'magnitude_detail')
+
+_partitionings = ('none', 'year')
+
+# indexes of the catalog used by the imports and normalizations themselves, see `DBAdapter.bulk_load`
+_LOAD_INDEXES = frozenset((
+    'rate_session_key',
+    'magnitude_session_key',
+    'fki_magnitude_detail_fk',
+    'fki_rate_magnitude_magn_fk',
+))
+
+# foreign keys of the tables as tuples of the name, the table, the column, the referenced table and
+# the referenced column
+FOREIGN_KEYS = (
+    ('rate_session_fk', 'rate', 'session_id', 'obs_session', 'id'),
+    ('magnitude_session_fk', 'magnitude', 'session_id', 'obs_session', 'id'),
+    ('magnitude_detail_fk', 'magnitude_detail', 'id', 'magnitude', 'id'),
+    ('rate_magnitude_rate_fk', 'rate_magnitude', 'rate_id', 'rate', 'id'),
+    ('rate_magnitude_magn_fk', 'rate_magnitude', 'magn_id', 'magnitude', 'id'),
+)
+
+# suffix of the file next to a SQLite database file that names the file of its current generation,
+# see `imo_vmdb.generations`
+GENERATION_SUFFIX = '.generation'
+
+_sqlite_value_pattern = re.compile('^-?[A-Za-z0-9]+$')
+
+# connect arguments of sqlite3 that are not strings, e.g. if read from a config file
+_sqlite_arg_types = {
+    'timeout': float,
+    'detect_types': int,
+    'cached_statements': int,
+}
+
+
 class DBAdapter(object):
 
-    def __init__(self, config):
+    def __init__(self, config, read_only=False):
+        """
+        :param config: Connect arguments of the database module, and the name of the module as `module`.
+            With SQLite, the option `sqlite_profile` selects PRAGMA settings of `SQLITE_PROFILES`, and
+            options `sqlite_<pragma>` set or override single settings.
+        :param read_only: If True, a SQLite database is opened read-only.
+        """
         self.db_module = config.get('module', 'sqlite3')
         if 'module' in config:
             config.pop('module')
+        connect_args = dict(config)
+        self.timestamp_storage = connect_args.pop('timestamp_storage', 'text')
+        if self.timestamp_storage not in _timestamp_storages:
+            raise DBException(
+                'Unknown timestamp_storage %s. Valid values are %s.' %
+                (self.timestamp_storage, ', '.join(_timestamp_storages))
+            )
+        self.partitioning = connect_args.pop('partitioning', 'none')
+        if self.partitioning not in _partitionings:
+            raise DBException(
+                'Unknown partitioning %s. Valid values are %s.' % (self.partitioning, ', '.join(_partitionings))
+            )
+        pragmas = {}
+        self.database_file = None
+        if 'sqlite3' == self.db_module:
+            pragmas = self._sqlite_pragmas(connect_args)
+            connect_args['database'] = generation_file(connect_args['database'])
+            self.database_file = connect_args['database']
+            for key, arg_type in _sqlite_arg_types.items():
+                if isinstance(connect_args.get(key), str):
+                    connect_args[key] = arg_type(connect_args[key])
+            # the normalizers share the connection between threads and serialize the access
+            connect_args.setdefault('check_same_thread', False)
+            if read_only:
+                # the journal mode is stored in the database file, it cannot be set by a reader
+                pragmas.pop('journal_mode', None)
+                connect_args['database'] = 'file:%s?mode=ro' % pathname2url(connect_args['database'])
+                connect_args['uri'] = True
         db = importlib.import_module(self.db_module)
-        self.conn = db.connect(**config)
+        self.conn = db.connect(**connect_args)
+        self._stream_counter = 0
+        self._epoch_columns = None
+        self._partitioned = None
+        self._statements = {}
+        self._prepared_statements = {}
+        self._statement_counters = {
+            'converted': 0,
+            'reused': 0,
+            'prepared': 0,
+            'executed': 0,
+        }
         if 'sqlite3' == self.db_module:
             self.conn.execute('PRAGMA foreign_keys = ON')
+            for name, value in pragmas.items():
+                self.conn.execute('PRAGMA %s = %s' % (name, value))
+
+    @staticmethod
+    def _sqlite_pragmas(connect_args):
+        profile = connect_args.pop('sqlite_profile', None)
+        if profile is not None and profile not in SQLITE_PROFILES:
+            raise DBException(
+                'Unknown sqlite_profile %s. Valid profiles are %s.' % (profile, ', '.join(SQLITE_PROFILES))
+            )
+
+        pragmas = dict(SQLITE_PROFILES.get(profile, {}))
+        for key in [k for k in connect_args if k.startswith('sqlite_')]:
+            name = key[len('sqlite_'):]
+            value = str(connect_args.pop(key))
+            if name not in SQLITE_PROFILES['bulk'] or not _sqlite_value_pattern.match(value):
+                raise DBException('Invalid SQLite setting %s = %s.' % (key, value))
+            pragmas[name] = value
+
+        return pragmas
 
     def cursor(self):
         return self.conn.cursor()
 
+    def stream(self, stmt, params=None, size=1000):
+        """
+        Execute a SELECT statement and fetch the result in batches.
+
+        With psycopg2, the rows are read by a server-side (named) cursor, with pymysql by an
+        unbuffered cursor, so only one batch is held in memory. The result must be read completely
+        before the next statement is executed on this connection.
+
+        :param stmt: The statement. It is converted with `convert_stmt`.
+        :param params: Optional parameters of the statement.
+        :param size: Number of rows fetched at once.
+        :return: Generator of tuples of the column names and a non-empty list of rows.
+        """
+        try:
+            if 'psycopg2' == self.db_module:
+                self._stream_counter += 1
+                cur = self.conn.cursor(name='imo_vmdb_stream_%s' % self._stream_counter)
+                cur.itersize = size
+            elif 'pymysql' == self.db_module:
+                cur = self.conn.cursor(importlib.import_module('pymysql.cursors').SSCursor)
+            else:
+                cur = self.conn.cursor()
+            cur.execute(self.convert_stmt(stmt), params or {})
+        except Exception as e:
+            raise DBException(str(e))
+
+        try:
+            while True:
+                try:
+                    rows = cur.fetchmany(size)
+                except Exception as e:
+                    raise DBException(str(e))
+                if not rows:
+                    break
+                yield [desc[0] for desc in cur.description], rows
+        finally:
+            cur.close()
+
     def commit(self):
         self.conn.commit()
 
+    def rollback(self):
+        self.conn.rollback()
+
     def close(self):
         self.conn.close()
 
+    @property
+    def epoch_columns(self):
+        """
+        True, if the tables have the generated epoch columns of the option `timestamp_storage = epoch`.
+        """
+        if self._epoch_columns is None:
+            self._epoch_columns = _has_column(self, 'rate', 'period_start_epoch')
+
+        return self._epoch_columns
+
+    @property
+    def partitioned(self):
+        """
+        True, if the tables of `PARTITIONED_TABLES` are partitioned by year (option `partitioning = year`).
+        """
+        if self._partitioned is None:
+            self._partitioned = 'psycopg2' == self.db_module and _is_partitioned(self, 'rate')
+
+        return self._partitioned
+
+    @contextmanager
+    def bulk_load(self, tables):
+        """
+        Defer the maintenance of the secondary indexes and the checks of the foreign keys of tables
+        that are rewritten in bulk.
+
+        The indexes of the catalog (see `index_catalog`) on the tables are dropped, except those used by the
+        imports and normalizations themselves, and created again at the end. With SQLite, the checks
+        of the foreign keys are deferred and the foreign keys of the tables are validated at the end
+        in one pass; ON DELETE CASCADE still applies. With the other database modules, the foreign
+        keys are checked immediately, since disabling the checks would also disable the cascades.
+
+        The block must not commit: if it fails, the dropped indexes are restored by the rollback of
+        the transaction, or created again where DDL statements are not transactional (MySQL).
+
+        :param tables: Names of the tables.
+        :raises DBException: If a foreign key of the tables is violated at the end.
+        """
+        drop_indexes(self, tables, keep=_LOAD_INDEXES)
+        deferred = 'sqlite3' == self.db_module
+        if deferred:
+            # reset by the end of the transaction
+            self.conn.execute('PRAGMA defer_foreign_keys = ON')
+
+        try:
+            yield
+        except BaseException:
+            try:
+                create_indexes(self, tables)
+            except DBException:
+                # the transaction is aborted, its rollback restores the dropped indexes
+                pass
+            raise
+
+        create_indexes(self, tables)
+        if deferred:
+            check_foreign_keys(self, tables)
+
     def convert_stmt(self, stmt):
+        """
+        Convert a statement with `%(name)s` parameters to the parameter style of the database module.
+
+        The converted statements are memoized by their text, up to `STATEMENT_CACHE_SIZE` statements.
+        """
+        converted = self._statements.get(stmt)
+        if converted is not None:
+            self._statement_counters['reused'] += 1
+            return converted
+
+        converted = stmt
         if 'sqlite3' == self.db_module:
-            stmt = stmt.replace(' %% ', ' % ')
-            return re.sub('%\\(([^)]*)\\)s', ':\\1', stmt)
+            converted = converted.replace(' %% ', ' % ')
+            converted = re.sub('%\\(([^)]*)\\)s', ':\\1', converted)
+        if len(self._statements) >= STATEMENT_CACHE_SIZE:
+            # the statements are kept in the order of their conversion, the oldest one is dropped
+            del self._statements[next(iter(self._statements))]
+        self._statements[stmt] = converted
+        self._statement_counters['converted'] += 1
+
+        return converted
+
+    def prepare(self, stmt):
+        """
+        Return the prepared statement of a statement with `%(name)s` parameters.
+
+        With psycopg2, the statement is prepared on the server when it is executed for the first time,
+        so it is planned only once per connection. The other database modules cache the statements
+        themselves, the statement is then only converted.
+
+        :param stmt: The statement, e.g. an INSERT or DELETE executed for each record.
+        :rtype: PreparedStatement
+        """
+        prepared = self._prepared_statements.get(stmt)
+        if prepared is not None:
+            self._statement_counters['reused'] += 1
+            return prepared
+
+        name = None
+        if 'psycopg2' == self.db_module:
+            name = 'imo_vmdb_stmt_%s' % (len(self._prepared_statements) + 1)
+        prepared = PreparedStatement(self, stmt, name)
+        self._prepared_statements[stmt] = prepared
+
+        return prepared
+
+    def statement_stats(self):
+        """
+        Return the counters of the statement registry.
+
+        :return: Dictionary with the number of `converted` statements, the number of `reused`
+            statements that were taken from the registry, the number of statements `prepared`
+            on the server and the number of `executed` prepared statements.
+        :rtype: dict
+        """
+        return dict(self._statement_counters)
+
+
+class PreparedStatement(object):
+    """
+    A statement created by :meth:`DBAdapter.prepare`.
+
+    With a name, the statement is prepared on the server with `PREPARE` and executed with `EXECUTE`,
+    the parameters are then passed in the order of their first occurrence in the statement.
+    """
+
+    def __init__(self, db_conn, stmt, name=None):
+        self._db_conn = db_conn
+        self._name = name
+        self._is_prepared = False
+        if name is None:
+            self._stmt = db_conn.convert_stmt(stmt)
+            return
+
+        param_names = []
+
+        def placeholder(match):
+            if match.group(1) not in param_names:
+                param_names.append(match.group(1))
+            return '$%s' % (param_names.index(match.group(1)) + 1)
+
+        # the statement is sent without parameters, so `%%` is not unescaped by the database module
+        self._stmt = re.sub('%\\(([^)]*)\\)s', placeholder, stmt).replace('%%', '%')
+        self._param_names = param_names
+        self._execute_stmt = 'EXECUTE %s' % name
+        if param_names:
+            self._execute_stmt += ' (%s)' % ', '.join(['%s'] * len(param_names))
+
+    def execute(self, cur, params=None):
+        """
+        Execute the statement with a cursor of the connection.
+        """
+        if self._name is None:
+            cur.execute(self._stmt, params or {})
+            return
+
+        if not self._is_prepared:
+            cur.execute('PREPARE %s AS %s' % (self._name, self._stmt))
+            self._is_prepared = True
+            self._db_conn._statement_counters['prepared'] += 1
+        params = params or {}
+        cur.execute(self._execute_stmt, [params[name] for name in self._param_names])
+        self._db_conn._statement_counters['executed'] += 1
+
+    def executemany(self, cur, seq_of_params):
+        """
+        Execute the statement for each parameters of a sequence.
+        """
+        if self._name is None:
+            cur.executemany(self._stmt, seq_of_params)
+            return
+
+        for params in seq_of_params:
+            self.execute(cur, params)
+
+
+class DBPool(object):
+    """
+    A thread-safe pool of database connections, e.g. for the web server.
+
+    A thread checks out a connection with `checkout` and returns it with `close`. If the thread
+    checks out again before returning the connection, it gets the same connection. A connection is
+    replaced when it is older than `max_lifetime` seconds, or when it has been idle for more than
+    `check_interval` seconds and fails a `SELECT 1`. If all `size` connections are checked out,
+    `checkout` waits up to `timeout` seconds for a returned connection. With `read_only`, the
+    connections are opened read-only (see :class:`DBAdapter`).
+    """
+
+    def __init__(self, config, size=5, max_lifetime=3600, check_interval=30, timeout=30, read_only=False):
+        self._config = dict(config)
+        self._read_only = read_only
+        self._size = size
+        self._max_lifetime = max_lifetime
+        self._check_interval = check_interval
+        self._timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._local = threading.local()
+        self._available = threading.Condition()
+        self._counters = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'failed_checks': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config, read_only=False):
+        """
+        Create a pool with the connection settings of the section `database` and the pool
+        settings `size`, `max_lifetime`, `check_interval` and `timeout` of the section `pool`.
+        """
+        return cls(config['database'], read_only=read_only, **_pool_options(config))
+
+    def checkout(self):
+        """
+        Check out a connection for the current thread.
+
+        :return: The connection. Its method `close` returns it to the pool.
+        :rtype: PooledConnection
+        :raises DBException: If no connection is available within the timeout or cannot be opened.
+        """
+        checked_out = getattr(self._local, 'connection', None)
+        if checked_out is not None:
+            checked_out.depth += 1
+            return checked_out
+
+        entry = self._acquire()
+        self._local.connection = PooledConnection(self, entry)
+        return self._local.connection
+
+    def stats(self):
+        """
+        :return: Dictionary of the size, the numbers of open, idle and checked out connections,
+            and the counters of the pool.
+        :rtype: dict
+        """
+        with self._available:
+            stats = {
+                'size': self._size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+            }
+            stats.update(self._counters)
+
+        return stats
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._counters['closed'] += len(idle)
+        for entry in idle:
+            self._close(entry)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self._timeout
+        with self._available:
+            self._counters['checkouts'] += 1
+        while True:
+            entry = None
+            with self._available:
+                while not self._idle and self._open >= self._size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise DBException('No database connection available within %s seconds.' % self._timeout)
+                    self._counters['waits'] += 1
+                    self._available.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._open += 1
+
+            # the connection is checked or opened outside of the lock
+            if entry is None:
+                return self._connect()
+            if self._is_usable(entry):
+                with self._available:
+                    self._counters['reused'] += 1
+                return entry
+
+            self._close(entry)
+            with self._available:
+                self._open -= 1
+                self._counters['closed'] += 1
+
+    def _connect(self):
+        try:
+            db_conn = DBAdapter(dict(self._config), self._read_only)
+        except Exception as e:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise DBException(str(e))
+
+        with self._available:
+            self._counters['created'] += 1
+        now = time.monotonic()
+        return [db_conn, now, now]
+
+    def _release(self, entry):
+        db_conn = entry[0]
+        try:
+            db_conn.rollback()
+            usable = True
+        except Exception:
+            usable = False
+
+        with self._available:
+            self._local.connection = None
+            if usable:
+                entry[2] = time.monotonic()
+                self._idle.append(entry)
+            else:
+                self._open -= 1
+                self._counters['closed'] += 1
+            self._available.notify()
+        if not usable:
+            self._close(entry)
+
+    def _is_usable(self, entry):
+        db_conn, created, last_used = entry
+        if db_conn.database_file is not None and db_conn.database_file != generation_file(self._config['database']):
+            # replaced by a blue/green normalization, the connection still reads the previous generation
+            return False
+        now = time.monotonic()
+        if now - created > self._max_lifetime:
+            return False
+        if now - last_used <= self._check_interval:
+            return True
+
+        try:
+            cur = db_conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchall()
+            cur.close()
+        except Exception:
+            with self._available:
+                self._counters['failed_checks'] += 1
+            return False
+
+        return True
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry[0].close()
+        except Exception:
+            pass
+
+
+def _pool_options(config):
+    # settings of the section `pool`
+    options = {}
+    if config.has_section('pool'):
+        for key, convert in (('size', int), ('max_lifetime', float), ('check_interval', float),
+                             ('timeout', float)):
+            if config.has_option('pool', key):
+                options[key] = convert(config.get('pool', key))
+
+    return options
+
+
+class PooledConnection(object):
+    """
+    A connection checked out from a :class:`DBPool`.
+
+    It provides the methods of :class:`DBAdapter`. `close` returns the connection to the pool,
+    after the last `close` of a thread that has checked it out several times.
+    """
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+        self.depth = 1
 
-        return stmt
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise DBException('The connection has been returned to the pool.')
 
+        return getattr(self._entry[0], name)
 
-def create_tables(db_conn):
+    def close(self):
+        if self._entry is None:
+            return
+
+        self.depth -= 1
+        if self.depth == 0:
+            entry, self._entry = self._entry, None
+            self._pool._release(entry)
+
+
+class ReplicaRouter(object):
+    """
+    Routes the connections of readers to a read replica, and to the primary database while the
+    replica lags behind or is unavailable.
+
+    It provides the methods `checkout`, `stats` and `close` of :class:`DBPool`. Both databases have
+    their own pool, the connections of the primary are opened read-only. The lag of the replica is
+    determined at most every `lag_check_interval` seconds (see `replication_lag`). A replica whose lag
+    exceeds `max_lag` seconds, or which cannot be connected, is not used until the next check.
+    """
+
+    def __init__(self, primary, replica, max_lag=30, lag_check_interval=10):
+        """
+        :param primary: The pool of the primary database.
+        :param replica: The pool of the replica.
+        :param max_lag: Maximum lag of the replica in seconds.
+        :param lag_check_interval: Seconds after which the lag of the replica is determined again.
+        """
+        self._primary = primary
+        self._replica = replica
+        self._max_lag = max_lag
+        self._lag_check_interval = lag_check_interval
+        self._lock = threading.Lock()
+        self._checked = None
+        self._lag = None
+        self._usable = False
+        self._counters = {
+            'replica_checkouts': 0,
+            'fallbacks': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a router with the connection settings of the sections `database` and `database_readonly`.
+
+        Settings that `database_readonly` lacks, e.g. `module`, are taken from `database`. The options
+        `max_lag` and `lag_check_interval` of `database_readonly` configure the router, the section `pool`
+        both pools.
+        """
+        replica_config = dict(config['database'])
+        replica_config.update(config['database_readonly'])
+        options = {}
+        for key in ('max_lag', 'lag_check_interval'):
+            if key in replica_config:
+                options[key] = float(replica_config.pop(key))
+
+        pool_options = _pool_options(config)
+        return cls(
+            DBPool(config['database'], read_only=True, **pool_options),
+            DBPool(replica_config, read_only=True, **pool_options),
+            **options
+        )
+
+    def checkout(self):
+        """
+        Check out a connection of the replica, or of the primary database if the replica is not usable.
+
+        :return: The connection. Its method `close` returns it to its pool.
+        :rtype: PooledConnection
+        :raises DBException: If no connection of the primary database is available.
+        """
+        if self._replica_usable():
+            try:
+                db_conn = self._replica.checkout()
+                with self._lock:
+                    self._counters['replica_checkouts'] += 1
+                return db_conn
+            except DBException:
+                with self._lock:
+                    self._usable = False
+
+        with self._lock:
+            self._counters['fallbacks'] += 1
+        return self._primary.checkout()
+
+    def stats(self):
+        """
+        :return: Dictionary of the statistics of the replica pool (see `DBPool.stats`), the statistics of
+            the primary pool as `primary`, the last lag of the replica in seconds, whether the replica is
+            used, and the counters of the router.
+        :rtype: dict
+        """
+        stats = self._replica.stats()
+        with self._lock:
+            stats['primary'] = self._primary.stats()
+            stats['replica_lag'] = self._lag
+            stats['replica_used'] = self._usable
+            stats.update(self._counters)
+
+        return stats
+
+    def close(self):
+        """
+        Close the idle connections of both pools.
+        """
+        self._replica.close()
+        self._primary.close()
+
+    def _replica_usable(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked is not None and now - self._checked < self._lag_check_interval:
+                return self._usable
+            # the other threads use the previous state during the check
+            self._checked = now
+
+        try:
+            lag = self._measure_lag()
+        except DBException:
+            lag = None
+
+        with self._lock:
+            self._lag = lag
+            self._usable = lag is not None and lag <= self._max_lag
+            return self._usable
+
+    def _measure_lag(self):
+        primary_config = self._primary._config
+        replica_config = self._replica._config
+        if 'sqlite3' == primary_config.get('module', 'sqlite3') == replica_config.get('module', 'sqlite3'):
+            # a copy of the database file, e.g. by a backup or a file replication tool
+            return _sqlite_file_lag(
+                generation_file(primary_config['database']), generation_file(replica_config['database'])
+            )
+
+        db_conn = self._replica.checkout()
+        try:
+            return replication_lag(db_conn)
+        finally:
+            db_conn.close()
+
+
+def replication_lag(db_conn):
+    """
+    Return the lag of a read replica in seconds.
+
+    On PostgreSQL, it is the age of the last replayed transaction while the replica has not yet
+    replayed all received changes. On MySQL, it is `Seconds_Behind_Source` of `SHOW REPLICA STATUS`.
+    A database that is not a replica has no lag.
+
+    :param db_conn: An open connection of the replica.
+    :return: The lag in seconds, or None if the replication is stopped.
+    """
+    try:
+        cur = db_conn.cursor()
+        if 'psycopg2' == db_conn.db_module:
+            cur.execute('''
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+                END
+            ''')
+            lag = cur.fetchone()[0]
+        elif 'pymysql' == db_conn.db_module:
+            cur.execute('SHOW REPLICA STATUS')
+            row = cur.fetchone()
+            if row is None:
+                lag = 0
+            else:
+                status = dict(zip([d[0] for d in cur.description], row))
+                lag = status.get('Seconds_Behind_Source')
+        else:
+            lag = 0
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return None if lag is None else float(lag)
+
+
+def generation_file(path):
+    """
+    Return the file of the current generation of a SQLite database, see :mod:`imo_vmdb.generations`.
+
+    :param path: The database file of the configuration.
+    """
+    try:
+        with open(path + GENERATION_SUFFIX, encoding='utf-8') as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return path
+    except OSError as e:
+        raise DBException(str(e))
+
+    return os.path.join(os.path.dirname(path), name)
+
+
+def _sqlite_file_lag(primary_path, replica_path):
+    # seconds between the last modifications of the files, including their write-ahead logs
+    def modified(path):
+        times = [os.stat(p).st_mtime for p in (path, path + '-wal') if os.path.exists(p)]
+        if not times:
+            raise DBException('The database file %s does not exist.' % path)
+        return max(times)
+
+    return max(0.0, modified(primary_path) - modified(replica_path))
+
+
+def create_tables(db_conn, partitioning=None):
+    """
+    Create the tables, removing existing tables and their data.
+
+    With the option `timestamp_storage = epoch` of the database connection, the tables of the
+    observations get generated columns with the periods in seconds since 1970-01-01 (see
+    `EPOCH_COLUMNS`).
+
+    With partitioning `year`, the tables of `PARTITIONED_TABLES` are range-partitioned by the year of
+    `period_start` (PostgreSQL only). Their primary keys include `period_start`, so `magnitude_detail`
+    gets a copy of the column, and `rate_magnitude` has no foreign keys to `rate` and `magnitude`. The
+    partitions are created by the normalization, see `create_partitions`.
+
+    :param db_conn: An open database connection.
+    :param partitioning: `none` or `year`. Default is the option `partitioning` of the database connection.
+    """
+    epoch = 'epoch' == db_conn.timestamp_storage
+    partitioned = 'year' == (partitioning or db_conn.partitioning)
+    if partitioned and 'psycopg2' != db_conn.db_module:
+        raise DBException('Partitioning is only supported by PostgreSQL.')
+    if partitioned and epoch:
+        # the partitions are only pruned by conditions on period_start, not on the epoch columns
+        raise DBException('The options partitioning = year and timestamp_storage = epoch cannot be combined.')
+
+    partition_key = ', period_start' if partitioned else ''
+    partition_by = '\n            PARTITION BY RANGE (period_start)' if partitioned else ''
+    rate_magnitude_fks = '' if partitioned else """,
+                CONSTRAINT rate_magnitude_rate_fk FOREIGN KEY (rate_id)
+                    REFERENCES rate (id) MATCH SIMPLE
+                    ON UPDATE CASCADE
+                    ON DELETE CASCADE,
+                CONSTRAINT rate_magnitude_magn_fk FOREIGN KEY (magn_id)
+                    REFERENCES magnitude(id) MATCH SIMPLE
+                    ON UPDATE CASCADE
+                    ON DELETE CASCADE"""
     cur = db_conn.cursor()
 
     try:
@@ -51,6 +890,16 @@ def create_tables(db_conn):
             cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS imported_session'))
             cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS imported_rate'))
             cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS imported_magnitude'))
+            cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS normalize_work'))
+            cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS normalize_dirty'))
+            cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS normalize_dirty_shower'))
+            cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS normalize_progress'))
+            cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS normalize_discard'))
+            cur.execute(db_conn.convert_stmt('DROP TABLE IF EXISTS r_estimate'))
+
+        if 'sqlite3' == db_conn.db_module:
+            # only effective in a database without tables, see `vacuum`
+            cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
 
         cur.execute(db_conn.convert_stmt('''
             CREATE TABLE obs_session
@@ -70,7 +919,7 @@ def create_tables(db_conn):
                 id integer NOT NULL,
                 shower varchar(6) NULL,
                 period_start timestamp NOT NULL,
-                period_end timestamp NOT NULL,
+                period_end timestamp NOT NULL,{epoch_columns}
                 sl_start double precision NOT NULL,
                 sl_end double precision NOT NULL,
                 session_id integer NOT NULL,
@@ -88,79 +937,63 @@ def create_tables(db_conn):
                 field_az double precision NULL,
                 rad_alt double precision NULL,
                 rad_az double precision NULL,
-                CONSTRAINT rate_pkey PRIMARY KEY (id),
+                CONSTRAINT rate_pkey PRIMARY KEY (id{partition_key}),
                 CONSTRAINT rate_session_fk FOREIGN KEY (session_id)
                     REFERENCES obs_session(id) MATCH SIMPLE
                     ON UPDATE CASCADE
                     ON DELETE CASCADE
-            )'''))
-        cur.execute(
-            db_conn.convert_stmt(
-                'CREATE INDEX rate_period_shower_key ON rate(period_start, period_end, shower)'
-            )
-        )
+            ){partition_by}'''.format(
+            epoch_columns=_epoch_columns(db_conn, 'rate', epoch),
+            partition_key=partition_key,
+            partition_by=partition_by
+        )))
 
         cur.execute(db_conn.convert_stmt('''
             CREATE TABLE magnitude (
                 id integer NOT NULL,
                 shower varchar(6) NULL,
                 period_start timestamp NOT NULL,
-                period_end timestamp NOT NULL,
+                period_end timestamp NOT NULL,{epoch_columns}
                 sl_start double precision NOT NULL,
                 sl_end double precision NOT NULL,
                 session_id integer NOT NULL,
                 freq integer NOT NULL,
                 mean double precision NOT NULL,
                 lim_mag real NULL,
-                CONSTRAINT magnitude_pkey PRIMARY KEY (id),
+                CONSTRAINT magnitude_pkey PRIMARY KEY (id{partition_key}),
                 CONSTRAINT magnitude_session_fk FOREIGN KEY (session_id)
                     REFERENCES obs_session(id) MATCH SIMPLE
                     ON UPDATE CASCADE
                     ON DELETE CASCADE
-            )'''))
-        cur.execute(
-            db_conn.convert_stmt(
-                'CREATE INDEX magnitude_period_shower_key ON rate(period_start, period_end, shower)'
-            )
-        )
+            ){partition_by}'''.format(
+            epoch_columns=_epoch_columns(db_conn, 'magnitude', epoch),
+            partition_key=partition_key,
+            partition_by=partition_by
+        )))
 
         cur.execute(db_conn.convert_stmt('''
             CREATE TABLE magnitude_detail (
-                id integer NOT NULL,
+                id integer NOT NULL,{period_start}
                 magn integer NOT NULL,
                 freq real NOT NULL,
-                CONSTRAINT magnitude_detail_pkey PRIMARY KEY (id, magn),
-                CONSTRAINT magnitude_detail_fk FOREIGN KEY (id)
-                    REFERENCES magnitude(id) MATCH SIMPLE
+                CONSTRAINT magnitude_detail_pkey PRIMARY KEY (id, magn{partition_key}),
+                CONSTRAINT magnitude_detail_fk FOREIGN KEY (id{partition_key})
+                    REFERENCES magnitude(id{partition_key}) MATCH SIMPLE
                     ON UPDATE CASCADE
                     ON DELETE CASCADE
-            )'''))
-        cur.execute(
-            db_conn.convert_stmt(
-                'CREATE INDEX fki_magnitude_detail_fk ON magnitude_detail(id)'
-            )
-        )
+            ){partition_by}'''.format(
+            period_start='\n                period_start timestamp NOT NULL,' if partitioned else '',
+            partition_key=partition_key,
+            partition_by=partition_by
+        )))
 
         cur.execute(db_conn.convert_stmt('''
             CREATE TABLE rate_magnitude (
                 rate_id integer NOT NULL,
                 magn_id integer NOT NULL,
                 "equals" boolean NOT NULL,
-                CONSTRAINT rate_magnitude_pkey PRIMARY KEY (rate_id),
-                CONSTRAINT rate_magnitude_rate_fk FOREIGN KEY (rate_id)
-                    REFERENCES rate (id) MATCH SIMPLE
-                    ON UPDATE CASCADE
-                    ON DELETE CASCADE,
-                CONSTRAINT rate_magnitude_magn_fk FOREIGN KEY (magn_id)
-                    REFERENCES magnitude(id) MATCH SIMPLE
-                    ON UPDATE CASCADE
-                    ON DELETE CASCADE
-            )'''))
-        cur.execute(
-            db_conn.convert_stmt(
-                'CREATE INDEX fki_rate_magnitude_magn_fk ON rate_magnitude(magn_id)'
-            )
-        )
+                CONSTRAINT rate_magnitude_pkey PRIMARY KEY (rate_id){foreign_keys}
+            )'''.format(foreign_keys=rate_magnitude_fks)))
 
         cur.execute(db_conn.convert_stmt('''
             CREATE TABLE shower (
@@ -193,69 +1026,607 @@ def create_tables(db_conn):
                 CONSTRAINT radiant_pkey PRIMARY KEY (shower, "month", "day")
             )'''))
 
+        _create_imported_tables(db_conn, cur, epoch)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    db_conn._epoch_columns = epoch
+    db_conn._partitioned = partitioned
+    create_indexes(db_conn)
+    create_normalize_tables(db_conn)
+
+
+def _create_imported_tables(db_conn, cur, epoch):
+    # the tables of the imported records, see `create_tables` and `clear_imported_tables`
+    cur.execute(db_conn.convert_stmt('''
+        CREATE TABLE imported_session
+        (
+            id integer PRIMARY KEY,
+            observer_id integer NULL,
+            observer_name TEXT NULL,
+            longitude real NOT NULL,
+            latitude real NOT NULL,
+            elevation real NULL,
+            country TEXT NOT NULL,
+            city TEXT NOT NULL
+        )'''))
+
+    cur.execute(db_conn.convert_stmt('''
+        CREATE TABLE imported_rate
+        (
+            id integer NOT NULL,
+            observer_id integer NULL,
+            session_id integer NOT NULL,
+            shower varchar(6) NULL,
+            "start" timestamp NOT NULL,
+            "end" timestamp NOT NULL,{epoch_columns}
+            t_eff real NOT NULL,
+            f real NOT NULL,
+            lm real NOT NULL,
+            method text NOT NULL,
+            ra real,
+            "dec" real,
+            "number" integer NOT NULL,
+            CONSTRAINT imported_rate_pkey PRIMARY KEY (id)
+        )'''.format(epoch_columns=_epoch_columns(db_conn, 'imported_rate', epoch))))
+
+    cur.execute(db_conn.convert_stmt('''
+        CREATE TABLE imported_magnitude
+        (
+            id integer NOT NULL,
+            observer_id integer NULL,
+            session_id integer NOT NULL,
+            shower varchar(6) NULL,
+            "start" timestamp NOT NULL,
+            "end" timestamp NOT NULL,{epoch_columns}
+            magn text NOT NULL,
+            CONSTRAINT imported_magnitude_pkey PRIMARY KEY (id)
+        )'''.format(epoch_columns=_epoch_columns(db_conn, 'imported_magnitude', epoch))))
+
+
+def index_catalog(db_conn):
+    """
+    Return the indexes of the catalog `INDEXES` and, if the database has the generated columns of the
+    option `timestamp_storage = epoch`, of `EPOCH_INDEXES`.
+    """
+    if db_conn.epoch_columns:
+        return INDEXES + EPOCH_INDEXES
+
+    return INDEXES
+
+
+def period_columns(db_conn, table, alias):
+    """
+    Return the select list of the timestamp columns of the period of a table of `EPOCH_COLUMNS`.
+
+    If the database has the generated epoch columns, these are selected with the names of the
+    timestamp columns, so the values are integers instead of timestamps.
+
+    :param db_conn: An open database connection.
+    :param table: Name of the table.
+    :param alias: Alias of the table in the statement.
+    """
+    if db_conn.epoch_columns:
+        return ', '.join('%s.%s AS %s' % (alias, epoch, column) for column, epoch in EPOCH_COLUMNS[table])
+
+    return ', '.join('%s.%s' % (alias, column) for column, epoch in EPOCH_COLUMNS[table])
+
+
+def parse_period(value):
+    """
+    Parse a date or time of a period filter.
+
+    ISO 8601 dates with an optional time, fraction of a second and UTC offset are accepted, e.g.
+    `2020-08-12`, `2020-08-12T21:00` or `2020-08-12 21:00:00.5+02:00`. A date without time stands for
+    midnight. Times with a UTC offset are converted to UTC, the time of the stored periods.
+
+    :rtype: datetime
+    :raises ValueError: If the value is not a valid date.
+    """
+    try:
+        parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value[-1:] in ('Z', 'z') else value)
+    except (TypeError, ValueError):
+        raise ValueError('invalid date %s' % value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def period_filter(column, value, epoch_columns=False):
+    """
+    Return the column and the parameter of a filter on a timestamp column of `EPOCH_COLUMNS`.
+
+    With the generated epoch columns, the epoch column is compared with the seconds since 1970-01-01.
+    Otherwise, the timestamp column is compared with the timestamp in the stored format, so that it
+    can also be compared as text (SQLite).
+
+    :param column: Name of the timestamp column, optionally with the alias of the table.
+    :param value: Date or time, see `parse_period`.
+    :param epoch_columns: True, if the database has the generated epoch columns.
+    :rtype: tuple
+    :raises ValueError: If the value is not a valid date.
+    """
+    parsed = parse_period(value)
+    if not epoch_columns:
+        return column, str(parsed)
+
+    seconds = (parsed - _EPOCH).total_seconds()
+    return column + '_epoch', int(seconds) if seconds.is_integer() else seconds
+
+
+def _epoch_columns(db_conn, table, enabled):
+    # definitions of the generated epoch columns of a table for CREATE TABLE
+    if not enabled:
+        return ''
+
+    definitions = []
+    for column, epoch in EPOCH_COLUMNS[table]:
+        if 'psycopg2' == db_conn.db_module:
+            expression = 'extract(epoch FROM %s)::bigint' % column
+        elif 'pymysql' == db_conn.db_module:
+            expression = "TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', %s)" % column
+        else:
+            expression = "CAST(strftime('%%s', %s) AS integer)" % column
+        definitions.append('%s bigint GENERATED ALWAYS AS (%s) STORED,' % (epoch, expression))
+
+    return '\n' + '\n'.join(' ' * 16 + definition for definition in definitions)
+
+
+def _has_column(db_conn, table, column):
+    if 'sqlite3' == db_conn.db_module:
+        # generated columns are only listed by table_xinfo
+        stmt = 'SELECT count(*) FROM pragma_table_xinfo(%(table)s) WHERE name = %(column)s'
+    else:
+        schema = 'current_schema()' if 'psycopg2' == db_conn.db_module else 'DATABASE()'
+        stmt = '''
+            SELECT count(*) FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %%(table)s AND column_name = %%(column)s
+        ''' % schema
+
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt(stmt), {'table': table, 'column': column})
+        count = cur.fetchone()[0]
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return count > 0
+
+
+def _is_partitioned(db_conn, table):
+    try:
+        cur = db_conn.cursor()
+        cur.execute(
+            db_conn.convert_stmt('''
+                SELECT count(*) FROM pg_partitioned_table AS p
+                INNER JOIN pg_class AS c ON c.oid = p.partrelid
+                WHERE c.relname = %(table)s AND c.relnamespace = current_schema()::regnamespace
+            '''),
+            {'table': table}
+        )
+        count = cur.fetchone()[0]
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return count > 0
+
+
+def existing_partitions(db_conn):
+    """
+    Return the partitions of the tables of `PARTITIONED_TABLES`.
+
+    :return: Dictionary of the partition names and the names of their tables.
+    :rtype: dict
+    """
+    if 'psycopg2' != db_conn.db_module:
+        return {}
+
+    try:
+        cur = db_conn.cursor()
+        cur.execute('''
+            SELECT c.relname, p.relname FROM pg_inherits AS i
+            INNER JOIN pg_class AS c ON c.oid = i.inhrelid
+            INNER JOIN pg_class AS p ON p.oid = i.inhparent
+            WHERE p.relnamespace = current_schema()::regnamespace
+        ''')
+        rows = cur.fetchall()
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return dict((name, table) for name, table in rows if table in PARTITIONED_TABLES)
+
+
+def create_partitions(db_conn, years):
+    """
+    Create the partitions of the tables of `PARTITIONED_TABLES` for years that do not exist.
+
+    :param db_conn: An open database connection.
+    :param years: The years.
+    :return: Names of the created partitions.
+    :rtype: list
+    """
+    existing = existing_partitions(db_conn)
+    created = []
+    try:
+        cur = db_conn.cursor()
+        for year in sorted(set(years)):
+            for table in PARTITIONED_TABLES:
+                name = '%s_y%d' % (table, year)
+                if name in existing:
+                    continue
+                # IF NOT EXISTS, since workers of a distributed normalization may create it meanwhile
+                cur.execute(
+                    "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%d-01-01') TO ('%d-01-01')" %
+                    (name, table, year, year + 1)
+                )
+                created.append(name)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return created
+
+
+def detach_partitions(db_conn, year, drop=False):
+    """
+    Detach the partitions of a year from the tables of `PARTITIONED_TABLES`.
+
+    The relationships between the rates and magnitudes of the year are deleted. The detached
+    partitions are standalone tables that can be archived, or dropped. The foreign keys between the
+    partitioned tables are dropped from the detached partitions, since they would still reference the
+    partitions of the year.
+
+    :param db_conn: An open database connection.
+    :param year: The year.
+    :param drop: If True, the detached partitions are dropped.
+    :return: Names of the detached partitions.
+    :rtype: list
+    """
+    existing = existing_partitions(db_conn)
+    detached = []
+    try:
+        cur = db_conn.cursor()
+        names = dict((table, '%s_y%d' % (table, int(year))) for table in PARTITIONED_TABLES)
+        conditions = []
+        if names['rate'] in existing:
+            conditions.append('rate_id IN (SELECT id FROM %s)' % names['rate'])
+        if names['magnitude'] in existing:
+            conditions.append('magn_id IN (SELECT id FROM %s)' % names['magnitude'])
+        if conditions:
+            cur.execute('DELETE FROM rate_magnitude WHERE %s' % ' OR '.join(conditions))
+        # the referencing partitions first
+        for table in reversed(PARTITIONED_TABLES):
+            name = names[table]
+            if name not in existing:
+                continue
+            cur.execute('ALTER TABLE %s DETACH PARTITION %s' % (table, name))
+            if drop:
+                cur.execute('DROP TABLE %s' % name)
+            else:
+                for fk_name, fk_table, column, ref_table, ref_column in FOREIGN_KEYS:
+                    if fk_table == table and ref_table in PARTITIONED_TABLES:
+                        cur.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (name, fk_name))
+            detached.append(name)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return detached
+
+
+def existing_indexes(db_conn):
+    """
+    Return the tables of the indexes of the catalog (see `index_catalog`) that exist in the database.
+
+    :return: Dictionary of the index names and the names of their tables.
+    :rtype: dict
+    """
+    if 'psycopg2' == db_conn.db_module:
+        stmt = 'SELECT indexname, tablename FROM pg_indexes WHERE schemaname = current_schema()'
+    elif 'pymysql' == db_conn.db_module:
+        stmt = '''
+            SELECT DISTINCT index_name, table_name FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+        '''
+    else:
+        stmt = "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'"
+
+    names = set(index[0] for index in index_catalog(db_conn))
+    try:
+        cur = db_conn.cursor()
+        cur.execute(stmt)
+        rows = cur.fetchall()
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return dict((name, table) for name, table in rows if name in names)
+
+
+def create_indexes(db_conn, tables=None):
+    """
+    Create the indexes of the catalog (see `index_catalog`) that do not exist.
+
+    An index of the catalog that exists on another table than given in the catalog is dropped
+    and created on the right table.
+
+    :param db_conn: An open database connection.
+    :param tables: Optional names of the tables whose indexes are created.
+    :return: Names of the created indexes.
+    :rtype: list
+    """
+    existing = existing_indexes(db_conn)
+    created = []
+    try:
+        cur = db_conn.cursor()
+        for name, table, columns in index_catalog(db_conn):
+            if tables is not None and table not in tables:
+                continue
+            if existing.get(name) == table:
+                continue
+            if name in existing:
+                cur.execute(_drop_index_stmt(db_conn, name, existing[name]))
+            cur.execute('CREATE INDEX %s ON %s(%s)' % (name, table, ', '.join(columns)))
+            created.append(name)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return created
+
+
+def drop_indexes(db_conn, tables=None, keep=()):
+    """
+    Drop the existing indexes of the catalog (see `index_catalog`).
+
+    :param db_conn: An open database connection.
+    :param tables: Optional names of the tables whose indexes are dropped.
+    :param keep: Names of indexes that are not dropped.
+    :return: Names of the dropped indexes.
+    :rtype: list
+    """
+    dropped = []
+    try:
+        cur = db_conn.cursor()
+        for name, table in existing_indexes(db_conn).items():
+            if tables is not None and table not in tables or name in keep:
+                continue
+            cur.execute(_drop_index_stmt(db_conn, name, table))
+            dropped.append(name)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return dropped
+
+
+def check_foreign_keys(db_conn, tables=None):
+    """
+    Validate the foreign keys of the catalog `FOREIGN_KEYS`.
+
+    :param db_conn: An open database connection.
+    :param tables: Optional names of the tables. Only the foreign keys of these tables, or
+        referencing these tables, are validated.
+    :raises DBException: If a foreign key is violated.
+    """
+    try:
+        cur = db_conn.cursor()
+        for name, table, column, ref_table, ref_column in FOREIGN_KEYS:
+            if tables is not None and table not in tables and ref_table not in tables:
+                continue
+            cur.execute('''
+                SELECT count(*) FROM %s AS t
+                WHERE NOT EXISTS (SELECT 1 FROM %s AS r WHERE r.%s = t.%s)
+            ''' % (table, ref_table, ref_column, column))
+            count = cur.fetchone()[0]
+            if count > 0:
+                raise DBException('%s records of table %s violate the foreign key %s.' % (count, table, name))
+        cur.close()
+    except DBException:
+        raise
+    except Exception as e:
+        raise DBException(str(e))
+
+
+def analyze_tables(db_conn):
+    """
+    Update the statistics of the query planner for the tables of the catalog `INDEXES`.
+    """
+    tables = []
+    for name, table, columns in INDEXES:
+        if table not in tables:
+            tables.append(table)
+
+    try:
+        cur = db_conn.cursor()
+        if 'sqlite3' == db_conn.db_module:
+            cur.execute('ANALYZE')
+        elif 'pymysql' == db_conn.db_module:
+            cur.execute('ANALYZE TABLE %s' % ', '.join(tables))
+            cur.fetchall()
+        else:
+            cur.execute('ANALYZE %s' % ', '.join(tables))
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+
+def clear_imported_tables(db_conn):
+    """
+    Remove all records of the tables of the imported records.
+
+    PostgreSQL and MySQL truncate the tables; on MySQL, this commits the transaction. SQLite has
+    no TRUNCATE, so the tables are dropped and created again with their indexes. Neither writes
+    the deleted records to the journal, and the space of the tables is free at once (with SQLite,
+    in the database file, see `vacuum`).
+    """
+    epoch = 'sqlite3' == db_conn.db_module and db_conn.epoch_columns
+    try:
+        cur = db_conn.cursor()
+        if 'psycopg2' == db_conn.db_module:
+            cur.execute('TRUNCATE imported_magnitude, imported_rate, imported_session')
+        elif 'pymysql' == db_conn.db_module:
+            for table in ('imported_magnitude', 'imported_rate', 'imported_session'):
+                cur.execute('TRUNCATE TABLE %s' % table)
+        else:
+            for table in ('imported_magnitude', 'imported_rate', 'imported_session'):
+                cur.execute('DROP TABLE %s' % table)
+            _create_imported_tables(db_conn, cur, epoch)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    if 'sqlite3' == db_conn.db_module:
+        create_indexes(db_conn, ('imported_session', 'imported_rate', 'imported_magnitude'))
+
+
+def vacuum(db_conn):
+    """
+    Return the free pages of a SQLite database file to the file system.
+
+    The transaction is committed first. A database created by `initdb` uses `auto_vacuum = INCREMENTAL`,
+    so only the free pages at the end of the file are truncated. Other databases are switched to it
+    by a full VACUUM, which rewrites the file once. PostgreSQL and MySQL return the space of truncated
+    tables themselves, so nothing is done.
+
+    :return: True, if the database file has been vacuumed.
+    :rtype: bool
+    """
+    if 'sqlite3' != db_conn.db_module:
+        return False
+
+    try:
+        db_conn.commit()
+        cur = db_conn.cursor()
+        cur.execute('PRAGMA auto_vacuum')
+        if 2 == cur.fetchone()[0]:
+            # the statement frees one page per step, executescript steps it to the end
+            db_conn.conn.executescript('PRAGMA incremental_vacuum')
+        else:
+            cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cur.execute('VACUUM')
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return True
+
+
+def explain(db_conn, stmt, params=None):
+    """
+    Return the query plan of a SELECT statement.
+
+    :param db_conn: An open database connection.
+    :param stmt: The statement. It is converted with `convert_stmt`.
+    :param params: Optional parameters of the statement.
+    :return: Lines of the query plan.
+    :rtype: list
+    """
+    prefix = 'EXPLAIN QUERY PLAN ' if 'sqlite3' == db_conn.db_module else 'EXPLAIN '
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt(prefix + stmt), params or {})
+        rows = cur.fetchall()
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    if 'sqlite3' == db_conn.db_module:
+        return [row[-1] for row in rows]
+    if 'psycopg2' == db_conn.db_module:
+        return [row[0] for row in rows]
+
+    return [' | '.join('' if value is None else str(value) for value in row) for row in rows]
+
+
+def _drop_index_stmt(db_conn, name, table):
+    if 'pymysql' == db_conn.db_module:
+        return 'DROP INDEX %s ON %s' % (name, table)
+
+    return 'DROP INDEX %s' % name
+
+
+def create_normalize_tables(db_conn):
+    """
+    Create the bookkeeping tables of the normalization, if they do not exist.
+
+    These are the work queue of the distributed normalization, the sessions
+    and showers changed by imports since the last normalization, the
+    discarded observations, the checkpoints of a normalization and the
+    estimates of the population index, which are valid until the next
+    normalization.
+    """
+    try:
+        cur = db_conn.cursor()
         cur.execute(db_conn.convert_stmt('''
-            CREATE TABLE imported_session
+            CREATE TABLE IF NOT EXISTS normalize_work
             (
-                id integer PRIMARY KEY,
-                observer_id integer NULL,
-                observer_name TEXT NULL,
-                longitude real NOT NULL,
-                latitude real NOT NULL,
-                elevation real NULL,
-                country TEXT NOT NULL,
-                city TEXT NOT NULL
+                id integer NOT NULL,
+                stage varchar(16) NOT NULL,
+                first_session_id integer NOT NULL,
+                last_session_id integer NOT NULL,
+                status varchar(8) NOT NULL,
+                claim varchar(32) NULL,
+                worker varchar(255) NULL,
+                lease_expires double precision NULL,
+                attempts integer NOT NULL,
+                counter_read integer NULL,
+                counter_write integer NULL,
+                counter_discard integer NULL,
+                CONSTRAINT normalize_work_pkey PRIMARY KEY (id)
             )'''))
-
         cur.execute(db_conn.convert_stmt('''
-            CREATE TABLE imported_rate
+            CREATE TABLE IF NOT EXISTS normalize_dirty
             (
-                id integer NOT NULL,
-                observer_id integer NULL,
                 session_id integer NOT NULL,
-                shower varchar(6) NULL,
-                "start" timestamp NOT NULL,
-                "end" timestamp NOT NULL,
-                t_eff real NOT NULL,
-                f real NOT NULL,
-                lm real NOT NULL,
-                method text NOT NULL,
-                ra real,
-                "dec" real,
-                "number" integer NOT NULL,
-                CONSTRAINT imported_rate_pkey PRIMARY KEY (id)
+                imported_table varchar(32) NOT NULL,
+                replaced integer NOT NULL,
+                CONSTRAINT normalize_dirty_pkey PRIMARY KEY (session_id, imported_table)
             )'''))
         cur.execute(db_conn.convert_stmt('''
-            CREATE INDEX imported_rate_order_key ON
-                imported_rate(
-                    session_id,
-                    shower,
-                    "start",
-                    "end"
-                )
-        '''))
-
+            CREATE TABLE IF NOT EXISTS normalize_dirty_shower
+            (
+                iau_code varchar(6) NOT NULL,
+                CONSTRAINT normalize_dirty_shower_pkey PRIMARY KEY (iau_code)
+            )'''))
         cur.execute(db_conn.convert_stmt('''
-            CREATE TABLE imported_magnitude
+            CREATE TABLE IF NOT EXISTS normalize_discard
             (
-                id integer NOT NULL,
-                observer_id integer NULL,
+                obs_type varchar(16) NOT NULL,
+                obs_id integer NOT NULL,
                 session_id integer NOT NULL,
                 shower varchar(6) NULL,
-                "start" timestamp NOT NULL,
-                "end" timestamp NOT NULL,
-                magn text NOT NULL,
-                CONSTRAINT imported_magnitude_pkey PRIMARY KEY (id)
+                reason_code varchar(32) NOT NULL,
+                detail varchar(255) NULL,
+                CONSTRAINT normalize_discard_pkey PRIMARY KEY (obs_type, session_id, obs_id)
             )'''))
         cur.execute(db_conn.convert_stmt('''
-            CREATE INDEX imported_magnitude_order_key ON
-                imported_magnitude(
-                    session_id,
-                    shower,
-                    "start",
-                    "end"
-                )
-        '''))
-
+            CREATE TABLE IF NOT EXISTS normalize_progress
+            (
+                stage varchar(16) NOT NULL,
+                last_session_id integer NULL,
+                done integer NOT NULL,
+                CONSTRAINT normalize_progress_pkey PRIMARY KEY (stage)
+            )'''))
+        cur.execute(db_conn.convert_stmt('''
+            CREATE TABLE IF NOT EXISTS r_estimate
+            (
+                cache_key varchar(255) NOT NULL,
+                sl_start double precision NOT NULL,
+                sl_end double precision NOT NULL,
+                sl double precision NOT NULL,
+                count integer NOT NULL,
+                freq double precision NOT NULL,
+                r double precision NULL,
+                r_lower double precision NULL,
+                r_upper double precision NULL,
+                CONSTRAINT r_estimate_pkey PRIMARY KEY (cache_key, sl_start)
+            )'''))
         cur.close()
     except Exception as e:
         raise DBException(str(e))
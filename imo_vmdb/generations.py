@@ -0,0 +1,386 @@
+import os
+import re
+from contextlib import contextmanager
+from imo_vmdb.db import create_partitions, create_tables, DBAdapter, DBException, generation_file, \
+    GENERATION_SUFFIX
+
+# tables in the order of their foreign keys, copied into a shadow schema of PostgreSQL
+_TABLES = (
+    'shower',
+    'radiant',
+    'obs_session',
+    'rate',
+    'magnitude',
+    'magnitude_detail',
+    'rate_magnitude',
+    'imported_session',
+    'imported_rate',
+    'imported_magnitude',
+    'normalize_work',
+    'normalize_dirty',
+    'normalize_dirty_shower',
+    'normalize_discard',
+    'normalize_progress',
+    'r_estimate',
+)
+
+
+class Generations(object):
+    """
+    Blue/green generations of a database.
+
+    A normalization in the `shadow` of the database writes into a copy of the current generation.
+    When it has completed, the copy replaces the current generation in one atomic step, so readers
+    such as the web server neither wait for the normalization nor see half-written results, and a
+    failed normalization leaves the current generation untouched. The replaced generations are
+    retained for a `rollback`, up to `keep` generations including the current one.
+
+    With SQLite, each generation is a file: the file of the configuration, then `<name>.gen1<ext>`,
+    `<name>.gen2<ext>` and so on. The file `<database>.generation` names the current generation, and
+    connections open this file (see `imo_vmdb.db.generation_file`). With PostgreSQL, the shadow is the
+    schema `<schema>_shadow`. It is renamed to the schema of the connection, the replaced schema is
+    renamed to `<schema>_gen<N>`.
+
+    Imports must not run during a normalization in the shadow, since their records would only be
+    written to the replaced generation. With SQLite, such modifications are detected and the shadow
+    is discarded.
+
+    :param config: Connect settings of the section `database`.
+    :param keep: Number of retained generations, including the current one.
+    """
+
+    def __init__(self, config, keep=3):
+        self._config = dict(config)
+        self._db_module = self._config.get('module', 'sqlite3')
+        if self._db_module not in ('sqlite3', 'psycopg2'):
+            raise DBException('Generations are only supported by SQLite and PostgreSQL.')
+        if keep < 1:
+            raise DBException('At least the current generation must be kept.')
+        self._keep = keep
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create the generations of the section `database` with the option `keep` of the section `generations`.
+        """
+        return cls(config['database'], config.getint('generations', 'keep', fallback=3))
+
+    def list(self):
+        """
+        :return: Names of the generations, the oldest first, and the name of the current generation.
+        :rtype: tuple
+        """
+        if 'sqlite3' == self._db_module:
+            path = self._config['database']
+            names = [os.path.basename(self._sqlite_file(number)) for number in self._sqlite_numbers()]
+            return names, os.path.basename(generation_file(path))
+
+        db_conn = DBAdapter(dict(self._config))
+        try:
+            schema = _current_schema(db_conn)
+            names = ['%s_gen%d' % (schema, number) for number in _schema_numbers(db_conn, schema)]
+        finally:
+            db_conn.close()
+
+        return names + [schema], schema
+
+    @contextmanager
+    def shadow(self):
+        """
+        Copy the current generation and provide a connection to the copy.
+
+        If the block completes, the copy is committed and becomes the current generation, and the
+        generations exceeding `keep` are removed. Otherwise, the copy is removed.
+
+        :return: The connection to the copy.
+        :rtype: DBAdapter
+        :raises DBException: If the database has been modified meanwhile (SQLite).
+        """
+        if 'sqlite3' == self._db_module:
+            with self._sqlite_shadow() as db_conn:
+                yield db_conn
+        else:
+            with self._schema_shadow() as db_conn:
+                yield db_conn
+
+    def rollback(self):
+        """
+        Make the newest of the previous generations the current generation and remove the current one.
+
+        :return: The name of the restored generation.
+        :rtype: str
+        :raises DBException: If there is no previous generation.
+        """
+        if 'sqlite3' == self._db_module:
+            return self._sqlite_rollback()
+
+        return self._schema_rollback()
+
+    # SQLite
+
+    def _sqlite_file(self, number):
+        path = self._config['database']
+        if 0 == number:
+            return path
+        root, ext = os.path.splitext(path)
+        return '%s.gen%d%s' % (root, number, ext)
+
+    def _sqlite_numbers(self):
+        # numbers of the existing generation files, generation 0 is the file of the configuration
+        path = self._config['database']
+        root, ext = os.path.splitext(os.path.basename(path))
+        pattern = re.compile(r'^%s\.gen(\d+)%s$' % (re.escape(root), re.escape(ext)))
+        numbers = [0] if os.path.exists(path) else []
+        for name in os.listdir(os.path.dirname(os.path.abspath(path))):
+            match = pattern.match(name)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+
+        return sorted(numbers)
+
+    def _sqlite_current(self):
+        current = os.path.basename(generation_file(self._config['database']))
+        for number in self._sqlite_numbers():
+            if os.path.basename(self._sqlite_file(number)) == current:
+                return number
+
+        raise DBException('The current generation %s does not exist.' % current)
+
+    @contextmanager
+    def _sqlite_shadow(self):
+        numbers = self._sqlite_numbers()
+        shadow = self._sqlite_file(numbers[-1] + 1 if numbers else 1)
+        _remove_sqlite_file(shadow)
+        db_conn = DBAdapter(dict(self._config, database=shadow))
+        source = None
+        try:
+            # the source stays open, its data version changes with the commits of other connections
+            source = DBAdapter(dict(self._config))
+            _execute(source, 'BEGIN', 'SELECT count(*) FROM sqlite_master')
+            data_version = _sqlite_data_version(source)
+            source.conn.backup(db_conn.conn)
+            source.rollback()
+            yield db_conn
+            db_conn.commit()
+            db_conn.close()
+            # the write lock is held until the pointer has been replaced, so no import commits in between
+            _execute(source, 'BEGIN IMMEDIATE')
+            if _sqlite_data_version(source) != data_version:
+                raise DBException(
+                    'The database has been modified during the normalization, the shadow has been discarded.'
+                )
+            self._sqlite_publish(shadow)
+        except BaseException:
+            db_conn.close()
+            _remove_sqlite_file(shadow)
+            raise
+        finally:
+            if source is not None:
+                source.rollback()
+                source.close()
+
+        self._sqlite_prune()
+
+    def _sqlite_publish(self, name):
+        # the pointer file is replaced atomically
+        pointer = self._config['database'] + GENERATION_SUFFIX
+        try:
+            if os.path.basename(name) == os.path.basename(self._config['database']):
+                os.remove(pointer)
+                return
+            with open(pointer + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(os.path.basename(name))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(pointer + '.tmp', pointer)
+        except OSError as e:
+            raise DBException(str(e))
+
+    def _sqlite_prune(self):
+        current = self._sqlite_current()
+        older = [number for number in self._sqlite_numbers() if number < current]
+        retained = set(older[max(0, len(older) - self._keep + 1):] + [current])
+        for number in self._sqlite_numbers():
+            if number not in retained:
+                _remove_sqlite_file(self._sqlite_file(number), ignore_errors=True)
+
+    def _sqlite_rollback(self):
+        current = self._sqlite_current()
+        older = [number for number in self._sqlite_numbers() if number < current]
+        if not older:
+            raise DBException('There is no previous generation.')
+
+        previous = self._sqlite_file(older[-1])
+        self._sqlite_publish(previous)
+        # readers of the removed file keep it open until they return their connections (POSIX)
+        _remove_sqlite_file(self._sqlite_file(current), ignore_errors=True)
+        return os.path.basename(previous)
+
+    # PostgreSQL
+
+    @contextmanager
+    def _schema_shadow(self):
+        source = DBAdapter(dict(self._config))
+        try:
+            schema = _current_schema(source)
+            shadow = schema + '_shadow'
+            _execute(source, 'DROP SCHEMA IF EXISTS %s CASCADE' % shadow, 'CREATE SCHEMA %s' % shadow)
+            source.commit()
+            db_conn = DBAdapter(dict(self._config))
+            try:
+                _execute(db_conn, 'SET search_path TO %s' % shadow)
+                create_tables(db_conn)
+                _copy_tables(source, schema, db_conn, shadow)
+                db_conn.commit()
+                yield db_conn
+                db_conn.commit()
+            except BaseException:
+                db_conn.rollback()
+                db_conn.close()
+                _execute(source, 'DROP SCHEMA IF EXISTS %s CASCADE' % shadow)
+                source.commit()
+                raise
+            db_conn.close()
+
+            numbers = _schema_numbers(source, schema)
+            # both renames become visible with the commit
+            _execute(
+                source,
+                'ALTER SCHEMA %s RENAME TO %s_gen%d' % (schema, schema, numbers[-1] + 1 if numbers else 1),
+                'ALTER SCHEMA %s RENAME TO %s' % (shadow, schema)
+            )
+            source.commit()
+            numbers = _schema_numbers(source, schema)
+            for number in numbers[:max(0, len(numbers) - self._keep + 1)]:
+                _execute(source, 'DROP SCHEMA %s_gen%d CASCADE' % (schema, number))
+            source.commit()
+        finally:
+            source.close()
+
+    def _schema_rollback(self):
+        db_conn = DBAdapter(dict(self._config))
+        try:
+            schema = _current_schema(db_conn)
+            numbers = _schema_numbers(db_conn, schema)
+            if not numbers:
+                raise DBException('There is no previous generation.')
+            previous = '%s_gen%d' % (schema, numbers[-1])
+            _execute(
+                db_conn,
+                'DROP SCHEMA IF EXISTS %s_rollback CASCADE' % schema,
+                'ALTER SCHEMA %s RENAME TO %s_rollback' % (schema, schema),
+                'ALTER SCHEMA %s RENAME TO %s' % (previous, schema)
+            )
+            db_conn.commit()
+            # the readers of the removed schema are not blocked by the renames, but by the DROP
+            _execute(db_conn, 'DROP SCHEMA %s_rollback CASCADE' % schema)
+            db_conn.commit()
+        finally:
+            db_conn.close()
+
+        return previous
+
+
+def _remove_sqlite_file(path, ignore_errors=False):
+    for name in (path, path + '-wal', path + '-shm', path + '-journal'):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if not ignore_errors:
+                raise DBException(str(e))
+
+
+def _sqlite_data_version(db_conn):
+    # changes with each commit of another connection, but not with a checkpoint of the write-ahead log
+    try:
+        cur = db_conn.cursor()
+        cur.execute('PRAGMA data_version')
+        data_version = cur.fetchone()[0]
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return data_version
+
+
+def _execute(db_conn, *stmts):
+    try:
+        cur = db_conn.cursor()
+        for stmt in stmts:
+            cur.execute(stmt)
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+
+def _current_schema(db_conn):
+    try:
+        cur = db_conn.cursor()
+        cur.execute('SELECT current_schema()')
+        schema = cur.fetchone()[0]
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return schema
+
+
+def _schema_numbers(db_conn, schema):
+    # numbers of the schemas of the previous generations
+    pattern = re.compile(r'^%s_gen(\d+)$' % re.escape(schema))
+    try:
+        cur = db_conn.cursor()
+        cur.execute('SELECT nspname FROM pg_namespace')
+        names = [row[0] for row in cur.fetchall()]
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return sorted(int(match.group(1)) for match in map(pattern.match, names) if match is not None)
+
+
+def _copy_tables(source, schema, db_conn, shadow):
+    if db_conn.partitioned:
+        try:
+            cur = source.cursor()
+            cur.execute(
+                'SELECT DISTINCT CAST(extract(year FROM period_start) AS integer) FROM %s.rate '
+                'UNION SELECT DISTINCT CAST(extract(year FROM period_start) AS integer) FROM %s.magnitude' %
+                (schema, schema)
+            )
+            years = [row[0] for row in cur.fetchall()]
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+        create_partitions(db_conn, years)
+
+    for table in _TABLES:
+        # the generated columns are computed again
+        shadow_columns = _columns(db_conn, shadow, table)
+        columns = [column for column in _columns(source, schema, table) if column in shadow_columns]
+        column_list = ', '.join('"%s"' % column for column in columns)
+        _execute(
+            db_conn,
+            'INSERT INTO %s.%s (%s) SELECT %s FROM %s.%s' % (shadow, table, column_list, column_list, schema, table)
+        )
+
+
+def _columns(db_conn, schema, table):
+    try:
+        cur = db_conn.cursor()
+        cur.execute(
+            '''
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s AND is_generated = 'NEVER'
+                ORDER BY ordinal_position
+            ''',
+            (schema, table)
+        )
+        columns = [row[0] for row in cur.fetchall()]
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return columns
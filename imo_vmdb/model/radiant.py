@@ -1,6 +1,3 @@
-from imo_vmdb.db import DBException
-
-
 class Position(object):
 
     def __init__(self, ra, dec):
@@ -12,6 +9,7 @@ class Drift(object):
 
     def __init__(self, positions):
         self._positions = positions
+        self._interpolated = {}
 
     def get_position(self, time):
         positions = self._positions
@@ -20,6 +18,9 @@ class Drift(object):
             return p['pos']
 
         yday = time.timetuple().tm_yday
+        if yday in self._interpolated:
+            return self._interpolated[yday]
+
         left = {'yday': -1, 'invalid': None}
         right = {'yday': 400, 'invalid': None}
 
@@ -47,21 +48,22 @@ class Drift(object):
         if yday == right_yday:
             return right_pos
 
-        if right_pos.ra < left_pos.ra:
-            right_pos.ra += 360.0
+        # The interpolated positions are kept apart from the given positions
+        # and the given positions are not modified. The result therefore does
+        # not depend on the order of the requests.
+        right_ra = right_pos.ra
+        if right_ra < left_pos.ra:
+            right_ra += 360.0
 
         f = float(yday - left_yday) / float(right_yday - left_yday)
-        ra = f * (right_pos.ra - left_pos.ra) + left_pos.ra
+        ra = f * (right_ra - left_pos.ra) + left_pos.ra
         dec = f * (right_pos.dec - left_pos.dec) + left_pos.dec
 
-        if right_pos.ra >= 360.0:
-            right_pos.ra -= 360.0
-
         if ra >= 360.0:
             ra -= 360.0
 
         pos = Position(ra, dec)
-        self._positions.append({'yday': yday, 'pos': pos})
+        self._interpolated[yday] = pos
 
         return pos
 
@@ -87,27 +89,16 @@ class Storage(object):
         ydays = self._get_ydays()
         radiants = {}
 
-        try:
-            cur = self._db_conn.cursor()
-            cur.execute('SELECT * FROM radiant ORDER BY shower, month, day')
-        except Exception as e:
-            raise DBException(str(e))
-
-        column_names = [desc[0] for desc in cur.description]
-        for r in cur:
-            r = dict(zip(column_names, r))
-            iau_code = r['shower']
-            if iau_code not in radiants:
-                radiants[iau_code] = []
-
-            radiants[iau_code].append({
-                'yday': ydays[r['month'] - 1] + r['day'],
-                'pos': Position(r['ra'], r['dec'])
-            })
-
-        try:
-            cur.close()
-        except Exception as e:
-            raise DBException(str(e))
+        for column_names, rows in self._db_conn.stream('SELECT * FROM radiant ORDER BY shower, month, day'):
+            for r in rows:
+                r = dict(zip(column_names, r))
+                iau_code = r['shower']
+                if iau_code not in radiants:
+                    radiants[iau_code] = []
+
+                radiants[iau_code].append({
+                    'yday': ydays[r['month'] - 1] + r['day'],
+                    'pos': Position(r['ra'], r['dec'])
+                })
 
         return dict((rad[0], Drift(rad[1])) for rad in radiants.items())
@@ -1,5 +1,4 @@
 import datetime
-from imo_vmdb.db import DBException
 from imo_vmdb.model.radiant import Position
 
 
@@ -47,22 +46,11 @@ class Storage(object):
         self._db_conn = db_conn
 
     def load(self, radiants):
-        try:
-            cur = self._db_conn.cursor()
-            cur.execute('SELECT * FROM shower')
-        except Exception as e:
-            raise DBException(str(e))
-
-        column_names = [desc[0] for desc in cur.description]
         showers = {}
-        for record in cur:
-            record = dict(zip(column_names, record))
-            iau_code = record['iau_code']
-            showers[iau_code] = Shower(record, radiants[iau_code] if iau_code in radiants else None)
-
-        try:
-            cur.close()
-        except Exception as e:
-            raise DBException(str(e))
+        for column_names, rows in self._db_conn.stream('SELECT * FROM shower'):
+            for record in rows:
+                record = dict(zip(column_names, record))
+                iau_code = record['iau_code']
+                showers[iau_code] = Shower(record, radiants[iau_code] if iau_code in radiants else None)
 
         return showers
@@ -1,4 +1,5 @@
 import math
+from collections import OrderedDict
 from astropy import units as u
 from astropy.coordinates import solar_system_ephemeris, get_body
 from astropy.coordinates import GeocentricMeanEcliptic
@@ -6,7 +7,50 @@ from astropy.time import Time as AstropyTime
 from datetime import datetime, timedelta
 
 
+# The following functions work on plain floats and tuples. They are the
+# allocation free counterparts of Sphere and Cartesian for the hot path of
+# the normalization, e.g. to_spherical(x, y, z) == Sphere(c=Cartesian(x, y, z)).
+
+def to_spherical(x, y, z):
+    r = math.sqrt(math.pow(x, 2) + math.pow(y, 2) + math.pow(z, 2))
+    lat = math.asin(z/r)
+    if 0.0 == x:
+        lng = (1.0 if y > 0.0 else -1) * math.pi/2
+    else:
+        lng = math.atan2(y, x)
+
+    if lng < 0.0:
+        lng += 2 * math.pi
+
+    return lng, lat, r
+
+
+def interpolate(f, c0, c1):
+    return (
+        f * (c1.x - c0.x) + c0.x,
+        f * (c1.y - c0.y) + c0.y,
+        f * (c1.z - c0.z) + c0.z,
+    )
+
+
+def to_horizontal(lng, lat, st, loc):
+    st_diff = st - lng
+    sin_loc_lat = math.sin(loc.lat)
+    cos_loc_lat = math.cos(loc.lat)
+    cos_lat = math.cos(lat)
+    sin_lat = math.sin(lat)
+    cos_st_diff = math.cos(st_diff)
+    x = sin_loc_lat * cos_lat * cos_st_diff - cos_loc_lat * sin_lat
+    y = cos_lat * math.sin(st_diff)
+    z = cos_loc_lat * cos_lat * cos_st_diff + sin_loc_lat * sin_lat
+    az, alt, _ = to_spherical(x, y, z)
+
+    return alt, (az if az > 0.0 else az + 2 * math.pi)
+
+
 class Sphere(object):
+    __slots__ = ('r', 'lng', 'lat')
+
     def __init__(self, lng=None, lat=None, r=1.0, c=None):
         if c is None:
             self.r = r
@@ -14,26 +58,22 @@ class Sphere(object):
             self.lat = lat
             return
 
-        self.r = math.sqrt(math.pow(c.x, 2) + math.pow(c.y, 2) + math.pow(c.z, 2))
-        self.lat = math.asin(c.z/self.r)
-        if 0.0 == c.x:
-            self.lng = (1.0 if c.y > 0.0 else -1) * math.pi/2
-        else:
-            self.lng = math.atan2(c.y, c.x)
-
-        if self.lng < 0.0:
-            self.lng += 2 * math.pi
+        self.lng, self.lat, self.r = to_spherical(c.x, c.y, c.z)
 
     def __str__(self):
         return 'lng=%s, lat=%s' % (self.lng, self.lat)
 
 
 class Location(Sphere):
+    __slots__ = ()
+
     def __init__(self, lng=None, lat=None):
         super().__init__(lng, lat)
 
 
 class Cartesian(object):
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x=None, y=None, z=None, s=None):
         if s is None:
             self.x = x
@@ -49,6 +89,42 @@ class Cartesian(object):
         return 'x=%s, y=%s, z=%s' % (self.x, self.y, self.z)
 
 
+class Memo(object):
+    """
+    A bounded least recently used cache with hit and miss counters.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, fn, *args):
+        data = self._data
+        try:
+            value = data[key]
+        except KeyError:
+            self.misses += 1
+            value = fn(*args)
+            data[key] = value
+            if len(data) > self.size:
+                data.popitem(last=False)
+            return value
+
+        self.hits += 1
+        data.move_to_end(key)
+        return value
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+
 class Ephemeris(object):
 
     def __init__(self, day):
@@ -72,48 +148,84 @@ class Ephemeris(object):
 
 
 class Sky(object):
+    """
+    Positions of the sun and the moon, derived from daily ephemerides.
 
-    def __init__(self):
+    Results that only depend on the time (solar longitude, sun and moon
+    vectors, moon illumination) or on the time and the longitude of the
+    observer (sidereal time) are kept in a bounded memo. A single instance
+    can therefore be shared between the rate and the magnitude normalization,
+    which mostly ask for the same timestamps.
+
+    :param memo_size: maximum number of memoized results.
+    :type memo_size: int
+    """
+
+    def __init__(self, memo_size=100000):
         self._days = {}
+        self.memo = Memo(memo_size)
 
     def sun(self, t, loc=None):
-        e0, e1 = self._get_time_range(t)
-        coord = self._approx(t, e0.day, e1.day, e0.sun, e1.sun)
-        s = Sphere(c=coord)
-        if loc is None:
-            return Sphere(s.lng, s.lat)
+        if loc is not None:
+            return Sphere(*self.sun_alt_az(t, loc)[::-1])
 
-        return self.alt_az(s, t, loc)
+        lng, lat, _ = to_spherical(*self._sun_vector(t))
+        return Sphere(lng, lat)
+
+    def sun_alt_az(self, t, loc, st=None):
+        if st is None:
+            st = self.sidereal_time(t, loc)
+        lng, lat, _ = to_spherical(*self._sun_vector(t))
+        return to_horizontal(lng, lat, st, loc)
 
     def solarlong(self, t):
-        e0, e1 = self._get_time_range(t)
-        sun = Sphere(c=self._approx(t, e0.day, e1.day, e0.sun_ecliptic, e1.sun_ecliptic))
-        return sun.lng if sun.lng > 0.0 else sun.lng + 2*math.pi
+        return self.memo.get(('sl', t), self._solarlong, t)
+
+    def _solarlong(self, t):
+        f, e0, e1 = self._get_factor(t)
+        lng, _, _ = to_spherical(*interpolate(f, e0.sun_ecliptic, e1.sun_ecliptic))
+        return lng if lng > 0.0 else lng + 2*math.pi
 
     def moon(self, t, loc=None):
-        e0, e1 = self._get_time_range(t)
-        coord = self._approx(t, e0.day, e1.day, e0.moon, e1.moon)
-        s = Sphere(c=coord)
-        if loc is None:
-            return Sphere(s.lng, s.lat)
+        if loc is not None:
+            return Sphere(*self.moon_alt_az(t, loc)[::-1])
+
+        lng, lat, _ = to_spherical(*self._moon_vector(t))
+        return Sphere(lng, lat)
 
-        return self.alt_az(s, t, loc)
+    def moon_alt_az(self, t, loc, st=None):
+        if st is None:
+            st = self.sidereal_time(t, loc)
+        lng, lat, _ = to_spherical(*self._moon_vector(t))
+        return to_horizontal(lng, lat, st, loc)
 
     def moon_illumination(self, t):
-        e0, e1 = self._get_time_range(t)
-        sun = Sphere(c=self._approx(t, e0.day, e1.day, e0.sun, e1.sun))
-        sun.r *= 149597870.7  # AE in km
-        moon = Sphere(c=self._approx(t, e0.day, e1.day, e0.moon, e1.moon))
+        return self.memo.get(('illum', t), self._moon_illumination, t)
+
+    def _moon_illumination(self, t):
+        sun_lng, sun_lat, sun_r = to_spherical(*self._sun_vector(t))
+        sun_r *= 149597870.7  # AE in km
+        moon_lng, moon_lat, moon_r = to_spherical(*self._moon_vector(t))
         elongation = math.acos(
-            math.sin(sun.lat) * math.sin(moon.lat) +
-            math.cos(sun.lat) * math.cos(moon.lat) * math.cos(sun.lng - moon.lng)
+            math.sin(sun_lat) * math.sin(moon_lat) +
+            math.cos(sun_lat) * math.cos(moon_lat) * math.cos(sun_lng - moon_lng)
         )
         moon_phase_angle = math.atan2(
-            sun.r * math.sin(elongation),
-            moon.r - sun.r * math.cos(elongation)
+            sun_r * math.sin(elongation),
+            moon_r - sun_r * math.cos(elongation)
         )
         return (1 + math.cos(moon_phase_angle)) / 2.0
 
+    def _sun_vector(self, t):
+        return self.memo.get(('sun', t), self._interpolate, t, 'sun')
+
+    def _moon_vector(self, t):
+        return self.memo.get(('moon', t), self._interpolate, t, 'moon')
+
+    def _interpolate(self, t, body):
+        f, e0, e1 = self._get_factor(t)
+        return interpolate(f, getattr(e0, body), getattr(e1, body))
+
     def _get_time_range(self, t):
         t0 = datetime(t.year, t.month, t.day, 0, 0, 0)
         t1 = t0 + timedelta(days=1)
@@ -124,27 +236,23 @@ class Sky(object):
 
         return self._days[t0], self._days[t1]
 
-    @staticmethod
-    def _approx(t, t0, t1, s0, s1):
-        f = ((t - t0) / (t1 - t0))
-        return Cartesian(
-            x=f * (s1.x - s0.x) + s0.x,
-            y=f * (s1.y - s0.y) + s0.y,
-            z=f * (s1.z - s0.z) + s0.z,
-        )
+    def _get_factor(self, t):
+        e0, e1 = self._get_time_range(t)
+        return (t - e0.day) / (e1.day - e0.day), e0, e1
+
+    def sidereal_time(self, t, loc):
+        return self.memo.get(('st', t, loc.lng), self._sidereal_time, t, loc.lng)
 
     @staticmethod
-    def sidereal_time(t, loc):
+    def _sidereal_time(t, lng):
         at = AstropyTime(t, format='datetime', scale='utc')
-        return at.sidereal_time('mean', longitude=loc.lng * u.rad).rad
-
-    @classmethod
-    def alt_az(cls, s, t, loc):
-        st = cls.sidereal_time(t, loc)
-        st_diff = st - s.lng
-        x = math.sin(loc.lat) * math.cos(s.lat) * math.cos(st_diff) - math.cos(loc.lat) * math.sin(s.lat)
-        y = math.cos(s.lat) * math.sin(st_diff)
-        z = math.cos(loc.lat) * math.cos(s.lat) * math.cos(st_diff) + math.sin(loc.lat) * math.sin(s.lat)
-        c = Cartesian(x, y, z)
-        s = Sphere(c=c)
-        return Sphere(s.lng, s.lat)
+        return at.sidereal_time('mean', longitude=lng * u.rad).rad
+
+    def equatorial_alt_az(self, lng, lat, t, loc, st=None):
+        if st is None:
+            st = self.sidereal_time(t, loc)
+        return to_horizontal(lng if lng > 0.0 else lng + 2 * math.pi, lat, st, loc)
+
+    def alt_az(self, s, t, loc):
+        alt, az = to_horizontal(s.lng, s.lat, self.sidereal_time(t, loc), loc)
+        return Sphere(az, alt)
@@ -1,11 +1,74 @@
-from astropy import units as u
-from astropy.coordinates import EarthLocation
-from datetime import datetime
-from imo_vmdb.db import DBException
+import logging
+import math
+import queue
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from imo_vmdb.db import create_partitions, DBException, period_columns
+from imo_vmdb.model.sky import Location
+
+_EPOCH = datetime(1970, 1, 1)
+
+DISCARD_REASONS = {
+    'observer_id': 'observer ID differs from session observer ID',
+    'contained': 'time period contained by observation %s',
+    'overlap': 'time period overlaps observation %s',
+    'field_below_horizon': 'field is below horizon (%s degrees)',
+    'sun_above_horizon': 'sun is above horizon (%s degrees)',
+    'radiant_below_horizon': 'radiant is too far below the horizon (%s degrees)',
+}
+
+
+def discard_message(reason, detail=None):
+    """
+    :return: The description of a discard reason code.
+    :rtype: str
+    """
+    message = DISCARD_REASONS.get(reason, reason)
+    if '%s' in message:
+        message = message % detail
+
+    return message
+
+
+def discard_counts(db_conn, obs_type=None):
+    """
+    Count the discarded observations of the last normalizations per reason code.
+
+    :param obs_type: Optional type of the observations, `rate` or `magnitude`.
+    :return: Dictionary of the reason codes with the number of discarded observations.
+    :rtype: dict
+    """
+    where = ''
+    if obs_type is not None:
+        where = 'WHERE obs_type = %(obs_type)s'
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt(
+            'SELECT reason_code, count(*) FROM normalize_discard %s GROUP BY reason_code ORDER BY reason_code' % where
+        ), {'obs_type': obs_type})
+        counts = dict(cur.fetchall())
+        cur.close()
+    except Exception as e:
+        raise DBException(str(e))
+
+    return counts
 
 
 class NormalizerException(Exception):
-    pass
+    """
+    Raised if an observation is discarded. `reason` is a key of DISCARD_REASONS.
+    """
+
+    def __init__(self, reason, detail=None):
+        super().__init__(reason, detail)
+        self.reason = reason
+        self.detail = detail
+
+    def __str__(self):
+        return discard_message(self.reason, self.detail)
 
 
 class BaseRecord(object):
@@ -16,17 +79,20 @@ class BaseRecord(object):
         self.session_id = record['session_id']
         self.observer_id = record['observer_id']
         self.session_observer_id = record['session_observer_id']
-        self.loc = EarthLocation(lat=record['latitude']*u.deg, lon=record['longitude']*u.deg)
+        self.loc = Location(math.radians(record['longitude']), math.radians(record['latitude']))
 
-        if isinstance(record['start'], datetime):
-            self.start = record['start']
-        else:
-            self.start = datetime.strptime(record['start'], '%Y-%m-%d %H:%M:%S')
+        self.start = self.parse_datetime(record['start'])
+        self.end = self.parse_datetime(record['end'])
 
-        if isinstance(record['end'], datetime):
-            self.end = record['end']
-        else:
-            self.end = datetime.strptime(record['end'], '%Y-%m-%d %H:%M:%S')
+    @staticmethod
+    def parse_datetime(value):
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, int):
+            # seconds since 1970-01-01 of the generated epoch columns
+            return _EPOCH + timedelta(seconds=value)
+
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
 
     def __eq__(self, other):
         return not self != other
@@ -56,110 +122,787 @@ class BaseRecord(object):
         return True
 
 
+class DirtySessions(object):
+    """
+    Restricts a normalization to the sessions changed by imports since the last normalization.
+
+    The imports store the IDs of the changed sessions in the table `normalize_dirty`, per imported
+    table. A session is marked as replaced, if its imported records have been deleted by an import.
+    The codes of showers whose reference data has been changed are stored in the table
+    `normalize_dirty_shower`.
+    """
+
+    # all records of the changed sessions are normalized again
+    partial = False
+
+    def __init__(self, db_conn):
+        self._db_conn = db_conn
+
+    @staticmethod
+    def condition(column='session_id'):
+        return '%s IN (SELECT session_id FROM normalize_dirty)' % column
+
+    @staticmethod
+    def replaced_condition(imported_table, column='session_id'):
+        return (
+            "%s IN (SELECT session_id FROM normalize_dirty WHERE imported_table = '%s' AND replaced = 1)" %
+            (column, imported_table)
+        )
+
+    def record_condition(self):
+        """
+        Condition of the records to be normalized.
+        """
+        return self.condition()
+
+    def stale_condition(self, imported_table):
+        """
+        Condition of the normalized records to be deleted before the normalization.
+        """
+        return self.replaced_condition(imported_table)
+
+    def session_ids(self):
+        return [row[0] for row in self._fetch(
+            'SELECT DISTINCT session_id FROM normalize_dirty ORDER BY session_id'
+        )]
+
+    def iau_codes(self):
+        return [row[0] for row in self._fetch('SELECT iau_code FROM normalize_dirty_shower ORDER BY iau_code')]
+
+    def mark(self, session_ids):
+        """
+        Mark sessions as changed, e.g. because normalized rates have been deleted.
+        """
+        session_ids = sorted(set(session_ids) - set(self.session_ids()))
+        self._execute_many(
+            "INSERT INTO normalize_dirty (session_id, imported_table, replaced) "
+            "VALUES (%(session_id)s, 'imported_rate', 0)",
+            [{'session_id': session_id} for session_id in session_ids]
+        )
+
+    def mark_unnormalized_rates(self):
+        """
+        Mark the sessions of imported rates of changed showers that are not normalized.
+
+        These rates may have been discarded because of their radiant, so their sessions
+        are normalized from the imported records again.
+        """
+        self._execute_many('''
+            INSERT INTO normalize_dirty (session_id, imported_table, replaced)
+            SELECT DISTINCT i.session_id, 'imported_rate', 0
+            FROM imported_rate AS i
+            WHERE
+                i.shower IN (SELECT iau_code FROM normalize_dirty_shower) AND
+                i.id NOT IN (SELECT id FROM rate) AND
+                i.session_id NOT IN (
+                    SELECT session_id FROM normalize_dirty WHERE imported_table = 'imported_rate'
+                )
+        ''')
+
+    def clear(self, session_ids=None, iau_codes=None):
+        """
+        Clear the given sessions and showers, or all of them.
+        """
+        if session_ids is None:
+            self._execute_many('DELETE FROM normalize_dirty')
+        else:
+            self._execute_many(
+                'DELETE FROM normalize_dirty WHERE session_id = %(session_id)s',
+                [{'session_id': session_id} for session_id in session_ids]
+            )
+
+        if iau_codes is None:
+            self._execute_many('DELETE FROM normalize_dirty_shower')
+        else:
+            self._execute_many(
+                'DELETE FROM normalize_dirty_shower WHERE iau_code = %(iau_code)s',
+                [{'iau_code': iau_code} for iau_code in iau_codes]
+            )
+
+    def _fetch(self, stmt):
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(stmt))
+            rows = cur.fetchall()
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+        return rows
+
+    def _execute_many(self, stmt, params=None):
+        if params is not None and not params:
+            return
+
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            if params is None:
+                cur.execute(db_conn.convert_stmt(stmt))
+            else:
+                cur.executemany(db_conn.convert_stmt(stmt), params)
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+
+class Selection(object):
+    """
+    Restricts a normalization to showers, a time period or sessions.
+
+    The sessions are selected by their ID or by any imported or normalized observation of the
+    showers within the time period. All observations of the selected showers of these sessions
+    are normalized again, because overlaps are checked per session and shower. The normalized
+    observations of the selection are deleted first, so observations that are no longer
+    imported are removed. The sessions themselves are updated in place, so the observations
+    of other showers are kept.
+    """
+
+    partial = True
+
+    _iau_code_pattern = re.compile('^[A-Z0-9]{3,6}$')
+
+    def __init__(self, db_conn, showers=None, period_start=None, period_end=None, session_ids=None):
+        """
+        :param showers: Optional list of IAU codes. `SPO` selects sporadic meteors.
+        :param period_start: Optional start of the time period as datetime or string `YYYY-MM-DD[ HH:MM[:SS]]`.
+        :param period_end: Optional end of the time period.
+        :param session_ids: Optional list of session IDs.
+        :raises ValueError: If an argument is invalid.
+        """
+        self._db_conn = db_conn
+        self._showers = None
+        if showers:
+            showers = [iau_code.strip().upper() for iau_code in showers]
+            for iau_code in showers:
+                if not self._iau_code_pattern.match(iau_code):
+                    raise ValueError('%s is not a valid shower code.' % iau_code)
+            self._showers = sorted(set(showers))
+        self._period_start = self._parse_date(period_start)
+        self._period_end = self._parse_date(period_end)
+        self._session_ids = None
+        if session_ids:
+            self._session_ids = sorted(set(int(session_id) for session_id in session_ids))
+        self.session_ids = self._select_sessions()
+
+    def condition(self, column='session_id'):
+        if not self.session_ids:
+            return '1 = 0'
+
+        return '%s IN (%s)' % (column, ', '.join(str(session_id) for session_id in self.session_ids))
+
+    def record_condition(self):
+        condition = self.condition()
+        if self._showers is not None:
+            condition += ' AND ' + self._shower_condition('shower')
+
+        return condition
+
+    def stale_condition(self, imported_table):
+        return self.record_condition()
+
+    def _shower_condition(self, column):
+        conditions = []
+        showers = [iau_code for iau_code in self._showers if 'SPO' != iau_code]
+        if showers:
+            conditions.append('%s IN (%s)' % (column, ', '.join("'%s'" % iau_code for iau_code in showers)))
+        if 'SPO' in self._showers:
+            conditions.append('%s IS NULL' % column)
+
+        return '(%s)' % ' OR '.join(conditions)
+
+    def _select_sessions(self):
+        if self._showers is None and self._period_start is None and self._period_end is None:
+            return self._session_ids
+
+        stmts = []
+        for table, start_column, end_column in (
+            ('imported_rate', '"start"', '"end"'),
+            ('imported_magnitude', '"start"', '"end"'),
+            ('rate', 'period_start', 'period_end'),
+            ('magnitude', 'period_start', 'period_end'),
+        ):
+            conditions = []
+            if self._showers is not None:
+                conditions.append(self._shower_condition('shower'))
+            if self._period_start is not None:
+                conditions.append("%s > '%s'" % (end_column, self._period_start))
+            if self._period_end is not None:
+                conditions.append("%s < '%s'" % (start_column, self._period_end))
+            if self._session_ids is not None:
+                conditions.append('session_id IN (%s)' % ', '.join(str(i) for i in self._session_ids))
+            stmts.append('SELECT session_id FROM %s WHERE %s' % (table, ' AND '.join(conditions)))
+
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(
+                'SELECT DISTINCT session_id FROM (%s) AS s ORDER BY session_id' % ' UNION '.join(stmts)
+            ))
+            session_ids = [row[0] for row in cur.fetchall()]
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+        return session_ids
+
+    @staticmethod
+    def _parse_date(value):
+        if value is None:
+            return None
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+
+        value = value.strip()
+        for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(value, date_format).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                pass
+
+        raise ValueError('%s is not a valid date.' % value)
+
+
+class Chunk(object):
+    """
+    The derived rows and the discards of the observations of a session range.
+    """
+
+    def __init__(self):
+        self.counter_read = 0
+        self.counter_write = 0
+        self.delete_ids = []
+        self.rows = []
+        self.detail_rows = []
+        self.discards = []
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.session_count = 0
+        self.first_session_id = None
+        self.last_session_id = None
+
+
+class BaseProcessor(object):
+    """
+    Turns imported records into derived rows without accessing the database.
+
+    A processor only holds data that can be passed to other processes.
+    The records must be ordered by session, shower, start and end (descending).
+    Overlapping observations are only searched within a session, so each
+    session range can be processed independently.
+    """
+
+    record_cls = None
+
+    def __init__(self, sky):
+        self.sky = sky
+
+    def process(self, column_names, rows):
+        chunk = Chunk()
+        memo = self.sky.memo
+        memo_hits = memo.hits
+        memo_misses = memo.misses
+        prev_record = None
+        for _record in rows:
+            chunk.counter_read += 1
+            record = self.record_cls(dict(zip(column_names, _record)))
+            if record.session_id != chunk.last_session_id:
+                chunk.session_count += 1
+                chunk.last_session_id = record.session_id
+                if chunk.first_session_id is None:
+                    chunk.first_session_id = record.session_id
+
+            if record.observer_id != record.session_observer_id:
+                self._discard(chunk, record, 'observer_id')
+                continue
+
+            chunk.delete_ids.append(record.id)
+
+            if prev_record is None:
+                prev_record = record
+                continue
+
+            if record in prev_record:
+                self._discard(chunk, prev_record, 'contained', record.id)
+                prev_record = record
+                continue
+
+            if prev_record == record:
+                self._discard(chunk, record, 'overlap', prev_record.id)
+                continue
+
+            self._write(chunk, prev_record)
+            prev_record = record
+
+        if prev_record is not None:
+            self._write(chunk, prev_record)
+
+        chunk.memo_hits = memo.hits - memo_hits
+        chunk.memo_misses = memo.misses - memo_misses
+
+        return chunk
+
+    def _write(self, chunk, record):
+        try:
+            self._add(chunk, record)
+        except NormalizerException as err:
+            self._discard(chunk, record, err.reason, err.detail)
+            return
+
+        chunk.counter_write += 1
+
+    def _add(self, chunk, record):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _discard(chunk, record, reason, detail=None):
+        chunk.discards.append((record.session_id, record.id, record.shower, reason, detail))
+
+
+_worker_processor = None
+
+
+def _init_worker(processor):
+    global _worker_processor
+    _worker_processor = processor
+
+
+def _process_in_worker(args):
+    return _worker_processor.process(*args)
+
+
+def _split_sessions(batches, chunk_size):
+    # splits batches of session IDs and record counts, ordered by session, into ranges of about chunk_size records
+    first_id = None
+    session_id = None
+    count = 0
+    for column_names, session_counts in batches:
+        for session_id, session_count in session_counts:
+            if first_id is None:
+                first_id = session_id
+            count += session_count
+            if count >= chunk_size:
+                yield first_id, session_id
+                first_id = None
+                count = 0
+
+    if first_id is not None:
+        yield first_id, session_id
+
+
+def _put(ready, item, stopped):
+    # puts an item into a bounded queue unless the consumer has stopped
+    while not stopped.is_set():
+        try:
+            ready.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
 class BaseNormalizer(object):
+    """
+    Reads the imported records in session ranges, lets the processor derive
+    the normalized rows and writes them.
+
+    The stages overlap: a reader thread reads the next session ranges while
+    the current ones are computed, and a writer thread writes the computed
+    chunks. The stages are connected by bounded queues and the threads take
+    turns on the database connection.
+
+    With more than one process, the session ranges are processed in a process
+    pool. The chunks are written in the order of the session ranges, so the
+    result and the log messages are the same as with a single process.
+    """
+
+    _queue_size = 4
 
-    def __init__(self, db_conn, logger):
+    _table = None
+    _imported_table = None
+    _imported_alias = None
+    _select_stmt = None
+    _delete_stmt = None
+    _insert_stmt = None
+    _insert_detail_stmt = None
+    _insert_discard_stmt = '''
+        INSERT INTO normalize_discard (
+            obs_type,
+            obs_id,
+            session_id,
+            shower,
+            reason_code,
+            detail
+        ) VALUES (
+            %(obs_type)s,
+            %(obs_id)s,
+            %(session_id)s,
+            %(shower)s,
+            %(reason_code)s,
+            %(detail)s
+        )
+    '''
+
+    def __init__(self, db_conn, logger, processor=None, processes=1, chunk_size=1000, session_filter=None,
+                 checkpoints=None):
         self._db_conn = db_conn
+        self._checkpoints = checkpoints
         self._logger = logger
+        self._processor = processor
+        self._processes = processes
+        self._chunk_size = chunk_size
+        self._session_filter = session_filter
+        self._db_lock = threading.Lock()
         self.has_errors = False
         self.counter_read = 0
         self.counter_write = 0
         self.counter_discard = 0
+        self.discard_counts = {}
+        self._partition_years = set()
+
+    def run(self, session_range=None, resume_after=None):
+        """
+        Normalize the imported records.
+
+        :param session_range: Optional tuple of the first and last session ID. If given, only the
+            records of these sessions are normalized, and all previously normalized records of the
+            imported sessions of the range are deleted first, so the range can be normalized again
+            at any time.
+        :param resume_after: Optional session ID. If given, only the records of the sessions after
+            this session are normalized.
+        """
+        chunks = self._read_ahead(self._read_chunks(session_range, resume_after))
+        if self._processes > 1:
+            chunks = self._process_parallel(chunks)
+        else:
+            chunks = (self._processor.process(*c) for c in chunks)
+
+        if session_range is not None:
+            # compute the range before writing, so that the write lock is held as short as possible
+            chunks = list(chunks)
+            self._delete_session_range(*session_range)
+
+        if self._session_filter is not None:
+            with self._db_lock:
+                self._delete_replaced_sessions()
+                self._delete_discards(self._session_filter.record_condition())
+
+        self._write_behind(chunks)
+
+    def _read_ahead(self, chunks):
+        # reads the chunks in a thread, while the previous chunks are computed
+        ready = queue.Queue(self._queue_size)
+        stopped = threading.Event()
+
+        def read():
+            try:
+                while not stopped.is_set():
+                    with self._db_lock:
+                        chunk = next(chunks, None)
+                    _put(ready, (chunk, None), stopped)
+                    if chunk is None:
+                        break
+            except BaseException as e:
+                _put(ready, (None, e), stopped)
+
+        reader = threading.Thread(target=read, name='normalize-reader', daemon=True)
+        reader.start()
+        try:
+            while True:
+                chunk, error = ready.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            stopped.set()
+            reader.join()
+
+    def _write_behind(self, chunks):
+        # writes the chunks in a thread, while the next chunks are computed
+        pending = queue.Queue(self._queue_size)
+        errors = []
+
+        def write():
+            cur = None
+            while True:
+                chunk = pending.get()
+                if chunk is None:
+                    break
+                if errors:
+                    continue
+                try:
+                    with self._db_lock:
+                        if cur is None:
+                            try:
+                                cur = self._db_conn.cursor()
+                            except Exception as e:
+                                raise DBException(str(e))
+                        self._write_chunk(cur, chunk)
+                        if self._checkpoints is not None:
+                            self._checkpoints.save(self._table, chunk.last_session_id, chunk.session_count)
+                except BaseException as e:
+                    errors.append(e)
+
+            if cur is not None:
+                try:
+                    cur.close()
+                except Exception as e:
+                    errors.append(DBException(str(e)))
+
+        writer = threading.Thread(target=write, name='normalize-writer', daemon=True)
+        writer.start()
+        try:
+            for chunk in chunks:
+                if errors:
+                    break
+                pending.put(chunk)
+        finally:
+            pending.put(None)
+            writer.join()
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        if errors:
+            raise errors[0]
+
+    def session_ranges(self, session_range=None, resume_after=None):
+        """
+        Split the sessions of the imported records into ranges of about `chunk_size` records.
+
+        A session is never split, so each range can be normalized independently.
+
+        :param session_range: Optional tuple of the first and last session ID to be split.
+        :param resume_after: Optional session ID. Only the sessions after this session are split.
+        :return: Generator of tuples of the first and last session ID of each range.
+        """
+        db_conn = self._db_conn
+        conditions = []
+        params = {}
+        if session_range is not None:
+            conditions.append('session_id BETWEEN %(first_session_id)s AND %(last_session_id)s')
+            params = {'first_session_id': session_range[0], 'last_session_id': session_range[1]}
+        if resume_after is not None:
+            conditions.append('session_id > %(resume_after)s')
+            params['resume_after'] = resume_after
+        if self._session_filter is not None:
+            conditions.append(self._session_filter.record_condition())
+        stmt = 'SELECT session_id, count(*) FROM %s' % self._imported_table
+        if conditions:
+            stmt += ' WHERE ' + ' AND '.join(conditions)
+        stmt += ' GROUP BY session_id ORDER BY session_id'
+        # the ranges are determined before the first one is read
+        yield from list(_split_sessions(db_conn.stream(stmt, params), self._chunk_size))
+
+    def _delete_session_range(self, first_id, last_id):
+        # only the sessions with imported records, the other sessions of the range are kept
+        db_conn = self._db_conn
+        condition = (
+            'session_id IN (SELECT session_id FROM %s '
+            'WHERE session_id BETWEEN %%(first_session_id)s AND %%(last_session_id)s)' % self._imported_table
+        )
+        params = {'first_session_id': first_id, 'last_session_id': last_id}
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt('DELETE FROM %s WHERE %s' % (self._table, condition)), params)
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+        self._delete_discards(condition, params)
+
+    def _delete_discards(self, condition, params=None):
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(
+                db_conn.convert_stmt('DELETE FROM normalize_discard WHERE obs_type = %%(obs_type)s AND %s' % condition),
+                dict(params or {}, obs_type=self._table)
+            )
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+    def _delete_replaced_sessions(self):
+        # The imported records of replaced sessions have been deleted before the import,
+        # so the normalized records that have not been imported again are removed.
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(
+                'DELETE FROM %s WHERE %s' %
+                (self._table, self._session_filter.stale_condition(self._imported_table))
+            ))
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+    def _read_chunks(self, session_range=None, resume_after=None):
+        db_conn = self._db_conn
+        session_filter = ''
+        if self._session_filter is not None:
+            session_filter = ' AND ' + self._session_filter.record_condition()
+        select_stmt = self._select_stmt.format(
+            session_filter=session_filter,
+            period_columns=period_columns(db_conn, self._imported_table, self._imported_alias)
+        )
+        for first_id, last_id in self.session_ranges(session_range, resume_after):
+            column_names = None
+            rows = []
+            params = {'first_session_id': first_id, 'last_session_id': last_id}
+            for column_names, batch in db_conn.stream(select_stmt, params):
+                rows.extend(batch)
+
+            if rows:
+                yield column_names, rows
+
+    def _process_parallel(self, chunks):
+        processes = self._processes
+        memo = self._processor.sky.memo
+        pending = deque()
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(self._processor,)) as executor:
+            for chunk in chunks:
+                pending.append(executor.submit(_process_in_worker, chunk))
+                if len(pending) < 2 * processes:
+                    continue
+
+                chunk = pending.popleft().result()
+                memo.hits += chunk.memo_hits
+                memo.misses += chunk.memo_misses
+                yield chunk
+
+            while pending:
+                chunk = pending.popleft().result()
+                memo.hits += chunk.memo_hits
+                memo.misses += chunk.memo_misses
+                yield chunk
+
+    def _write_chunk(self, cur, chunk):
+        db_conn = self._db_conn
+        if chunk.rows and db_conn.partitioned:
+            self._create_partitions(chunk.rows)
+        try:
+            if chunk.delete_ids:
+                db_conn.prepare(self._delete_stmt).executemany(
+                    cur,
+                    [{'id': obs_id} for obs_id in chunk.delete_ids]
+                )
+            if chunk.rows:
+                db_conn.prepare(self._insert_stmt).executemany(cur, chunk.rows)
+            if chunk.detail_rows:
+                db_conn.prepare(self._insert_detail_stmt).executemany(cur, chunk.detail_rows)
+        except Exception as e:
+            raise DBException(str(e))
+
+        if chunk.first_session_id is not None:
+            # the discards of the sessions of the chunk are replaced
+            condition = 'session_id BETWEEN %(first_session_id)s AND %(last_session_id)s'
+            if self._session_filter is not None:
+                condition += ' AND ' + self._session_filter.record_condition()
+            self._delete_discards(
+                condition,
+                {'first_session_id': chunk.first_session_id, 'last_session_id': chunk.last_session_id}
+            )
+        self._write_discards(cur, chunk.discards)
+        self.counter_read += chunk.counter_read
+        self.counter_write += chunk.counter_write
+
+    def _create_partitions(self, rows):
+        # the partitions of the years the normalizer has not yet written to
+        years = set(row['period_start'].year for row in rows) - self._partition_years
+        if years:
+            create_partitions(self._db_conn, years)
+            self._partition_years.update(years)
+
+    def _write_discards(self, cur, discards):
+        db_conn = self._db_conn
+        if discards:
+            try:
+                db_conn.prepare(self._insert_discard_stmt).executemany(cur, [{
+                    'obs_type': self._table,
+                    'obs_id': obs_id,
+                    'session_id': session_id,
+                    'shower': shower,
+                    'reason_code': reason,
+                    'detail': None if detail is None else str(detail),
+                } for session_id, obs_id, shower, reason, detail in discards])
+            except Exception as e:
+                raise DBException(str(e))
+
+        for session_id, obs_id, shower, reason, detail in discards:
+            self._log_discard(session_id, obs_id, reason, detail)
 
     def _log_error(self, msg):
         self._logger.error(msg)
         self.has_errors = True
 
-    def _log_discard(self, session_id, obs_id, reason):
-        self._logger.error('session %s: observation %s discarded - %s' % (session_id, obs_id, reason))
+    def _log_discard(self, session_id, obs_id, reason, detail=None):
+        # the discards are stored in the table normalize_discard, the messages are only formatted for debugging
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(
+                'session %s: observation %s discarded - %s' % (session_id, obs_id, discard_message(reason, detail))
+            )
         self.counter_discard += 1
+        self.discard_counts[reason] = self.discard_counts.get(reason, 0) + 1
         self.has_errors = True
 
 
-def create_rate_magn(db_conn):
+def create_rate_magn(db_conn, session_filter=None, chunk_size=1000):
+    """
+    Create the relationships between rates and magnitudes and set the limiting magnitudes.
+
+    A rate is assigned to a magnitude observation of the same session and shower whose time period
+    contains the period of the rate. The assignment is only made if the rate is contained by exactly
+    one magnitude observation and the rates contained by the magnitude observation have at least as
+    many meteors as the magnitude observation. The limiting magnitude of a magnitude observation is
+    the t_eff-weighted mean of the limiting magnitudes of its rates.
+
+    Both tables are read in ranges of sessions of about `chunk_size` rates and the pairs are found
+    by a sweep over the periods of each session and shower, so the rows of a session are only
+    compared with each other.
+    """
+    where = ''
+    range_filter = ''
+    if session_filter is not None:
+        where = 'WHERE ' + session_filter.record_condition()
+        range_filter = ' AND ' + session_filter.record_condition()
+
     try:
         cur = db_conn.cursor()
-        # find magnitude-rate-pairs containing each other
-        cur.execute(db_conn.convert_stmt('''
-            WITH selection AS (
-                SELECT
-                    r.id as rate_id,
-                    m.id as magn_id,
-                    r.period_start as rate_period_start,
-                    r.period_end as rate_period_end,
-                    m.period_start as magn_period_start,
-                    m.period_end as magn_period_end,
-                    r.freq as rate_n,
-                    m.freq as magn_n
-                FROM rate as r
-                INNER JOIN magnitude as m
-                    ON
-                       r.session_id = m.session_id AND
-                       (
-                           r.shower = m.shower OR
-                           (r.shower IS NULL AND m.shower IS NULL)
-                       )
-            ),
-            rate_magnitude_rel AS (
-                SELECT
-                    rate_id,
-                    magn_id,
-                    rate_n,
-                    magn_n,
-                    true as "equals"
-                FROM selection
-                WHERE
-                   rate_period_start = magn_period_start AND
-                   rate_period_end = magn_period_end
-                UNION
-                SELECT
-                    rate_id,
-                    magn_id,
-                    rate_n,
-                    magn_n,
-                    false as "equals"
-                FROM selection
-                WHERE
-                    -- magnitude period contains rate period
-                    rate_period_start BETWEEN magn_period_start AND magn_period_end AND
-                    rate_period_end BETWEEN magn_period_start AND magn_period_end AND
-                    NOT (
-                        -- rate period contains magnitude period
-                        magn_period_start BETWEEN rate_period_start AND rate_period_end AND
-                        magn_period_end BETWEEN rate_period_start AND rate_period_end
-                    )
-            ),
-            aggregates AS (
-                SELECT
-                    rate_id,
-                    magn_id,
-                    sum(rate_n) OVER (PARTITION BY magn_id) as rate_n,
-                    magn_n,
-                    "equals",
-                    count(magn_id) OVER (PARTITION BY rate_id) as magn_id_count
-                FROM rate_magnitude_rel
-            ),
-            unique_rate_ids AS (
-                SELECT
-                    rate_id,
-                    magn_id,
-                    "equals"
-                FROM aggregates
-                WHERE
-                    magn_id_count = 1 AND
-                    rate_n >= magn_n
-            )
-
-            SELECT rate_id, magn_id, "equals" FROM unique_rate_ids
-        '''))
+        if session_filter is None:
+            cur.execute(db_conn.convert_stmt('DELETE FROM rate_magnitude'))
+        else:
+            cur.execute(db_conn.convert_stmt(
+                'DELETE FROM rate_magnitude WHERE rate_id IN (SELECT id FROM rate %s)' % where
+            ))
+            if db_conn.partitioned:
+                # without foreign keys to the partitioned tables, the relationships of deleted records remain
+                cur.execute(db_conn.convert_stmt('''
+                    DELETE FROM rate_magnitude
+                    WHERE
+                        NOT EXISTS (SELECT 1 FROM rate WHERE rate.id = rate_magnitude.rate_id) OR
+                        NOT EXISTS (SELECT 1 FROM magnitude WHERE magnitude.id = rate_magnitude.magn_id)
+                '''))
+        cur.execute(db_conn.convert_stmt('UPDATE magnitude SET lim_mag = NULL %s' % where))
     except Exception as e:
         raise DBException(str(e))
 
-    column_names = [desc[0] for desc in cur.description]
-    delete_stmt = db_conn.convert_stmt(
-        'DELETE FROM rate_magnitude WHERE rate_id = %(rate_id)s'
-    )
-    insert_stmt = db_conn.convert_stmt('''
+    session_ranges = list(_split_sessions(
+        db_conn.stream('SELECT session_id, count(*) FROM rate %s GROUP BY session_id ORDER BY session_id' % where),
+        chunk_size
+    ))
+    rate_stmt = '''
+        SELECT session_id, shower, {period_columns}, id, freq, t_eff, lim_mag
+        FROM rate
+        WHERE session_id BETWEEN %(first_session_id)s AND %(last_session_id)s{range_filter}
+    '''.format(range_filter=range_filter, period_columns=period_columns(db_conn, 'rate', 'rate'))
+    magn_stmt = '''
+        SELECT session_id, shower, {period_columns}, id, freq
+        FROM magnitude
+        WHERE session_id BETWEEN %(first_session_id)s AND %(last_session_id)s{range_filter}
+    '''.format(range_filter=range_filter, period_columns=period_columns(db_conn, 'magnitude', 'magnitude'))
+    insert_stmt = db_conn.prepare('''
         INSERT INTO rate_magnitude (
             rate_id,
             magn_id,
@@ -170,57 +913,100 @@ def create_rate_magn(db_conn):
             %(equals)s
         )
     ''')
+    update_stmt = db_conn.prepare('UPDATE magnitude SET lim_mag = %(lim_mag)s WHERE id = %(magn_id)s')
 
-    try:
-        write_cur = db_conn.cursor()
-    except Exception as e:
-        raise DBException(str(e))
+    for first_id, last_id in session_ranges:
+        params = {'first_session_id': first_id, 'last_session_id': last_id}
+        magnitudes = {}
+        for column_names, rows in db_conn.stream(magn_stmt, params):
+            for row in rows:
+                magnitudes.setdefault(row[0], []).append(row)
+        if not magnitudes:
+            continue
 
-    for record in cur:
-        record = dict(zip(column_names, record))
-        magn_rate = {
-            'rate_id': record['rate_id'],
-            'magn_id': record['magn_id'],
-            'equals': record['equals'],
-        }
-        try:
-            write_cur.execute(delete_stmt, {'rate_id': record['rate_id']})
-            write_cur.execute(insert_stmt, magn_rate)
-        except Exception as e:
-            raise DBException(str(e))
+        rates = {}
+        for column_names, rows in db_conn.stream(rate_stmt, params):
+            for row in rows:
+                rates.setdefault(row[0], []).append(row)
 
-    # set limiting magnitude
-    try:
-        cur.execute(db_conn.convert_stmt('UPDATE magnitude SET lim_mag = NULL'))
-        cur.execute(db_conn.convert_stmt('''
-            WITH limiting_magnitudes AS (
-                SELECT rm.magn_id, sum(r.t_eff*r.lim_mag)/sum(r.t_eff) as lim_mag
-                FROM rate r
-                INNER JOIN rate_magnitude rm ON rm.rate_id = r.id
-                GROUP BY rm.magn_id
-            )
-            SELECT magn_id, round(lim_mag*100)/100.0 as lim_mag
-            FROM limiting_magnitudes
-        '''))
-    except Exception as e:
-        raise DBException(str(e))
+        rate_magn_rows = []
+        lim_mag_rows = []
+        for session_id, session_rates in rates.items():
+            if session_id in magnitudes:
+                _link_session(session_rates, magnitudes[session_id], rate_magn_rows, lim_mag_rows)
 
-    column_names = [desc[0] for desc in cur.description]
-    update_stmt = db_conn.convert_stmt(
-        'UPDATE magnitude SET lim_mag = %(lim_mag)s WHERE id = %(magn_id)s'
-    )
-    for record in cur:
-        record = dict(zip(column_names, record))
         try:
-            write_cur.execute(update_stmt, {
-                'lim_mag': record['lim_mag'],
-                'magn_id': record['magn_id']
-            })
+            if rate_magn_rows:
+                insert_stmt.executemany(cur, rate_magn_rows)
+            if lim_mag_rows:
+                update_stmt.executemany(cur, lim_mag_rows)
         except Exception as e:
             raise DBException(str(e))
 
     try:
-        write_cur.close()
         cur.close()
     except Exception as e:
         raise DBException(str(e))
+
+
+def _link_session(rates, magnitudes, rate_magn_rows, lim_mag_rows):
+    magnitudes_by_shower = {}
+    for magn in magnitudes:
+        magnitudes_by_shower.setdefault(magn[1], []).append(magn)
+    rates_by_shower = {}
+    for rate in rates:
+        rates_by_shower.setdefault(rate[1], []).append(rate)
+
+    for shower, shower_rates in rates_by_shower.items():
+        shower_magnitudes = magnitudes_by_shower.get(shower)
+        if shower_magnitudes is None:
+            continue
+
+        # sweep over the periods: a magnitude observation is active as long as it can contain a rate
+        shower_rates.sort(key=lambda r: r[2])
+        shower_magnitudes.sort(key=lambda m: m[2])
+        pairs = []
+        active = []
+        i = 0
+        for rate in shower_rates:
+            rate_start, rate_end = rate[2], rate[3]
+            while i < len(shower_magnitudes) and shower_magnitudes[i][2] <= rate_start:
+                active.append(shower_magnitudes[i])
+                i += 1
+            active = [m for m in active if m[3] >= rate_start]
+            for magn in active:
+                magn_start, magn_end = magn[2], magn[3]
+                if not magn_start <= rate_end <= magn_end:
+                    continue
+                if rate_start == magn_start and rate_end == magn_end:
+                    pairs.append((rate, magn, True))
+                elif not (rate_start <= magn_start <= rate_end and rate_start <= magn_end <= rate_end):
+                    pairs.append((rate, magn, False))
+
+        magn_counts = {}
+        rate_freqs = {}
+        for rate, magn, equals in pairs:
+            magn_counts[rate[4]] = magn_counts.get(rate[4], 0) + 1
+            rate_freqs[magn[4]] = rate_freqs.get(magn[4], 0) + rate[5]
+
+        lim_mags = {}
+        for rate, magn, equals in pairs:
+            if magn_counts[rate[4]] != 1 or rate_freqs[magn[4]] < magn[5]:
+                continue
+            rate_magn_rows.append({'rate_id': rate[4], 'magn_id': magn[4], 'equals': equals})
+            sums = lim_mags.setdefault(magn[4], [0.0, 0.0])
+            sums[0] += rate[6] * rate[7]
+            sums[1] += rate[6]
+
+        for magn_id, (weighted_sum, t_eff_sum) in lim_mags.items():
+            lim_mag = None
+            if t_eff_sum != 0:
+                lim_mag = _round(weighted_sum / t_eff_sum * 100) / 100.0
+            lim_mag_rows.append({'magn_id': magn_id, 'lim_mag': lim_mag})
+
+
+def _round(value):
+    # rounds half away from zero like round() in SQL
+    if value < 0:
+        return float(math.ceil(value - 0.5))
+    return float(math.floor(value + 0.5))
@@ -1,10 +1,85 @@
 import json
 import math
-from imo_vmdb.db import DBException
-from imo_vmdb.normalizer import BaseRecord, BaseNormalizer
+from imo_vmdb.normalizer import BaseNormalizer, BaseProcessor, BaseRecord
 
 
 class Record(BaseRecord):
+
+    def __init__(self, record):
+        super().__init__(record)
+        self.magn = json.loads(record['magn'])
+
+    def values(self, sky):
+        mid = self.id
+        freq = int(sum(m for m in self.magn.values()))
+        magn_items = self.magn.items()
+        mean = sum(float(m) * float(n) for m, n in magn_items) / freq
+        sl_start = sky.solarlong(self.start)
+        sl_end = sky.solarlong(self.end)
+        iau_code = self.shower
+        magn = {
+            'id': mid,
+            'shower': iau_code,
+            'period_start': self.start,
+            'period_end': self.end,
+            'sl_start': math.degrees(sl_start),
+            'sl_end': math.degrees(sl_end),
+            'session_id': self.session_id,
+            'freq': freq,
+            'mean': mean,
+        }
+        details = [
+            {
+                'id': mid,
+                'period_start': self.start,
+                'magn': int(m),
+                'freq': float(n),
+            } for m, n in magn_items
+        ]
+
+        return magn, details
+
+
+class MagnitudeProcessor(BaseProcessor):
+
+    record_cls = Record
+
+    def _add(self, chunk, record):
+        magn, details = record.values(self.sky)
+        chunk.rows.append(magn)
+        chunk.detail_rows.extend(details)
+
+
+class MagnitudeNormalizer(BaseNormalizer):
+
+    _table = 'magnitude'
+    _imported_table = 'imported_magnitude'
+    _imported_alias = 'm'
+
+    _select_stmt = '''
+        SELECT
+            m.id,
+            s.longitude,
+            s.latitude,
+            s.elevation,
+            s.observer_id AS "session_observer_id",
+            m.shower,
+            m.session_id,
+            m.observer_id,
+            {period_columns},
+            m.magn
+        FROM imported_magnitude as m
+        INNER JOIN obs_session as s ON s.id = m.session_id
+        WHERE m.session_id BETWEEN %(first_session_id)s AND %(last_session_id)s{session_filter}
+        ORDER BY
+            m.session_id ASC,
+            m.shower ASC,
+            m."start" ASC,
+            m."end" DESC
+    '''
+
+    _delete_stmt = 'DELETE FROM magnitude WHERE id = %(id)s'
+
     _insert_stmt = '''
         INSERT INTO magnitude (
             id,
@@ -41,133 +116,25 @@ class Record(BaseRecord):
         )
     '''
 
-    def __init__(self, record):
-        super().__init__(record)
-        self.magn = json.loads(record['magn'])
-
-    @classmethod
-    def init_stmt(cls, db_conn):
-        cls._insert_stmt = db_conn.convert_stmt(cls._insert_stmt)
-        cls._insert_detail_stmt = db_conn.convert_stmt(cls._insert_detail_stmt)
-
-    def write(self, cur, sky):
-        mid = self.id
-        freq = int(sum(m for m in self.magn.values()))
-        magn_items = self.magn.items()
-        mean = sum(float(m) * float(n) for m, n in magn_items) / freq
-        sl_start = sky.solarlong(self.start)
-        sl_end = sky.solarlong(self.end)
-        iau_code = self.shower
-        magn = {
-            'id': mid,
-            'shower': iau_code,
-            'period_start': self.start,
-            'period_end': self.end,
-            'sl_start': math.degrees(sl_start),
-            'sl_end': math.degrees(sl_end),
-            'session_id': self.session_id,
-            'freq': freq,
-            'mean': mean,
-        }
-
-        try:
-            cur.execute(self._insert_stmt, magn)
-        except Exception as e:
-            raise DBException(str(e))
-
-        for m, n in magn_items:
-            magn = {
-                'id': mid,
-                'magn': int(m),
-                'freq': float(n),
-            }
-            try:
-                cur.execute(self._insert_detail_stmt, magn)
-            except Exception as e:
-                raise DBException(str(e))
-
-
-class MagnitudeNormalizer(BaseNormalizer):
+    # with the option partitioning = year, magnitude_detail has the partition key of magnitude
+    _insert_partitioned_detail_stmt = '''
+        INSERT INTO magnitude_detail (
+            id,
+            period_start,
+            magn,
+            freq
+        ) VALUES (
+            %(id)s,
+            %(period_start)s,
+            %(magn)s,
+            %(freq)s
+        )
+    '''
 
-    def __init__(self, db_conn, logger, sky):
-        super().__init__(db_conn, logger)
-        self._sky = sky
-        Record.init_stmt(db_conn)
-
-    def run(self):
-        db_conn = self._db_conn
-        try:
-            cur = db_conn.cursor()
-            cur.execute(db_conn.convert_stmt('''
-                SELECT
-                    m.id,
-                    s.longitude,
-                    s.latitude,
-                    s.elevation,
-                    s.observer_id AS "session_observer_id",
-                    m.shower,
-                    m.session_id,
-                    m.observer_id,
-                    m."start",
-                    m."end",
-                    m.magn
-                FROM imported_magnitude as m
-                INNER JOIN obs_session as s ON s.id = m.session_id
-                ORDER BY
-                    m.session_id ASC,
-                    m.shower ASC,
-                    m."start" ASC,
-                    m."end" DESC
-            '''))
-        except Exception as e:
-            raise DBException(str(e))
-
-        column_names = [desc[0] for desc in cur.description]
-
-        try:
-            write_cur = db_conn.cursor()
-        except Exception as e:
-            raise DBException(str(e))
-
-        prev_record = None
-        delete_stmt = db_conn.convert_stmt('DELETE FROM magnitude WHERE id = %(id)s')
-        for _record in cur:
-            self.counter_read += 1
-
-            record = Record(dict(zip(column_names, _record)))
-            if record.observer_id != record.session_observer_id:
-                self._log_discard(record.session_id, record.id, 'observer ID differs from session observer ID')
-                prev_record = record
-                continue
-
-            try:
-                write_cur.execute(delete_stmt, {'id': record.id})
-            except Exception as e:
-                raise DBException(str(e))
-
-            if prev_record is None:
-                prev_record = record
-                continue
-
-            if record in prev_record:
-                self._log_discard(prev_record.session_id, prev_record.id, 'time period contained by observation %s' % record.id)
-                prev_record = record
-                continue
-
-            if prev_record == record:
-                self._log_discard(record.session_id, record.id, 'time period overlaps observation %s' % prev_record.id)
-                continue
-
-            prev_record.write(write_cur, self._sky)
-            self.counter_write += 1
-            prev_record = record
-
-        if prev_record is not None:
-            prev_record.write(write_cur, self._sky)
-            self.counter_write += 1
-
-        try:
-            cur.close()
-            write_cur.close()
-        except Exception as e:
-            raise DBException(str(e))
+    def __init__(self, db_conn, logger, sky, processes=1, chunk_size=1000, session_filter=None,
+                 checkpoints=None):
+        super().__init__(
+            db_conn, logger, MagnitudeProcessor(sky), processes, chunk_size, session_filter, checkpoints
+        )
+        if db_conn.partitioned:
+            self._insert_detail_stmt = self._insert_partitioned_detail_stmt
@@ -0,0 +1,85 @@
+from imo_vmdb.db import DBException
+
+
+class Checkpoints(object):
+    """
+    Progress of a normalization, stored in the table `normalize_progress`.
+
+    The normalization commits after about every `interval` sessions of a stage and at the end of
+    each stage, together with the last normalized session of the stage. A normalization that has
+    been aborted can then be resumed after the last committed session range.
+    """
+
+    def __init__(self, db_conn, interval=1000):
+        self._db_conn = db_conn
+        self._interval = interval
+        self._session_count = 0
+
+    def load(self):
+        """
+        :return: Dictionary of the stages with a tuple of the last session ID and whether the stage is done.
+        :rtype: dict
+        """
+        rows = self._fetch('SELECT stage, last_session_id, done FROM normalize_progress')
+        return dict((stage, (last_session_id, bool(done))) for stage, last_session_id, done in rows)
+
+    def start(self):
+        """
+        Remove the progress of a previous normalization.
+        """
+        self._execute('DELETE FROM normalize_progress')
+
+    def save(self, stage, last_session_id, session_count):
+        """
+        Commit, if about `interval` sessions have been normalized since the last commit.
+        """
+        self._session_count += session_count
+        if self._session_count < self._interval:
+            return
+
+        self._session_count = 0
+        self._set(stage, last_session_id, 0)
+
+    def done(self, stage):
+        """
+        Mark a stage as done and commit.
+        """
+        self._session_count = 0
+        self._set(stage, None, 1)
+
+    def finish(self):
+        """
+        Remove the progress of the completed normalization and commit.
+        """
+        self._execute('DELETE FROM normalize_progress')
+
+    def _set(self, stage, last_session_id, done):
+        self._execute('DELETE FROM normalize_progress WHERE stage = %(stage)s', {'stage': stage}, commit=False)
+        self._execute(
+            'INSERT INTO normalize_progress (stage, last_session_id, done) VALUES '
+            '(%(stage)s, %(last_session_id)s, %(done)s)',
+            {'stage': stage, 'last_session_id': last_session_id, 'done': done}
+        )
+
+    def _fetch(self, stmt):
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(stmt))
+            rows = cur.fetchall()
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+        return rows
+
+    def _execute(self, stmt, params=None, commit=True):
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(stmt), params or {})
+            cur.close()
+            if commit:
+                db_conn.commit()
+        except Exception as e:
+            raise DBException(str(e))
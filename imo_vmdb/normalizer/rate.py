@@ -1,57 +1,10 @@
 import math
-from imo_vmdb.db import DBException
-from imo_vmdb.model.sky import Location, Sphere
-from imo_vmdb.normalizer import BaseRecord, BaseNormalizer, NormalizerException
+from imo_vmdb.db import DBException, period_columns
+from imo_vmdb.model.sky import Location
+from imo_vmdb.normalizer import BaseNormalizer, BaseProcessor, BaseRecord, NormalizerException
 
 
 class Record(BaseRecord):
-    _insert_stmt = '''
-        INSERT INTO rate (
-            id,
-            shower,
-            period_start,
-            period_end,
-            sl_start,
-            sl_end,
-            session_id,
-            freq,
-            lim_mag,
-            t_eff,
-            f,
-            sidereal_time,
-            sun_alt,
-            sun_az,
-            moon_alt,
-            moon_az,
-            moon_illum,
-            field_alt,
-            field_az,
-            rad_alt,
-            rad_az
-        ) VALUES (
-            %(id)s,
-            %(shower)s,
-            %(period_start)s,
-            %(period_end)s,
-            %(sl_start)s,
-            %(sl_end)s,
-            %(session_id)s,
-            %(freq)s,
-            %(lim_mag)s,
-            %(t_eff)s,
-            %(f)s,
-            %(sidereal_time)s,
-            %(sun_alt)s,
-            %(sun_az)s,
-            %(moon_alt)s,
-            %(moon_az)s,
-            %(moon_illum)s,
-            %(field_alt)s,
-            %(field_az)s,
-            %(rad_alt)s,
-            %(rad_az)s
-        )
-    '''
 
     def __init__(self, record):
         super().__init__(record)
@@ -61,14 +14,6 @@ class Record(BaseRecord):
         self.f = record['f']
         self.ra = record['ra']
         self.dec = record['dec']
-        self.loc = Location(
-            math.radians(record['longitude']),
-            math.radians(record['latitude'])
-        )
-
-    @classmethod
-    def init_stmt(cls, db_conn):
-        cls._insert_stmt = db_conn.convert_stmt(cls._insert_stmt)
 
     @staticmethod
     def _zenith_coor(alt, v):
@@ -78,48 +23,69 @@ class Record(BaseRecord):
         zo = z / 2.0 + math.asin(v * math.sin(z / 2.0) / w)
         return math.pi/2.0 - zo
 
-    def write(self, cur, sky, showers):
+    @classmethod
+    def radiant_alt_az(cls, sky, showers, iau_code, t_mean, loc, st):
+        """
+        Returns the altitude with zenith attraction applied and the azimuth of the radiant in degrees.
+
+        Both values are None if the shower is unknown or not active.
+        Raises NormalizerException if the radiant is too far below the horizon.
+        """
+        shower = showers[iau_code] if iau_code in showers else None
+        radiant = shower.get_radiant(t_mean) if shower is not None else None
+        if radiant is None:
+            return None, None
+
+        rad_alt, rad_az = sky.equatorial_alt_az(
+            math.radians(radiant.ra),
+            math.radians(radiant.dec),
+            t_mean,
+            loc,
+            st
+        )
+        rad_az = math.degrees(rad_az)
+        rad_alt = math.degrees(cls._zenith_coor(rad_alt, shower.v))
+
+        if rad_alt < -5.0:
+            raise NormalizerException('radiant_below_horizon', round(rad_alt))
+
+        return rad_alt, rad_az
+
+    def values(self, sky, showers):
         iau_code = self.shower
         t_abs = self.end - self.start
         t_mean = self.start + t_abs / 2
         sl_start = sky.solarlong(self.start)
         sl_end = sky.solarlong(self.end)
-        shower = showers[iau_code] if iau_code in showers else None
-        radiant = shower.get_radiant(t_mean) if shower is not None else None
 
+        loc = self.loc
+        st = sky.sidereal_time(t_mean, loc)
         field_alt = None
         field_az = None
         if self.ra is not None and self.dec is not None:
-            field = sky.alt_az(
-                Sphere(math.radians(self.ra), math.radians(self.dec)),
+            field_alt, field_az = sky.equatorial_alt_az(
+                math.radians(self.ra),
+                math.radians(self.dec),
                 t_mean,
-                self.loc
+                loc,
+                st
             )
-            field_alt = math.degrees(field.lat)
-            field_az = math.degrees(field.lng)
+            field_alt = math.degrees(field_alt)
+            field_az = math.degrees(field_az)
 
         if field_alt is not None and field_alt < 0.0:
-            raise NormalizerException("field is below horizon (%s degrees)" % round(field_alt))
+            raise NormalizerException('field_below_horizon', round(field_alt))
 
-        sun = sky.sun(t_mean, self.loc)
-        if sun.lat > 0.0:
-            raise NormalizerException("sun is above horizon (%s degrees)" % round(math.degrees(sun.lat)))
+        sun_alt, sun_az = sky.sun_alt_az(t_mean, loc, st)
+        if sun_alt > 0.0:
+            raise NormalizerException('sun_above_horizon', round(math.degrees(sun_alt)))
 
-        moon = sky.moon(t_mean, self.loc)
+        moon_alt, moon_az = sky.moon_alt_az(t_mean, loc, st)
         moon_illumination = sky.moon_illumination(t_mean)
 
-        rad_alt = None
-        rad_az = None
-        if radiant is not None:
-            rad_radec = Sphere(math.radians(radiant.ra), math.radians(radiant.dec))
-            rad_coord = sky.alt_az(rad_radec, t_mean, self.loc)
-            rad_az = math.degrees(rad_coord.lng)
-            rad_alt = math.degrees(self._zenith_coor(rad_coord.lat, shower.v))
+        rad_alt, rad_az = self.radiant_alt_az(sky, showers, iau_code, t_mean, loc, st)
 
-        if rad_alt is not None and rad_alt < -5.0:
-            raise NormalizerException("radiant of %s is too far below the horizon (%s degrees)" % (iau_code, round(rad_alt)))
-
-        rate = {
+        return {
             'id': self.id,
             'shower': iau_code,
             'period_start': self.start,
@@ -131,11 +97,11 @@ class Record(BaseRecord):
             'lim_mag': self.lm,
             't_eff': self.t_eff,
             'f': self.f,
-            'sidereal_time': math.degrees(sky.sidereal_time(t_mean, self.loc)),
-            'sun_alt': math.degrees(sun.lat),
-            'sun_az': math.degrees(sun.lng),
-            'moon_alt': math.degrees(moon.lat),
-            'moon_az': math.degrees(moon.lng),
+            'sidereal_time': math.degrees(st),
+            'sun_alt': math.degrees(sun_alt),
+            'sun_az': math.degrees(sun_az),
+            'moon_alt': math.degrees(moon_alt),
+            'moon_az': math.degrees(moon_az),
             'moon_illum': moon_illumination,
             'field_alt': field_alt,
             'field_az': field_az,
@@ -143,108 +109,195 @@ class Record(BaseRecord):
             'rad_az': rad_az
         }
 
-        try:
-            cur.execute(self._insert_stmt, rate)
-        except Exception as e:
-            raise DBException(str(e))
+
+class RateProcessor(BaseProcessor):
+
+    record_cls = Record
+
+    def __init__(self, sky, showers):
+        super().__init__(sky)
+        self._showers = showers
+
+    def _add(self, chunk, record):
+        chunk.rows.append(record.values(self.sky, self._showers))
 
 
 class RateNormalizer(BaseNormalizer):
 
-    def __init__(self, db_conn, logger, sky, showers):
-        super().__init__(db_conn, logger)
+    _table = 'rate'
+    _imported_table = 'imported_rate'
+    _imported_alias = 'r'
+
+    _select_stmt = '''
+        SELECT
+            r.id,
+            s.longitude,
+            s.latitude,
+            s.elevation,
+            s.observer_id AS "session_observer_id",
+            r.shower,
+            r.session_id,
+            r.observer_id,
+            {period_columns},
+            r.t_eff,
+            r.f,
+            r.lm,
+            r.ra,
+            r.dec,
+            r."number" AS freq
+        FROM imported_rate as r
+        INNER JOIN obs_session as s ON s.id = r.session_id
+        WHERE r.session_id BETWEEN %(first_session_id)s AND %(last_session_id)s{session_filter}
+        ORDER BY
+            r.session_id ASC,
+            r.shower ASC,
+            r."start" ASC,
+            r."end" DESC
+    '''
+
+    _delete_stmt = 'DELETE FROM rate WHERE id = %(id)s'
+
+    _insert_stmt = '''
+        INSERT INTO rate (
+            id,
+            shower,
+            period_start,
+            period_end,
+            sl_start,
+            sl_end,
+            session_id,
+            freq,
+            lim_mag,
+            t_eff,
+            f,
+            sidereal_time,
+            sun_alt,
+            sun_az,
+            moon_alt,
+            moon_az,
+            moon_illum,
+            field_alt,
+            field_az,
+            rad_alt,
+            rad_az
+        ) VALUES (
+            %(id)s,
+            %(shower)s,
+            %(period_start)s,
+            %(period_end)s,
+            %(sl_start)s,
+            %(sl_end)s,
+            %(session_id)s,
+            %(freq)s,
+            %(lim_mag)s,
+            %(t_eff)s,
+            %(f)s,
+            %(sidereal_time)s,
+            %(sun_alt)s,
+            %(sun_az)s,
+            %(moon_alt)s,
+            %(moon_az)s,
+            %(moon_illum)s,
+            %(field_alt)s,
+            %(field_az)s,
+            %(rad_alt)s,
+            %(rad_az)s
+        )
+    '''
+
+    def __init__(self, db_conn, logger, sky, showers, processes=1, chunk_size=1000, session_filter=None,
+                 checkpoints=None):
+        super().__init__(
+            db_conn, logger, RateProcessor(sky, showers), processes, chunk_size, session_filter, checkpoints
+        )
+
+
+class RadiantNormalizer(BaseNormalizer):
+    """
+    Updates the radiants of normalized rates of showers whose reference data has been changed.
+
+    Only the columns `rad_alt` and `rad_az` are updated. Rates whose radiant is now too far
+    below the horizon are deleted and logged as discarded; their sessions are collected in
+    `session_ids`. Rates of the sessions selected by the session filter are skipped, because
+    these sessions are normalized from their imported records.
+    """
+
+    _table = 'rate'
+
+    _select_stmt = '''
+        SELECT
+            r.id,
+            r.session_id,
+            r.shower,
+            {period_columns},
+            s.longitude,
+            s.latitude
+        FROM rate AS r
+        INNER JOIN obs_session AS s ON s.id = r.session_id
+        WHERE r.shower IN (SELECT iau_code FROM normalize_dirty_shower){session_filter}
+        ORDER BY r.id
+    '''
+
+    _update_stmt = 'UPDATE rate SET rad_alt = %(rad_alt)s, rad_az = %(rad_az)s WHERE id = %(id)s'
+
+    _delete_stmt = 'DELETE FROM rate WHERE id = %(id)s'
+
+    def __init__(self, db_conn, logger, sky, showers, session_filter=None):
+        super().__init__(db_conn, logger, session_filter=session_filter)
         self._sky = sky
         self._showers = showers
-        Record.init_stmt(db_conn)
+        self.session_ids = set()
 
     def run(self):
         db_conn = self._db_conn
-        try:
-            cur = db_conn.cursor()
-            cur.execute(db_conn.convert_stmt('''
-                SELECT
-                    r.id,
-                    s.longitude,
-                    s.latitude,
-                    s.elevation,
-                    s.observer_id AS "session_observer_id",
-                    r.shower,
-                    r.session_id,
-                    r.observer_id,
-                    r."start",
-                    r."end",
-                    r.t_eff,
-                    r.f,
-                    r.lm,
-                    r.ra,
-                    r.dec,
-                    r."number" AS freq
-                FROM imported_rate as r
-                INNER JOIN obs_session as s ON s.id = r.session_id
-                ORDER BY
-                    r.session_id ASC,
-                    r.shower ASC,
-                    r."start" ASC,
-                    r."end" DESC
-            '''))
-        except Exception as e:
-            raise DBException(str(e))
+        session_filter = ''
+        if self._session_filter is not None:
+            session_filter = ' AND NOT ' + self._session_filter.condition('r.session_id')
 
-        column_names = [desc[0] for desc in cur.description]
+        updates = []
+        discards = []
+        select_stmt = self._select_stmt.format(
+            session_filter=session_filter,
+            period_columns=period_columns(db_conn, 'rate', 'r')
+        )
+        for column_names, rows in db_conn.stream(select_stmt):
+            for row in rows:
+                self._update(dict(zip(column_names, row)), updates, discards)
 
         try:
-            write_cur = db_conn.cursor()
+            cur = db_conn.cursor()
+            if updates:
+                db_conn.prepare(self._update_stmt).executemany(cur, updates)
+            if discards:
+                db_conn.prepare(self._delete_stmt).executemany(cur, [{'id': d[1]} for d in discards])
         except Exception as e:
             raise DBException(str(e))
 
-        prev_record = None
-        delete_stmt = db_conn.convert_stmt('DELETE FROM rate WHERE id = %(id)s')
-        for _record in cur:
-            self.counter_read += 1
-            record = Record(dict(zip(column_names, _record)))
-
-            if record.observer_id != record.session_observer_id:
-                self._log_discard(record.session_id, record.id, 'observer ID differs from session observer ID')
-                prev_record = record
-                continue
-
-            try:
-                write_cur.execute(delete_stmt, {'id': record.id})
-            except Exception as err:
-                raise DBException(str(err))
-
-            if prev_record is None:
-                prev_record = record
-                continue
-
-            if record in prev_record:
-                self._log_discard(prev_record.session_id, prev_record.id, 'time period contained by observation %s' % record.id)
-                prev_record = record
-                continue
-
-            if prev_record == record:
-                self._log_discard(record.session_id, record.id, 'time period overlaps observation %s' % prev_record.id)
-                continue
-
-            try:
-                prev_record.write(write_cur, self._sky, self._showers)
-            except NormalizerException as err:
-                self._log_discard(prev_record.session_id, prev_record.id, str(err))
-                prev_record = record
-                continue
-
-            self.counter_write += 1
-            prev_record = record
-
-        if prev_record is not None:
-            try:
-                prev_record.write(write_cur, self._sky, self._showers)
-                self.counter_write += 1
-            except NormalizerException as err:
-                self._log_discard(prev_record.session_id, prev_record.id, str(err))
-
+        self._write_discards(cur, discards)
         try:
             cur.close()
-            write_cur.close()
         except Exception as e:
             raise DBException(str(e))
+
+    def _update(self, record, updates, discards):
+        sky = self._sky
+        self.counter_read += 1
+        start = BaseRecord.parse_datetime(record['period_start'])
+        t_mean = start + (BaseRecord.parse_datetime(record['period_end']) - start) / 2
+        loc = Location(math.radians(record['longitude']), math.radians(record['latitude']))
+        try:
+            rad_alt, rad_az = Record.radiant_alt_az(
+                sky,
+                self._showers,
+                record['shower'],
+                t_mean,
+                loc,
+                sky.sidereal_time(t_mean, loc)
+            )
+        except NormalizerException as err:
+            discards.append((record['session_id'], record['id'], record['shower'], err.reason, err.detail))
+            self.session_ids.add(record['session_id'])
+            return
+
+        updates.append({'id': record['id'], 'rad_alt': rad_alt, 'rad_az': rad_az})
+        self.counter_write += 1
@@ -2,7 +2,21 @@ from imo_vmdb.db import DBException
 from imo_vmdb.normalizer import BaseNormalizer
 
 
-class Record(object):
+class SessionNormalizer(BaseNormalizer):
+    """
+    Copies the imported sessions to the table `obs_session`.
+
+    The sessions are replaced by two set-based statements that run entirely inside the database.
+    Replaced sessions are deleted first, so their normalized records are removed by cascade
+    as before. If only a part of the records of the sessions is normalized, the sessions are
+    updated in place instead, so the normalized records of the other showers are kept.
+    """
+
+    _delete_stmt = '''
+        DELETE FROM obs_session
+        WHERE id IN (SELECT id FROM imported_session {where})
+    '''
+
     _insert_stmt = '''
         INSERT INTO obs_session (
             id,
@@ -13,93 +27,84 @@ class Record(object):
             observer_name,
             country,
             city
-        ) VALUES (
-            %(id)s,
-            %(latitude)s,
-            %(longitude)s,
-            %(elevation)s,
-            %(observer_id)s,
-            %(observer_name)s,
-            %(country)s,
-            %(city)s
         )
+        SELECT
+            id,
+            latitude,
+            longitude,
+            elevation,
+            observer_id,
+            observer_name,
+            country,
+            city
+        FROM imported_session
+        {where}
     '''
 
-    def __init__(self, record):
-        self.id = record['id']
-        self.latitude = record['latitude']
-        self.longitude = record['longitude']
-        self.elevation = record['elevation']
-        self.observer_id = record['observer_id']
-        self.observer_name = record['observer_name']
-        self.country = record['country']
-        self.city = record['city']
+    _update_stmt = '''
+        UPDATE obs_session SET
+            latitude = (SELECT i.latitude FROM imported_session AS i WHERE i.id = obs_session.id),
+            longitude = (SELECT i.longitude FROM imported_session AS i WHERE i.id = obs_session.id),
+            elevation = (SELECT i.elevation FROM imported_session AS i WHERE i.id = obs_session.id),
+            observer_id = (SELECT i.observer_id FROM imported_session AS i WHERE i.id = obs_session.id),
+            observer_name = (SELECT i.observer_name FROM imported_session AS i WHERE i.id = obs_session.id),
+            country = (SELECT i.country FROM imported_session AS i WHERE i.id = obs_session.id),
+            city = (SELECT i.city FROM imported_session AS i WHERE i.id = obs_session.id)
+        WHERE {condition} AND id IN (SELECT id FROM imported_session)
+    '''
 
-    @classmethod
-    def init_stmt(cls, db_conn):
-        cls._insert_stmt = db_conn.convert_stmt(cls._insert_stmt)
+    def __init__(self, db_conn, logger, session_filter=None):
+        super().__init__(db_conn, logger, session_filter=session_filter)
+        self.counter_delete = 0
 
-    def write(self, cur):
+    def run(self):
+        db_conn = self._db_conn
+        session_filter = self._session_filter
+
+        where = ''
+        if session_filter is not None:
+            where = 'WHERE ' + session_filter.condition('id')
+            if session_filter.partial:
+                self._update_sessions()
+                where += ' AND id NOT IN (SELECT id FROM obs_session)'
+            else:
+                self._delete_vanished_sessions()
 
-        rate = {
-            'id': self.id,
-            'latitude': self.latitude,
-            'longitude': self.longitude,
-            'elevation': self.elevation,
-            'observer_id': self.observer_id,
-            'observer_name': self.observer_name,
-            'country': self.country,
-            'city': self.city
-        }
         try:
-            cur.execute(self._insert_stmt, rate)
+            cur = db_conn.cursor()
+            if session_filter is None or not session_filter.partial:
+                cur.execute(db_conn.convert_stmt(self._delete_stmt.format(where=where)))
+            cur.execute(db_conn.convert_stmt(self._insert_stmt.format(where=where)))
+            self.counter_read += cur.rowcount
+            self.counter_write += cur.rowcount
+            cur.close()
         except Exception as e:
             raise DBException(str(e))
 
-
-class SessionNormalizer(BaseNormalizer):
-
-    def __init__(self, db_conn, logger):
-        super().__init__(db_conn, logger)
-        Record.init_stmt(db_conn)
-
-    def run(self):
+    def _delete_vanished_sessions(self):
+        # Replaced sessions that have not been imported again have been deleted from the imported data.
+        # The normalized records of these sessions are removed by cascade.
         db_conn = self._db_conn
-
         try:
             cur = db_conn.cursor()
             cur.execute(db_conn.convert_stmt('''
-                SELECT
-                    id,
-                    latitude,
-                    longitude,
-                    elevation,
-                    observer_id,
-                    observer_name,
-                    country,
-                    city
-                FROM imported_session
-            '''))
+                DELETE FROM obs_session
+                WHERE %s AND id NOT IN (SELECT id FROM imported_session)
+            ''' % self._session_filter.replaced_condition('imported_session', 'id')))
+            self.counter_delete = cur.rowcount
+            cur.close()
         except Exception as e:
             raise DBException(str(e))
 
-        column_names = [desc[0] for desc in cur.description]
-
+    def _update_sessions(self):
+        db_conn = self._db_conn
         try:
-            write_cur = db_conn.cursor()
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(
+                self._update_stmt.format(condition=self._session_filter.condition('id'))
+            ))
+            self.counter_read += cur.rowcount
+            self.counter_write += cur.rowcount
+            cur.close()
         except Exception as e:
             raise DBException(str(e))
-
-        delete_stmt = db_conn.convert_stmt('DELETE FROM obs_session WHERE id = %(id)s')
-        for _record in cur:
-            self.counter_read += 1
-            record = Record(dict(zip(column_names, _record)))
-            try:
-                write_cur.execute(delete_stmt, {'id': record.id})
-            except Exception as e:
-                raise DBException(str(e))
-            record.write(write_cur)
-            self.counter_write += 1
-
-        cur.close()
-        write_cur.close()
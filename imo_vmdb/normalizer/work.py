@@ -0,0 +1,268 @@
+import os
+import socket
+import time
+import uuid
+from imo_vmdb.db import DBException
+
+
+class WorkUnit(object):
+
+    def __init__(self, record):
+        self.id = record['id']
+        self.stage = record['stage']
+        self.first_session_id = record['first_session_id']
+        self.last_session_id = record['last_session_id']
+        self.claim = record['claim']
+        self.attempts = record['attempts']
+
+    @property
+    def session_range(self):
+        return self.first_session_id, self.last_session_id
+
+
+class WorkQueue(object):
+    """
+    Session ranges to be normalized, stored in the table `normalize_work`.
+
+    Any number of workers on any host can claim units of the queue. A claimed unit is leased for
+    `lease_time` seconds. If the worker does not complete the unit within this time, the unit
+    can be claimed by another worker. A worker can only complete a unit as long as it holds
+    the claim, so the result of an expired claim is rolled back.
+
+    On PostgreSQL and MySQL, the units are claimed with `SELECT ... FOR UPDATE SKIP LOCKED`.
+    On SQLite, a unit is claimed by a single UPDATE statement that sets a unique claim token. Since
+    SQLite has a single writer, the claim is not committed before the unit is completed, so the
+    worker keeps the write lock until then. Meanwhile, the other workers find no unit to be claimed
+    and poll again, so the units are written one after another.
+
+    Every method commits, except a successful claim on SQLite, because the queue is shared between
+    connections.
+    """
+
+    _skip_locked_modules = ('psycopg2', 'pymysql')
+
+    def __init__(self, db_conn, lease_time=600, worker_id=None):
+        self._db_conn = db_conn
+        self._lease_time = lease_time
+        if worker_id is None:
+            worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.worker_id = worker_id
+
+    def fill(self, stage, session_ranges):
+        """
+        Replace all units of a stage.
+
+        :param stage: Name of the stage, e.g. `rate` or `magnitude`.
+        :param session_ranges: Iterable of tuples of the first and last session ID.
+        :return: Number of created units.
+        """
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(
+                db_conn.convert_stmt('DELETE FROM normalize_work WHERE stage = %(stage)s'),
+                {'stage': stage}
+            )
+            cur.execute(db_conn.convert_stmt('SELECT coalesce(max(id), 0) FROM normalize_work'))
+            max_id = cur.fetchone()[0]
+            units = [
+                {'id': max_id + i, 'stage': stage, 'first_session_id': first_id, 'last_session_id': last_id}
+                for i, (first_id, last_id) in enumerate(session_ranges, 1)
+            ]
+            if units:
+                cur.executemany(db_conn.convert_stmt('''
+                    INSERT INTO normalize_work (
+                        id,
+                        stage,
+                        first_session_id,
+                        last_session_id,
+                        status,
+                        attempts
+                    ) VALUES (
+                        %(id)s,
+                        %(stage)s,
+                        %(first_session_id)s,
+                        %(last_session_id)s,
+                        'pending',
+                        0
+                    )
+                '''), units)
+            cur.close()
+            db_conn.commit()
+        except Exception as e:
+            raise DBException(str(e))
+
+        return len(units)
+
+    def claim(self):
+        """
+        Claim the next pending unit or a unit whose lease has expired.
+
+        :return: The claimed unit or None, if there is no unit to be claimed or the database is
+            locked by another worker (SQLite).
+        :rtype: WorkUnit
+        """
+        db_conn = self._db_conn
+        now = time.time()
+        params = {
+            'now': now,
+            'claim': uuid.uuid4().hex,
+            'worker': self.worker_id,
+            'lease_expires': now + self._lease_time,
+        }
+        claimable = '''
+            SELECT id FROM normalize_work
+            WHERE
+                status = 'pending' OR
+                (status = 'claimed' AND lease_expires < %(now)s)
+            ORDER BY id
+            LIMIT 1
+        '''
+        update_stmt = '''
+            UPDATE normalize_work SET
+                status = 'claimed',
+                claim = %(claim)s,
+                worker = %(worker)s,
+                lease_expires = %(lease_expires)s,
+                attempts = attempts + 1
+            WHERE id = %(id)s
+        '''
+        try:
+            cur = db_conn.cursor()
+            if db_conn.db_module in self._skip_locked_modules:
+                cur.execute(db_conn.convert_stmt(claimable + ' FOR UPDATE SKIP LOCKED'), params)
+                row = cur.fetchone()
+                if row is not None:
+                    cur.execute(db_conn.convert_stmt(update_stmt), dict(params, id=row[0]))
+            else:
+                # the subselect and the update are executed atomically
+                cur.execute(
+                    db_conn.convert_stmt(update_stmt.replace('%(id)s', '(%s)' % claimable)),
+                    params
+                )
+            cur.execute(db_conn.convert_stmt('''
+                SELECT id, stage, first_session_id, last_session_id, claim, attempts
+                FROM normalize_work
+                WHERE claim = %(claim)s
+            '''), params)
+            column_names = [desc[0] for desc in cur.description]
+            row = cur.fetchone()
+            cur.close()
+            if row is None or db_conn.db_module in self._skip_locked_modules:
+                db_conn.commit()
+        except Exception as e:
+            if _is_locked(db_conn, e):
+                db_conn.rollback()
+                return None
+            raise DBException(str(e))
+
+        if row is None:
+            return None
+
+        return WorkUnit(dict(zip(column_names, row)))
+
+    def complete(self, unit, counter_read, counter_write, counter_discard):
+        """
+        Mark a claimed unit as done and commit the work of the unit.
+
+        If the claim has expired and the unit has been claimed by another worker in the meantime,
+        the work is rolled back.
+
+        :return: True if the unit has been completed, False if the claim was lost.
+        :rtype: bool
+        """
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt('''
+                UPDATE normalize_work SET
+                    status = 'done',
+                    counter_read = %(counter_read)s,
+                    counter_write = %(counter_write)s,
+                    counter_discard = %(counter_discard)s
+                WHERE id = %(id)s AND claim = %(claim)s AND status = 'claimed'
+            '''), {
+                'id': unit.id,
+                'claim': unit.claim,
+                'counter_read': counter_read,
+                'counter_write': counter_write,
+                'counter_discard': counter_discard,
+            })
+            completed = cur.rowcount == 1
+            cur.close()
+            if completed:
+                db_conn.commit()
+            else:
+                db_conn.rollback()
+        except Exception as e:
+            raise DBException(str(e))
+
+        return completed
+
+    def release(self, unit):
+        """
+        Roll back the work of a claimed unit and return the unit to the queue.
+        """
+        db_conn = self._db_conn
+        try:
+            db_conn.rollback()
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt('''
+                UPDATE normalize_work SET status = 'pending', claim = NULL
+                WHERE id = %(id)s AND claim = %(claim)s
+            '''), {'id': unit.id, 'claim': unit.claim})
+            cur.close()
+            db_conn.commit()
+        except Exception as e:
+            raise DBException(str(e))
+
+    def count_unfinished(self):
+        """
+        :return: Number of units that are not done yet, or None if the database is locked by another
+            worker (SQLite).
+        :rtype: int
+        """
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt(
+                "SELECT count(*) FROM normalize_work WHERE status <> 'done'"
+            ))
+            count = cur.fetchone()[0]
+            cur.close()
+            db_conn.commit()
+        except Exception as e:
+            if _is_locked(db_conn, e):
+                db_conn.rollback()
+                return None
+            raise DBException(str(e))
+
+        return count
+
+    def counters(self, stage):
+        """
+        :return: The sums of the read, written and discarded records of the completed units of a stage.
+        :rtype: tuple
+        """
+        db_conn = self._db_conn
+        try:
+            cur = db_conn.cursor()
+            cur.execute(db_conn.convert_stmt('''
+                SELECT
+                    coalesce(sum(counter_read), 0),
+                    coalesce(sum(counter_write), 0),
+                    coalesce(sum(counter_discard), 0)
+                FROM normalize_work
+                WHERE stage = %(stage)s AND status = 'done'
+            '''), {'stage': stage})
+            counters = tuple(cur.fetchone())
+            cur.close()
+        except Exception as e:
+            raise DBException(str(e))
+
+        return counters
+
+
+def _is_locked(db_conn, error):
+    # the busy timeout of SQLite has expired while another connection holds the write lock
+    return 'sqlite3' == db_conn.db_module and 'database is locked' in str(error)
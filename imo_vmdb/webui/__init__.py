@@ -1,9 +1,20 @@
 from flask import Flask
 
+from imo_vmdb.db import DBPool, ReplicaRouter
+
 
 def create_app(config, upload_dir):
     app = Flask(__name__, template_folder='templates')
     app.config['IMO_CONFIG'] = config
+    # The API and the exports only read, so their connections never block a running import or
+    # normalization. With a read replica, they only read from the primary while the replica lags.
+    # The jobs connect to the primary.
+    db_pool = None
+    if config.has_section('database_readonly') and config.has_section('database'):
+        db_pool = ReplicaRouter.from_config(config)
+    elif config.has_section('database'):
+        db_pool = DBPool.from_config(config, read_only=True)
+    app.config['DB_POOL'] = db_pool
     app.config['UPLOAD_DIR'] = upload_dir
     from .routes import bp
     from .api import api_bp
@@ -2,7 +2,8 @@ import os
 
 from flask import Blueprint, current_app, jsonify, request, send_from_directory
 
-from imo_vmdb.db import DBAdapter
+from imo_vmdb.analysis.zhr import observation_zhr, population_index, Rates, zhr_profile
+from imo_vmdb.db import DBException, period_filter
 
 api_bp = Blueprint('api', __name__)
 
@@ -16,8 +17,14 @@ def _rows_to_dicts(cursor):
     return [dict(zip(cols, row)) for row in cursor.fetchall()]
 
 
-def _get_db(config):
-    return DBAdapter(dict(config['database']))
+def _get_db():
+    return current_app.config['DB_POOL'].checkout()
+
+
+@api_bp.errorhandler(DBException)
+def _db_unavailable(exc):
+    # raised if no pooled connection is available
+    return jsonify({'error': str(exc)}), 503
 
 
 def _add_shower_condition(args, alias, conditions, params):
@@ -38,23 +45,26 @@ def _add_shower_condition(args, alias, conditions, params):
         conditions.append(f'({" OR ".join(parts)})')
 
 
-def _build_rate_conditions(args):
+def _add_period_condition(args, alias, epoch_columns, conditions, params):
+    for key, column, op in [
+        ('period_start', 'period_start', '>='),
+        ('period_end',   'period_end',   '<='),
+    ]:
+        val = args.get(key)
+        if not val:
+            continue
+        column, params[key] = period_filter(f'{alias}.{column}', val, epoch_columns)
+        conditions.append(f'{column} {op} %({key})s')
+
+
+def _build_rate_conditions(args, epoch_columns=False):
     conditions = []
     params = {}
 
     _add_shower_condition(args, 'r', conditions, params)
 
-    period_start = args.get('period_start')
-    if period_start:
-        conditions.append('r.period_start >= %(period_start)s')
-        params['period_start'] = period_start
-
-    period_end = args.get('period_end')
-    if period_end:
-        conditions.append('r.period_end <= %(period_end)s')
-        params['period_end'] = period_end
-
     try:
+        _add_period_condition(args, 'r', epoch_columns, conditions, params)
         for key, col, op in [
             ('sl_min',       'r.sl_start', '>='),
             ('sl_max',       'r.sl_end',   '<='),
@@ -88,23 +98,14 @@ def _build_rate_conditions(args):
     return conditions, params
 
 
-def _build_magnitude_conditions(args):
+def _build_magnitude_conditions(args, epoch_columns=False):
     conditions = []
     params = {}
 
     _add_shower_condition(args, 'm', conditions, params)
 
-    period_start = args.get('period_start')
-    if period_start:
-        conditions.append('m.period_start >= %(period_start)s')
-        params['period_start'] = period_start
-
-    period_end = args.get('period_end')
-    if period_end:
-        conditions.append('m.period_end <= %(period_end)s')
-        params['period_end'] = period_end
-
     try:
+        _add_period_condition(args, 'm', epoch_columns, conditions, params)
         for key, col, op in [
             ('sl_min',       'm.sl_start', '>='),
             ('sl_max',       'm.sl_end',   '<='),
@@ -136,6 +137,76 @@ def _build_magnitude_conditions(args):
     return conditions, params
 
 
+_RATE_SELECT = """
+    SELECT
+        r.id,
+        r.shower,
+        r.period_start,
+        r.period_end,
+        r.sl_start,
+        r.sl_end,
+        r.session_id,
+        r.freq,
+        r.lim_mag,
+        r.t_eff,
+        r.f,
+        r.sidereal_time,
+        r.sun_alt,
+        r.sun_az,
+        r.moon_alt,
+        r.moon_az,
+        r.moon_illum,
+        r.field_alt,
+        r.field_az,
+        r.rad_alt,
+        r.rad_az,
+        rm.magn_id
+    FROM rate r
+    LEFT JOIN rate_magnitude rm ON r.id = rm.rate_id
+"""
+
+_MAGNITUDE_SELECT = """
+    SELECT
+        m.id,
+        m.shower,
+        m.period_start,
+        m.period_end,
+        m.sl_start,
+        m.sl_end,
+        m.session_id,
+        m.freq,
+        m.mean,
+        m.lim_mag
+    FROM magnitude m
+"""
+
+
+def rates_query(args, epoch_columns=False):
+    """
+    Return the SELECT statement and the parameters of the rates filtered by the request arguments.
+
+    With `epoch_columns`, the period is compared with the generated epoch columns.
+
+    :raises ValueError: If an argument is invalid.
+    """
+    conditions, params = _build_rate_conditions(args, epoch_columns)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return f'{_RATE_SELECT} {where}', params
+
+
+def magnitudes_query(args, epoch_columns=False):
+    """
+    Return the SELECT statement and the parameters of the magnitudes filtered by the request arguments.
+
+    With `epoch_columns`, the period is compared with the generated epoch columns.
+
+    :raises ValueError: If an argument is invalid.
+    """
+    conditions, params = _build_magnitude_conditions(args, epoch_columns)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return f'{_MAGNITUDE_SELECT} {where}', params
+
+
 def _fetch_sessions(db_conn, session_ids):
     phs = ', '.join(f'%(sid_{i})s' for i in range(len(session_ids)))
     params = {f'sid_{i}': sid for i, sid in enumerate(session_ids)}
@@ -170,46 +241,15 @@ def get_rates():
     if not config.has_section('database'):
         return jsonify({'error': 'No database configured.'}), 503
 
-    try:
-        conditions, params = _build_rate_conditions(request.args)
-    except ValueError as exc:
-        return jsonify({'error': str(exc)}), 400
-
-    stmt = db_conn = None
-    select = """
-        SELECT
-            r.id,
-            r.shower,
-            r.period_start,
-            r.period_end,
-            r.sl_start,
-            r.sl_end,
-            r.session_id,
-            r.freq,
-            r.lim_mag,
-            r.t_eff,
-            r.f,
-            r.sidereal_time,
-            r.sun_alt,
-            r.sun_az,
-            r.moon_alt,
-            r.moon_az,
-            r.moon_illum,
-            r.field_alt,
-            r.field_az,
-            r.rad_alt,
-            r.rad_az,
-            rm.magn_id
-        FROM rate r
-        LEFT JOIN rate_magnitude rm ON r.id = rm.rate_id
-    """
-    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
-    stmt = f'{select} {where}'
-
     includes = {x.strip() for x in request.args.get('include', '').split(',') if x.strip()}
 
-    db_conn = _get_db(config)
+    db_conn = _get_db()
     try:
+        try:
+            stmt, params = rates_query(request.args, db_conn.epoch_columns)
+        except ValueError as exc:
+            return jsonify({'error': str(exc)}), 400
+
         cur = db_conn.cursor()
         cur.execute(db_conn.convert_stmt(stmt), params)
         observations = _rows_to_dicts(cur)
@@ -239,32 +279,15 @@ def get_magnitudes():
     if not config.has_section('database'):
         return jsonify({'error': 'No database configured.'}), 503
 
-    try:
-        conditions, params = _build_magnitude_conditions(request.args)
-    except ValueError as exc:
-        return jsonify({'error': str(exc)}), 400
-
-    select = """
-        SELECT
-            m.id,
-            m.shower,
-            m.period_start,
-            m.period_end,
-            m.sl_start,
-            m.sl_end,
-            m.session_id,
-            m.freq,
-            m.mean,
-            m.lim_mag
-        FROM magnitude m
-    """
-    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
-    stmt = f'{select} {where}'
-
     includes = {x.strip() for x in request.args.get('include', '').split(',') if x.strip()}
 
-    db_conn = _get_db(config)
+    db_conn = _get_db()
     try:
+        try:
+            stmt, params = magnitudes_query(request.args, db_conn.epoch_columns)
+        except ValueError as exc:
+            return jsonify({'error': str(exc)}), 400
+
         cur = db_conn.cursor()
         cur.execute(db_conn.convert_stmt(stmt), params)
         observations = _rows_to_dicts(cur)
@@ -293,7 +316,7 @@ def get_showers():
     if not config.has_section('database'):
         return jsonify({'error': 'No database configured.'}), 503
 
-    db_conn = _get_db(config)
+    db_conn = _get_db()
     try:
         cur = db_conn.cursor()
         cur.execute("""
@@ -323,6 +346,119 @@ def get_showers():
     return jsonify(showers)
 
 
+@api_bp.route('/discards')
+def get_discards():
+    config = current_app.config['IMO_CONFIG']
+    if not config.has_section('database'):
+        return jsonify({'error': 'No database configured.'}), 503
+
+    conditions = []
+    params = {}
+    _add_shower_condition(request.args, 'd', conditions, params)
+    obs_type = request.args.get('obs_type')
+    if obs_type is not None:
+        if obs_type not in ('rate', 'magnitude'):
+            return jsonify({'error': 'obs_type must be rate or magnitude.'}), 400
+        conditions.append('d.obs_type = %(obs_type)s')
+        params['obs_type'] = obs_type
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    db_conn = _get_db()
+    try:
+        cur = db_conn.cursor()
+        cur.execute(db_conn.convert_stmt(f"""
+            SELECT
+                d.obs_type,
+                d.shower,
+                d.reason_code,
+                count(*) AS count
+            FROM normalize_discard AS d
+            {where}
+            GROUP BY d.obs_type, d.shower, d.reason_code
+            ORDER BY d.obs_type, d.shower, d.reason_code
+        """), params)
+        discards = _rows_to_dicts(cur)
+    except Exception as exc:
+        return jsonify({'error': str(exc)}), 500
+    finally:
+        db_conn.close()
+
+    return jsonify(discards)
+
+
+@api_bp.route('/zhr')
+def get_zhr():
+    config = current_app.config['IMO_CONFIG']
+    if not config.has_section('database'):
+        return jsonify({'error': 'No database configured.'}), 503
+
+    args = request.args
+    shower = args.get('shower')
+    if not shower:
+        return jsonify({'error': 'The parameter shower is required.'}), 400
+    shower = shower.upper()
+
+    try:
+        options = {}
+        for key, default in [
+            ('bin_width',   1.0),
+            ('r',           None),
+            ('gamma',       1.0),
+            ('min_rad_alt', 20.0),
+            ('min_lim_mag', None),
+            ('max_f',       None),
+        ]:
+            val = args.get(key)
+            options[key] = default if val is None else float(val)
+    except (ValueError, TypeError) as exc:
+        return jsonify({'error': f'Invalid parameter value: {exc}'}), 400
+    weighting = args.get('weighting', 'time')
+    includes = {x.strip() for x in args.get('include', '').split(',') if x.strip()}
+
+    db_conn = _get_db()
+    try:
+        r = options['r'] if options['r'] is not None else population_index(db_conn, shower)
+        rates = Rates.load(
+            db_conn,
+            shower,
+            period_start=args.get('period_start') or None,
+            period_end=args.get('period_end') or None,
+            min_rad_alt=options['min_rad_alt'],
+            min_lim_mag=options['min_lim_mag'],
+            max_f=options['max_f'],
+        )
+        result = {
+            'shower': shower,
+            'r': r,
+            'bins': zhr_profile(rates, r, options['bin_width'], weighting, options['gamma']),
+        }
+        if 'observations' in includes:
+            zhr = observation_zhr(rates, r, options['gamma'])
+            result['observations'] = [
+                {'id': obs_id, 'session_id': session_id, 'sl': sl, 'zhr': obs_zhr}
+                for obs_id, session_id, sl, obs_zhr in zip(
+                    rates.id.tolist(), rates.session_id.tolist(), rates.sl.round(4).tolist(), zhr.round(4).tolist()
+                )
+            ]
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    except Exception as exc:
+        return jsonify({'error': str(exc)}), 500
+    finally:
+        db_conn.close()
+
+    return jsonify(result)
+
+
+@api_bp.route('/pool')
+def get_pool():
+    pool = current_app.config['DB_POOL']
+    if pool is None:
+        return jsonify({'error': 'No database configured.'}), 503
+
+    return jsonify(pool.stats())
+
+
 @api_bp.route('/openapi.yaml')
 def openapi_spec():
     if not os.path.isfile(_OPENAPI_FILE):
@@ -12,6 +12,7 @@ from werkzeug.utils import secure_filename
 
 import imo_vmdb
 from imo_vmdb.db import DBAdapter
+from imo_vmdb.generations import Generations
 
 _DATA_DIR = Path(os.path.dirname(os.path.realpath(__file__))).parent / 'data'
 
@@ -65,6 +66,18 @@ def _run_job(job_id, fn, config, extra_args):
     _finish_job(job_id, exit_code if exit_code is not None else 0)
 
 
+def _run_shadow_job(job_id, fn, config):
+    logger = _make_logger(job_id)
+    try:
+        with Generations.from_config(config).shadow() as db_conn:
+            exit_code = fn(db_conn, logger)
+        logger.info('The normalized copy has replaced the database.')
+    except Exception as exc:
+        logger.critical('Unexpected error: %s', exc)
+        exit_code = 100
+    _finish_job(job_id, exit_code if exit_code is not None else 0)
+
+
 def _run_import_job(job_id, config, file_paths, do_delete, is_permissive, try_repair):
     logger = _make_logger(job_id)
     try:
@@ -135,7 +148,10 @@ def run_initdb():
 @bp.route('/run/normalize', methods=['POST'])
 def run_normalize():
     config = current_app.config['IMO_CONFIG']
-    job_id = _start_job(_run_job, imo_vmdb.normalize, config, ())
+    if config.getboolean('generations', 'shadow', fallback=False):
+        job_id = _start_job(_run_shadow_job, imo_vmdb.normalize, config)
+    else:
+        job_id = _start_job(_run_job, imo_vmdb.normalize, config, ())
     if job_id is None:
         return jsonify({'error': 'Another job is already running.'}), 409
     return jsonify({'job_id': job_id})
@@ -231,7 +247,10 @@ def _export_db_table(table):
     config = current_app.config['IMO_CONFIG']
     if not config.has_section('database'):
         return None, 'No database configured'
-    db_conn = DBAdapter(dict(config['database']))
+    try:
+        db_conn = current_app.config['DB_POOL'].checkout()
+    except Exception as exc:
+        return None, str(exc)
     try:
         cur = db_conn.cursor()
         cur.execute(f'SELECT * FROM {table}')
@@ -0,0 +1,138 @@
+import logging
+import math
+from pathlib import Path
+
+import pytest
+
+import imo_vmdb
+from imo_vmdb import CSVImporter
+from imo_vmdb.analysis.population import estimate_r, fit_r, Magnitudes, r_profile
+from imo_vmdb.analysis.zhr import observation_zhr, population_index, Rates, zhr_profile
+from imo_vmdb.db import DBAdapter
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+logger = logging.getLogger('test')
+
+
+@pytest.fixture
+def normalized_db(tmp_path):
+    """SQLite DB with normalized rate and magnitude observations."""
+    db_conn = DBAdapter({'database': str(tmp_path / 'normalized.db')})
+    imo_vmdb.initdb(db_conn, logger)
+    CSVImporter(db_conn, logger).run([
+        str(FIXTURES / 'sessions.csv'),
+        str(FIXTURES / 'rates.csv'),
+        str(FIXTURES / 'overlapping_rates.csv'),
+        str(FIXTURES / 'overlapping_magnitudes.csv'),
+    ])
+    imo_vmdb.normalize(db_conn, logger)
+    yield db_conn
+    db_conn.close()
+
+
+def _zhr(freq, t_eff, f, lim_mag, rad_alt, r):
+    return freq * f * r ** (6.5 - lim_mag) / (t_eff * math.sin(math.radians(rad_alt)))
+
+
+class TestZHR:
+    def test_observation_zhr(self, normalized_db):
+        r = population_index(normalized_db, 'PER')
+        rates = Rates.load(normalized_db, 'PER', min_rad_alt=None)
+        cur = normalized_db.cursor()
+        cur.execute("SELECT id, freq, t_eff, f, lim_mag, rad_alt FROM rate WHERE shower = 'PER'")
+        expected = dict((row[0], _zhr(*row[1:], r)) for row in cur.fetchall())
+
+        assert sorted(rates.id.tolist()) == sorted(expected)
+        assert list(rates.sl) == sorted(rates.sl)
+        for obs_id, zhr in zip(rates.id.tolist(), observation_zhr(rates, r).tolist()):
+            assert zhr == pytest.approx(expected[obs_id])
+
+    def test_cuts_are_applied(self, normalized_db):
+        assert len(Rates.load(normalized_db, 'PER', min_rad_alt=None)) == 5
+        assert len(Rates.load(normalized_db, 'PER', min_rad_alt=40.0)) == 3
+        assert len(Rates.load(normalized_db, 'PER', min_rad_alt=None, min_lim_mag=6.2)) == 3
+        assert len(Rates.load(normalized_db, 'PER', period_end='2020-08-12 23:00:00')) == 3
+
+    def test_time_weighted_profile(self, normalized_db):
+        rates = Rates.load(normalized_db, 'PER', min_rad_alt=None)
+        profile = zhr_profile(rates, 2.2, bin_width=0.1)
+        assert [(b['sl_start'], b['sl_end'], b['count'], b['freq']) for b in profile] == [
+            (140.3, 140.4, 3, 60),
+            (140.4, 140.5, 2, 38),
+        ]
+        first = [i for i in range(len(rates)) if rates.sl[i] < 140.4]
+        t_corr = sum(rates.freq[i] / observation_zhr(rates, 2.2)[i] for i in first)
+        assert profile[0]['zhr'] == pytest.approx(60 / t_corr, abs=1e-4)
+        assert profile[0]['zhr_error'] == pytest.approx(profile[0]['zhr'] / math.sqrt(60), abs=1e-4)
+
+    def test_equal_weighted_profile(self, normalized_db):
+        rates = Rates.load(normalized_db, 'PER', min_rad_alt=None)
+        profile = zhr_profile(rates, 2.2, weighting='equal')
+        assert len(profile) == 1
+        assert profile[0]['zhr'] == pytest.approx(observation_zhr(rates, 2.2).mean(), abs=1e-4)
+        assert zhr_profile(Rates(), 2.2) == []
+
+    def test_invalid_arguments(self, normalized_db):
+        rates = Rates.load(normalized_db, 'PER')
+        with pytest.raises(ValueError):
+            zhr_profile(rates, 2.2, bin_width=0)
+        with pytest.raises(ValueError):
+            zhr_profile(rates, 2.2, weighting='median')
+        with pytest.raises(ValueError):
+            population_index(normalized_db, 'XYZ')
+        with pytest.raises(ValueError):
+            population_index(normalized_db, "PER' OR '1")
+
+
+class TestPopulationIndex:
+    def test_magnitudes_are_truncated(self, normalized_db):
+        magnitudes = Magnitudes.load(normalized_db, 'PER')
+        assert magnitudes.id.tolist() == [8001, 8003]
+        # 8001 has the limiting magnitude 6.2, so the classes up to 5 are used
+        assert magnitudes.freq.tolist() == [20.0, 44.0]
+        assert magnitudes.j_sum.tolist() == [58.0, 121.0]
+        assert Magnitudes.load(normalized_db, 'PER', offset=0.0).freq.tolist() == [20.0, 46.0]
+
+    def test_maximum_likelihood_fit(self):
+        assert fit_r(20.0, 58.0) == pytest.approx(1.0 + 20.0 / 58.0)
+        assert math.isnan(fit_r(3.0, 0.0))
+
+    def test_profile_does_not_depend_on_processes(self, normalized_db):
+        magnitudes = Magnitudes.load(normalized_db, 'PER')
+        profile = r_profile(magnitudes, bin_width=0.5, bootstrap=200)
+        assert len(profile) == 1
+        assert profile[0]['freq'] == 64.0
+        assert profile[0]['r'] == pytest.approx(1.0 + 64.0 / 179.0, abs=1e-4)
+        assert profile[0]['r_lower'] <= profile[0]['r'] <= profile[0]['r_upper']
+        assert r_profile(magnitudes, bin_width=0.5, bootstrap=200, processes=2) == profile
+        assert r_profile(magnitudes, bootstrap=0)[0]['r_lower'] is None
+
+    def test_estimates_are_stored_until_normalization(self, normalized_db):
+        profile = estimate_r(normalized_db, 'PER', bootstrap=100)
+        cur = normalized_db.cursor()
+        cur.execute('UPDATE r_estimate SET r = 2.5')
+        assert estimate_r(normalized_db, 'PER', bootstrap=100)[0]['r'] == 2.5
+        assert estimate_r(normalized_db, 'PER', bootstrap=50)[0]['r'] == profile[0]['r']
+
+        imo_vmdb.normalize(normalized_db, logger)
+        assert estimate_r(normalized_db, 'PER', bootstrap=100) == profile
+
+    def test_period_is_parsed_once(self, normalized_db):
+        profile = estimate_r(normalized_db, 'PER', period_start='2020-08-12', period_end='2020-08-13T02:00')
+        assert profile[0]['freq'] == 64.0
+        assert estimate_r(
+            normalized_db, 'PER', period_start='2020-08-12 00:00:00', period_end='2020-08-13 04:00:00+02:00'
+        ) == profile
+        cur = normalized_db.cursor()
+        cur.execute('SELECT count(DISTINCT cache_key) FROM r_estimate')
+        assert cur.fetchone()[0] == 1
+        assert estimate_r(normalized_db, 'PER', period_start='2020-08-12T21:30')[0]['freq'] == 44.0
+        with pytest.raises(ValueError):
+            estimate_r(normalized_db, 'PER', period_start='12.08.2020')
+
+    def test_invalid_arguments(self, normalized_db):
+        magnitudes = Magnitudes.load(normalized_db, 'PER')
+        with pytest.raises(ValueError):
+            r_profile(magnitudes, confidence=1.5)
+        with pytest.raises(ValueError):
+            r_profile(magnitudes, bin_width=-1.0)
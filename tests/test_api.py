@@ -1,4 +1,51 @@
 """Tests for the REST API (/api/v1/*)."""
+import configparser
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+import imo_vmdb
+from imo_vmdb import CSVImporter
+from imo_vmdb.db import DBAdapter
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+def _normalized_db_path(path, timestamp_storage):
+    db_conn = DBAdapter({'database': path, 'timestamp_storage': timestamp_storage})
+    imo_vmdb.initdb(db_conn, logging.getLogger('setup'))
+    CSVImporter(db_conn, logging.getLogger('setup')).run([
+        str(FIXTURES / 'sessions.csv'),
+        str(FIXTURES / 'rates.csv'),
+        str(FIXTURES / 'overlapping_magnitudes.csv'),
+    ])
+    imo_vmdb.normalize(db_conn, logging.getLogger('setup'))
+    db_conn.commit()
+    db_conn.close()
+    return path
+
+
+@pytest.fixture
+def epoch_db_path(tmp_path):
+    """SQLite DB with generated epoch columns and normalized observations."""
+    return _normalized_db_path(str(tmp_path / 'epoch.db'), 'epoch')
+
+
+@pytest.fixture
+def text_db_path(tmp_path):
+    """SQLite DB without generated epoch columns and with normalized observations."""
+    return _normalized_db_path(str(tmp_path / 'text.db'), 'text')
+
+
+def _client(db_path):
+    cfg = configparser.ConfigParser()
+    cfg.add_section('database')
+    cfg.set('database', 'database', db_path)
+    from imo_vmdb.webui import create_app
+    return create_app(cfg, tempfile.gettempdir()).test_client()
 
 
 class TestShowers:
@@ -16,6 +63,17 @@ class TestShowers:
             assert field in shower
 
 
+class TestDiscards:
+    def test_returns_200(self, client):
+        r = client.get('/api/v1/discards?shower=PER&shower=SPO&obs_type=rate')
+        assert r.status_code == 200
+        assert isinstance(r.get_json(), list)
+
+    def test_invalid_obs_type_returns_400(self, client):
+        r = client.get('/api/v1/discards?obs_type=session')
+        assert r.status_code == 400
+
+
 class TestRates:
     def test_returns_200_with_empty_observations(self, client):
         r = client.get('/api/v1/rates')
@@ -93,6 +151,116 @@ class TestMagnitudes:
         assert 'sessions' in r.get_json()
 
 
+class TestZHR:
+    def test_returns_200_with_empty_bins(self, client):
+        resp = client.get('/api/v1/zhr?shower=PER')
+        assert resp.status_code == 200
+        data = resp.get_json()
+        assert data['bins'] == []
+        assert data['r'] == pytest.approx(2.2)
+
+    def test_include_observations_key_present(self, client):
+        resp = client.get('/api/v1/zhr?shower=PER&bin_width=0.5&include=observations')
+        assert resp.status_code == 200
+        assert resp.get_json()['observations'] == []
+
+    def test_missing_shower_returns_400(self, client):
+        resp = client.get('/api/v1/zhr')
+        assert resp.status_code == 400
+
+    def test_unknown_shower_returns_400(self, client):
+        resp = client.get('/api/v1/zhr?shower=XYZ')
+        assert resp.status_code == 400
+
+    def test_invalid_param_returns_400(self, client):
+        assert client.get('/api/v1/zhr?shower=PER&bin_width=abc').status_code == 400
+        assert client.get('/api/v1/zhr?shower=PER&weighting=median').status_code == 400
+
+    def test_period_filter_matches_rates(self, text_db_path, epoch_db_path):
+        for client in (_client(text_db_path), _client(epoch_db_path)):
+            period = 'period_start=2020-08-12T21:00&period_end=2020-08-13T00:00:00Z'
+            r = client.get(f'/api/v1/rates?shower=PER&{period}')
+            expected = sorted(o['id'] for o in r.get_json()['observations'])
+            assert expected == [5001]
+            r = client.get(f'/api/v1/zhr?shower=PER&min_rad_alt=0&include=observations&{period}')
+            assert r.status_code == 200
+            assert sorted(o['id'] for o in r.get_json()['observations']) == expected
+            assert client.get('/api/v1/zhr?shower=PER&period_start=12.08.2020').status_code == 400
+
+
+class TestEpochColumns:
+    def test_period_filter_uses_epoch_columns(self, epoch_db_path):
+        client = _client(epoch_db_path)
+
+        db_conn = DBAdapter({'database': epoch_db_path})
+        assert db_conn.epoch_columns
+        cur = db_conn.cursor()
+        for table in ('rate', 'magnitude'):
+            cur.execute(f"""
+                SELECT id FROM {table}
+                WHERE period_start >= '2020-08-12 21:00:00' AND period_end <= '2020-08-13 00:00:00'
+            """)
+            expected = sorted(row[0] for row in cur.fetchall())
+            assert len(expected) == 2
+            endpoint = 'rates' if table == 'rate' else 'magnitudes'
+            r = client.get(f'/api/v1/{endpoint}?period_start=2020-08-12T21:00&period_end=2020-08-13')
+            assert r.status_code == 200
+            assert sorted(o['id'] for o in r.get_json()['observations']) == expected
+        db_conn.close()
+
+        r = client.get('/api/v1/rates?period_start=12.08.2020')
+        assert r.status_code == 400
+
+    def test_both_modes_accept_the_same_filters(self, text_db_path, epoch_db_path):
+        clients = [_client(text_db_path), _client(epoch_db_path)]
+        for query, expected in (
+            ('period_start=2020-08-13T00:30:00%2B02:00&period_end=2020-08-13T00:00:00Z', [5002]),
+            ('period_start=2020-08-12 22:00:00.5&period_end=2020-08-13', [5002]),
+            ('period_start=2020-08-12T21:00&period_end=2020-08-12T22:30:00.000001', [5001]),
+        ):
+            for client in clients:
+                r = client.get(f'/api/v1/rates?{query}')
+                assert r.status_code == 200
+                assert sorted(o['id'] for o in r.get_json()['observations']) == expected
+
+        for client in clients:
+            assert client.get('/api/v1/rates?period_start=12.08.2020').status_code == 400
+
+
+class TestPool:
+    def test_returns_statistics(self, client):
+        client.get('/api/v1/showers')
+        resp = client.get('/api/v1/pool')
+        assert resp.status_code == 200
+        stats = resp.get_json()
+        assert stats['in_use'] == 0
+        assert stats['open'] >= 1
+        assert stats['checkouts'] >= 1
+
+
+class TestReplica:
+    def test_reads_are_routed_to_replica(self, _app_db_path, tmp_path):
+        replica_path = str(tmp_path / 'replica.db')
+        shutil.copy(_app_db_path, replica_path)
+        replica = DBAdapter({'database': replica_path})
+        replica.cursor().execute("DELETE FROM shower WHERE iau_code <> 'PER'")
+        replica.commit()
+        replica.close()
+        cfg = configparser.ConfigParser()
+        cfg.read_dict({'database': {'database': _app_db_path}, 'database_readonly': {'database': replica_path}})
+        from imo_vmdb.webui import create_app
+        client = create_app(cfg, tempfile.gettempdir()).test_client()
+
+        r = client.get('/api/v1/showers')
+        assert [s['iau_code'] for s in r.get_json()] == ['PER']
+        r = client.get('/export/shower')
+        assert r.status_code == 200
+        assert len(r.data.decode().splitlines()) == 2
+        stats = client.get('/api/v1/pool').get_json()
+        assert stats['replica_used'] and stats['replica_checkouts'] == 2
+        assert stats['primary']['checkouts'] == 0
+
+
 class TestOpenApiSpec:
     def test_yaml_is_reachable(self, client):
         r = client.get('/api/v1/openapi.yaml')
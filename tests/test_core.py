@@ -1,5 +1,9 @@
+import configparser
 import logging
 import math
+import os
+import shutil
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
 from unittest.mock import MagicMock
@@ -9,8 +13,10 @@ import pytest
 import imo_vmdb
 from imo_vmdb import CSVImporter
 from imo_vmdb.csv_import import CsvParser, ImportException
-from imo_vmdb.db import DBAdapter
-from imo_vmdb.model.sky import Ephemeris, Sky, Location
+from imo_vmdb.db import analyze_tables, create_indexes, create_partitions, create_tables, DBAdapter, DBException, \
+    DBPool, detach_partitions, drop_indexes, existing_indexes, explain, INDEXES, PreparedStatement, ReplicaRouter
+from imo_vmdb.model.radiant import Drift, Position
+from imo_vmdb.model.sky import Cartesian, Ephemeris, Memo, Sky, Location, Sphere, to_spherical
 
 FIXTURES = Path(__file__).parent / 'fixtures'
 logger = logging.getLogger('test')
@@ -50,6 +56,375 @@ class TestEphemeris:
         assert 0.0 <= illum <= 1.0
 
 
+class TestSkyPrimitives:
+    T = datetime(2024, 8, 12, 22, 17, 0)
+    LOC = Location(lng=math.radians(13.4), lat=math.radians(52.5))
+
+    def test_geometry_types_have_no_instance_dict(self):
+        for obj in (Sphere(1.0, 0.5), self.LOC, Cartesian(1.0, 2.0, 3.0)):
+            assert not hasattr(obj, '__dict__')
+
+    def test_to_spherical_matches_sphere(self):
+        c = Cartesian(-0.3, 0.0, 0.7)
+        s = Sphere(c=c)
+        assert to_spherical(c.x, c.y, c.z) == (s.lng, s.lat, s.r)
+
+    def test_fused_sun_alt_az_matches_sphere_path(self):
+        sky = Sky()
+        sun = sky.sun(self.T, self.LOC)
+        assert sky.sun_alt_az(self.T, self.LOC) == (sun.lat, sun.lng)
+
+    def test_fused_moon_alt_az_matches_sphere_path(self):
+        sky = Sky()
+        moon = sky.moon(self.T, self.LOC)
+        st = sky.sidereal_time(self.T, self.LOC)
+        assert sky.moon_alt_az(self.T, self.LOC, st) == (moon.lat, moon.lng)
+
+    def test_equatorial_alt_az_matches_alt_az(self):
+        sky = Sky()
+        radec = Sphere(math.radians(46.0), math.radians(58.0))
+        expected = sky.alt_az(radec, self.T, self.LOC)
+        alt, az = sky.equatorial_alt_az(math.radians(46.0), math.radians(58.0), self.T, self.LOC)
+        assert (alt, az) == (expected.lat, expected.lng)
+
+
+class TestSkyMemo:
+    T = datetime(2024, 8, 12, 22, 17, 0)
+
+    def test_memo_is_bounded(self):
+        memo = Memo(2)
+        for key in range(5):
+            memo.get(key, lambda k: k * 2, key)
+        assert len(memo) == 2
+        assert memo.misses == 5
+
+    def test_memo_evicts_least_recently_used(self):
+        memo = Memo(2)
+        memo.get('a', str, 1)
+        memo.get('b', str, 2)
+        memo.get('a', str, 1)
+        memo.get('c', str, 3)
+        memo.get('a', str, 1)
+        assert memo.hits == 2
+        assert memo.misses == 3
+
+    def test_repeated_solarlong_is_a_hit(self):
+        sky = Sky()
+        first = sky.solarlong(self.T)
+        assert sky.solarlong(self.T) == first
+        assert sky.memo.hits == 1
+        assert sky.memo.hit_rate == 0.5
+
+    def test_sidereal_time_is_keyed_by_longitude(self):
+        sky = Sky()
+        east = sky.sidereal_time(self.T, Location(math.radians(13.4), 0.9))
+        west = sky.sidereal_time(self.T, Location(math.radians(-70.0), 0.9))
+        assert east != west
+        assert sky.memo.misses == 2
+
+
+class TestDrift:
+    @staticmethod
+    def _drift():
+        return Drift([
+            {'yday': 100, 'pos': Position(350.0, 10.0)},
+            {'yday': 110, 'pos': Position(10.0, 20.0)},
+            {'yday': 120, 'pos': Position(30.1, 30.0)},
+        ])
+
+    def test_interpolates_across_zero_ra(self):
+        pos = self._drift().get_position(datetime(2021, 4, 15))  # yday 105
+        assert pos.ra == pytest.approx(0.0)
+        assert pos.dec == pytest.approx(15.0)
+
+    def test_result_does_not_depend_on_request_order(self):
+        days = [datetime(2021, 4, d) for d in (12, 15, 18, 23, 27)]
+        forward = self._drift()
+        backward = self._drift()
+        a = [(p.ra, p.dec) for p in (forward.get_position(d) for d in days)]
+        b = [(p.ra, p.dec) for p in (backward.get_position(d) for d in reversed(days))]
+        assert a == list(reversed(b))
+
+
+class TestDBAdapter:
+    def test_stream_fetches_in_batches(self, seeded_db):
+        batches = list(seeded_db.stream(
+            'SELECT shower, "month", "day" FROM radiant WHERE shower = %(shower)s ORDER BY "month", "day"',
+            {'shower': 'PER'},
+            size=4
+        ))
+        assert [len(rows) for column_names, rows in batches] == [4, 4, 1]
+        assert batches[0][0] == ['shower', 'month', 'day']
+        assert batches[-1][1] == [('PER', 8, 25)]
+
+    def test_stream_of_empty_result(self, seeded_db):
+        assert list(seeded_db.stream("SELECT * FROM radiant WHERE shower = 'XXX'")) == []
+
+    def test_sqlite_profile_sets_pragmas(self, tmp_path):
+        db_conn = DBAdapter({
+            'database': str(tmp_path / 'profile.db'),
+            'sqlite_profile': 'bulk',
+            'sqlite_busy_timeout': '1000',
+            'timeout': '2.5',
+        })
+        cur = db_conn.cursor()
+        assert cur.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert cur.execute('PRAGMA busy_timeout').fetchone()[0] == 1000
+        assert cur.execute('PRAGMA cache_size').fetchone()[0] == -262144
+        db_conn.close()
+
+    def test_invalid_sqlite_settings_are_rejected(self, tmp_path):
+        with pytest.raises(DBException):
+            DBAdapter({'database': str(tmp_path / 'profile.db'), 'sqlite_profile': 'fast'})
+        with pytest.raises(DBException):
+            DBAdapter({'database': str(tmp_path / 'profile.db'), 'sqlite_cache_size': '1; DROP TABLE rate'})
+        with pytest.raises(DBException):
+            DBAdapter({'database': str(tmp_path / 'profile.db'), 'sqlite_locking_mode': 'EXCLUSIVE'})
+        with pytest.raises(DBException):
+            DBAdapter({'database': str(tmp_path / 'profile.db'), 'timestamp_storage': 'unix'})
+        with pytest.raises(DBException):
+            DBAdapter({'database': str(tmp_path / 'profile.db'), 'partitioning': 'month'})
+
+    def test_read_only_connection(self, seeded_db):
+        db_path = seeded_db.conn.execute('PRAGMA database_list').fetchone()[2]
+        db_conn = DBAdapter({'database': db_path, 'sqlite_profile': 'serving'}, read_only=True)
+        cur = db_conn.cursor()
+        assert cur.execute('SELECT count(*) FROM shower').fetchone()[0] > 0
+        with pytest.raises(Exception, match='readonly'):
+            cur.execute('DELETE FROM shower')
+        db_conn.close()
+
+    def test_statements_are_memoized(self, seeded_db):
+        stats = seeded_db.statement_stats()
+        stmt = 'SELECT count(*) FROM radiant WHERE shower = %(shower)s'
+        assert seeded_db.convert_stmt(stmt) == 'SELECT count(*) FROM radiant WHERE shower = :shower'
+        assert seeded_db.convert_stmt(stmt) is seeded_db.convert_stmt(stmt)
+        assert seeded_db.prepare(stmt) is seeded_db.prepare(stmt)
+        cur = seeded_db.cursor()
+        seeded_db.prepare(stmt).execute(cur, {'shower': 'PER'})
+        assert cur.fetchone()[0] == 9
+        new_stats = seeded_db.statement_stats()
+        assert new_stats['converted'] == stats['converted'] + 1
+        assert new_stats['reused'] == stats['reused'] + 5
+        assert new_stats['prepared'] == stats['prepared']
+
+    def test_server_side_prepared_statement(self, seeded_db):
+        stmt = PreparedStatement(
+            seeded_db,
+            'UPDATE rate SET f = %(f)s WHERE id = %(id)s AND f <> %(f)s AND t_eff %% 1 = 0',
+            'imo_vmdb_stmt_1'
+        )
+        cur = MagicMock()
+        stmt.executemany(cur, [{'id': 1, 'f': 1.5}, {'id': 2, 'f': 1.0}])
+        assert [c.args for c in cur.execute.call_args_list] == [
+            ('PREPARE imo_vmdb_stmt_1 AS UPDATE rate SET f = $1 WHERE id = $2 AND f <> $1 AND t_eff % 1 = 0',),
+            ('EXECUTE imo_vmdb_stmt_1 (%s, %s)', [1.5, 1]),
+            ('EXECUTE imo_vmdb_stmt_1 (%s, %s)', [1.0, 2]),
+        ]
+        assert seeded_db.statement_stats()['prepared'] == 1
+        assert seeded_db.statement_stats()['executed'] == 2
+
+
+class TestIndexes:
+    def test_catalog_indexes_are_created(self, seeded_db):
+        assert existing_indexes(seeded_db) == dict((name, table) for name, table, columns in INDEXES)
+
+    def test_misplaced_and_missing_indexes_are_repaired(self, seeded_db):
+        cur = seeded_db.cursor()
+        cur.execute('DROP INDEX magnitude_period_shower_key')
+        cur.execute('CREATE INDEX magnitude_period_shower_key ON rate(period_start, period_end, shower)')
+        cur.execute('DROP INDEX rate_session_key')
+        assert existing_indexes(seeded_db)['magnitude_period_shower_key'] == 'rate'
+
+        assert create_indexes(seeded_db) == ['rate_session_key', 'magnitude_period_shower_key']
+        assert existing_indexes(seeded_db)['magnitude_period_shower_key'] == 'magnitude'
+        assert create_indexes(seeded_db) == []
+
+    def test_indexes_are_dropped_by_table(self, seeded_db):
+        assert drop_indexes(seeded_db, tables=['rate_magnitude']) == ['fki_rate_magnitude_magn_fk']
+        assert 'fki_rate_magnitude_magn_fk' not in existing_indexes(seeded_db)
+        assert create_indexes(seeded_db, tables=['rate_magnitude']) == ['fki_rate_magnitude_magn_fk']
+
+    def test_api_filters_use_indexes(self, seeded_db):
+        analyze_tables(seeded_db)
+        plan = explain(seeded_db, 'SELECT * FROM magnitude m WHERE m.session_id IN (%(s1)s, %(s2)s)', {
+            's1': 1, 's2': 2
+        })
+        assert any('magnitude_session_key' in line for line in plan)
+
+    def test_bulk_load_rebuilds_indexes(self, seeded_db):
+        with seeded_db.bulk_load(['rate', 'magnitude']):
+            existing = existing_indexes(seeded_db)
+            assert 'rate_sl_key' not in existing
+            assert 'magnitude_lim_mag_key' not in existing
+            assert existing['rate_session_key'] == 'rate'
+            assert existing['fki_magnitude_detail_fk'] == 'magnitude_detail'
+        assert existing_indexes(seeded_db) == dict((name, table) for name, table, columns in INDEXES)
+
+        with pytest.raises(ValueError):
+            with seeded_db.bulk_load(['rate']):
+                raise ValueError()
+        assert 'rate_sl_key' in existing_indexes(seeded_db)
+
+    def test_bulk_load_validates_foreign_keys(self, seeded_db):
+        cur = seeded_db.cursor()
+        with pytest.raises(DBException, match='magnitude_detail_fk'):
+            with seeded_db.bulk_load(['magnitude_detail']):
+                cur.execute('INSERT INTO magnitude_detail (id, magn, freq) VALUES (1, 3, 1.0)')
+        seeded_db.rollback()
+
+
+class TestPartitions:
+    def test_only_postgresql_is_partitioned(self, fresh_db):
+        assert not fresh_db.partitioned
+        with pytest.raises(DBException):
+            create_tables(fresh_db, 'year')
+
+    def test_partitions_of_new_years_are_created(self):
+        db_conn = MagicMock(db_module='psycopg2')
+        cur = db_conn.cursor.return_value
+        cur.fetchall.return_value = [
+            ('rate_y2020', 'rate'), ('magnitude_y2020', 'magnitude'), ('magnitude_detail_y2020', 'magnitude_detail'),
+        ]
+        assert create_partitions(db_conn, [2021, 2020, 2021]) == [
+            'rate_y2021', 'magnitude_y2021', 'magnitude_detail_y2021',
+        ]
+        assert cur.execute.call_args_list[-1].args == (
+            "CREATE TABLE IF NOT EXISTS magnitude_detail_y2021 PARTITION OF magnitude_detail "
+            "FOR VALUES FROM ('2021-01-01') TO ('2022-01-01')",
+        )
+
+    def test_referencing_partitions_are_detached_first(self):
+        db_conn = MagicMock(db_module='psycopg2')
+        cur = db_conn.cursor.return_value
+        cur.fetchall.return_value = [('rate_y2020', 'rate'), ('magnitude_y2020', 'magnitude'),
+                                     ('magnitude_detail_y2020', 'magnitude_detail')]
+        assert detach_partitions(db_conn, 2020, drop=True) == [
+            'magnitude_detail_y2020', 'magnitude_y2020', 'rate_y2020',
+        ]
+        assert [c.args[0] for c in cur.execute.call_args_list[1:]] == [
+            'DELETE FROM rate_magnitude WHERE rate_id IN (SELECT id FROM rate_y2020) '
+            'OR magn_id IN (SELECT id FROM magnitude_y2020)',
+            'ALTER TABLE magnitude_detail DETACH PARTITION magnitude_detail_y2020',
+            'DROP TABLE magnitude_detail_y2020',
+            'ALTER TABLE magnitude DETACH PARTITION magnitude_y2020',
+            'DROP TABLE magnitude_y2020',
+            'ALTER TABLE rate DETACH PARTITION rate_y2020',
+            'DROP TABLE rate_y2020',
+        ]
+
+    def test_detached_partitions_do_not_reference_partitions(self):
+        db_conn = MagicMock(db_module='psycopg2')
+        cur = db_conn.cursor.return_value
+        cur.fetchall.return_value = [('rate_y2020', 'rate'), ('magnitude_y2020', 'magnitude'),
+                                     ('magnitude_detail_y2020', 'magnitude_detail')]
+        assert detach_partitions(db_conn, 2020) == ['magnitude_detail_y2020', 'magnitude_y2020', 'rate_y2020']
+        assert [c.args[0] for c in cur.execute.call_args_list[2:]] == [
+            'ALTER TABLE magnitude_detail DETACH PARTITION magnitude_detail_y2020',
+            'ALTER TABLE magnitude_detail_y2020 DROP CONSTRAINT IF EXISTS magnitude_detail_fk',
+            'ALTER TABLE magnitude DETACH PARTITION magnitude_y2020',
+            'ALTER TABLE rate DETACH PARTITION rate_y2020',
+        ]
+
+
+class TestDBPool:
+    def test_connection_is_reused(self, tmp_path):
+        pool = DBPool({'database': str(tmp_path / 'pool.db')}, size=2)
+        db_conn = pool.checkout()
+        first = db_conn.conn
+        assert pool.checkout() is db_conn
+        db_conn.close()
+        assert pool.stats()['in_use'] == 1
+        db_conn.close()
+        assert pool.stats()['idle'] == 1
+
+        db_conn = pool.checkout()
+        assert db_conn.conn is first
+        db_conn.close()
+        stats = pool.stats()
+        assert (stats['created'], stats['reused'], stats['open']) == (1, 1, 1)
+        with pytest.raises(DBException):
+            db_conn.cursor()
+        pool.close()
+
+    def test_threads_get_own_connections(self, tmp_path):
+        pool = DBPool({'database': str(tmp_path / 'pool.db')}, size=1, timeout=0.1)
+        db_conn = pool.checkout()
+        errors = []
+
+        def checkout():
+            try:
+                pool.checkout()
+            except DBException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=checkout)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+        assert pool.stats()['timeouts'] == 1
+        db_conn.close()
+
+    def test_expired_and_broken_connections_are_replaced(self, tmp_path):
+        pool = DBPool({'database': str(tmp_path / 'pool.db')}, max_lifetime=0)
+        db_conn = pool.checkout()
+        first = db_conn.conn
+        db_conn.close()
+        db_conn = pool.checkout()
+        assert db_conn.conn is not first
+        db_conn.close()
+
+        pool = DBPool({'database': str(tmp_path / 'pool.db')}, check_interval=0)
+        db_conn = pool.checkout()
+        db_conn.conn.close()
+        db_conn.close()
+        db_conn = pool.checkout()
+        db_conn.cursor().execute('SELECT 1')
+        db_conn.close()
+        stats = pool.stats()
+        assert (stats['created'], stats['closed'], stats['open']) == (2, 1, 1)
+
+
+class TestReplicaRouter:
+    @staticmethod
+    def _showers(router):
+        db_conn = router.checkout()
+        cur = db_conn.cursor()
+        cur.execute('SELECT count(*) FROM shower')
+        count = cur.fetchone()[0]
+        db_conn.close()
+        return count
+
+    def test_lagging_or_missing_replica_falls_back_to_primary(self, seeded_db, tmp_path):
+        primary_path = str(tmp_path / 'seeded.db')
+        replica_path = str(tmp_path / 'replica.db')
+        shutil.copy(primary_path, replica_path)
+        replica = DBAdapter({'database': replica_path})
+        replica.cursor().execute('DELETE FROM shower')
+        replica.commit()
+        replica.close()
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'database': {'database': primary_path},
+            'database_readonly': {'database': replica_path, 'max_lag': '60', 'lag_check_interval': '0'},
+        })
+        router = ReplicaRouter.from_config(config)
+        assert self._showers(router) == 0
+        assert router.stats()['replica_used']
+
+        mtime = os.stat(replica_path).st_mtime
+        os.utime(primary_path, (mtime + 120, mtime + 120))
+        assert self._showers(router) > 0
+        stats = router.stats()
+        assert (stats['replica_used'], stats['replica_lag'], stats['fallbacks']) == (False, 120.0, 1)
+
+        os.utime(primary_path, (mtime, mtime))
+        os.remove(replica_path)
+        assert self._showers(router) > 0
+        assert router.stats()['replica_lag'] is None
+        router.close()
+
+
 class TestInitdb:
     def test_returns_zero(self, fresh_db):
         result = imo_vmdb.initdb(fresh_db, logger)
@@ -102,6 +477,22 @@ class TestCleanup:
         cur.execute('SELECT COUNT(*) FROM shower')
         assert cur.fetchone()[0] > 0
 
+    def test_vacuum_shrinks_database_file(self, seeded_db, tmp_path):
+        path = tmp_path / 'seeded.db'
+        cur = seeded_db.cursor()
+        cur.executemany(
+            'INSERT INTO imported_magnitude (id, session_id, shower, "start", "end", magn) VALUES (?, 1, ?, ?, ?, ?)',
+            [(i, 'PER', '2020-08-12 22:00:00', '2020-08-12 23:00:00', '{"1": 2.0}' * 20) for i in range(20000)]
+        )
+        seeded_db.commit()
+        size = path.stat().st_size
+
+        assert imo_vmdb.cleanup(seeded_db, logger, do_vacuum=True, do_analyze=True) == 0
+        assert path.stat().st_size < size / 2
+        assert cur.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        assert cur.execute('SELECT count(*) FROM imported_magnitude').fetchone()[0] == 0
+        assert existing_indexes(seeded_db)['imported_magnitude_order_key'] == 'imported_magnitude'
+
 
 class TestCSVImporter:
     def test_import_sessions(self, seeded_db):
@@ -0,0 +1,562 @@
+"""Tests for the normalization of imported observations."""
+import functools
+import logging
+import multiprocessing
+import threading
+from pathlib import Path
+
+import pytest
+
+import imo_vmdb
+from imo_vmdb import CSVImporter
+from imo_vmdb.db import DBAdapter, DBException, DBPool, existing_indexes, INDEXES
+from imo_vmdb.generations import Generations
+from imo_vmdb.model.radiant import Storage as RadiantStorage
+from imo_vmdb.model.shower import Storage as ShowerStorage
+from imo_vmdb.model.sky import Sky
+from imo_vmdb.normalizer import create_rate_magn, discard_counts, DirtySessions, Selection
+from imo_vmdb.normalizer.magnitude import MagnitudeNormalizer
+from imo_vmdb.normalizer.progress import Checkpoints
+from imo_vmdb.normalizer.rate import RateNormalizer
+from imo_vmdb.normalizer.session import SessionNormalizer
+from imo_vmdb.normalizer.work import WorkQueue
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+IMPORT_FILES = [
+    str(FIXTURES / 'sessions.csv'),
+    str(FIXTURES / 'overlapping_rates.csv'),
+    str(FIXTURES / 'overlapping_magnitudes.csv'),
+]
+logger = logging.getLogger('test')
+
+
+def _table(db_conn, table, order_by='id'):
+    cur = db_conn.cursor()
+    cur.execute(f'SELECT * FROM {table} ORDER BY {order_by}')
+    # without the generated epoch columns
+    used = [i for i, d in enumerate(cur.description) if not d[0].endswith('_epoch')]
+    return [tuple(row[i] for i in used) for row in cur.fetchall()]
+
+
+def _normalized(db_conn):
+    return {
+        'rate': _table(db_conn, 'rate'),
+        'magnitude': _table(db_conn, 'magnitude'),
+        'magnitude_detail': _table(db_conn, 'magnitude_detail', 'id, magn'),
+        'rate_magnitude': _table(db_conn, 'rate_magnitude', 'rate_id'),
+        'normalize_discard': _table(db_conn, 'normalize_discard', 'obs_type, obs_id'),
+    }
+
+
+def _discard_messages(caplog):
+    return [r.getMessage() for r in caplog.records if 'discarded' in r.getMessage()]
+
+
+def _run_worker(db_path):
+    db_conn = DBAdapter({'database': db_path})
+    imo_vmdb.normalize_worker(db_conn, logger, poll_interval=0.1)
+    db_conn.close()
+
+
+def _serial_result(tmp_path):
+    db_conn = DBAdapter({'database': str(tmp_path / 'serial.db')})
+    imo_vmdb.initdb(db_conn, logger)
+    CSVImporter(db_conn, logger).run(IMPORT_FILES)
+    imo_vmdb.normalize(db_conn, logger)
+    result = _normalized(db_conn)
+    db_conn.close()
+    return result
+
+
+@pytest.fixture
+def imported_db(tmp_path):
+    """SQLite DB with reference data and imported overlapping observations."""
+    db_conn = DBAdapter({'database': str(tmp_path / 'imported.db')})
+    imo_vmdb.initdb(db_conn, logger)
+    CSVImporter(db_conn, logger).run(IMPORT_FILES)
+    db_conn.commit()
+    yield db_conn
+    db_conn.close()
+
+
+class TestNormalize:
+    def test_discards_are_reported(self, imported_db, caplog):
+        with caplog.at_level(logging.DEBUG, logger='test'):
+            result = imo_vmdb.normalize(imported_db, logger)
+        assert result == 1
+        messages = _discard_messages(caplog)
+        assert 'session 1001: observation 7002 discarded - time period overlaps observation 7001' in messages
+        assert any('7006 discarded - sun is above horizon' in m for m in messages)
+
+    def test_discards_are_stored(self, imported_db, caplog):
+        with caplog.at_level(logging.ERROR, logger='test'):
+            imo_vmdb.normalize(imported_db, logger)
+        assert _discard_messages(caplog) == [
+            '4 rate records discarded (contained: 1, observer_id: 1, overlap: 1, sun_above_horizon: 1). '
+            'The discarded records are listed in the table normalize_discard.',
+            '1 magnitude records discarded (overlap: 1). '
+            'The discarded records are listed in the table normalize_discard.',
+        ]
+        assert _table(imported_db, 'normalize_discard', 'obs_type, obs_id') == [
+            ('magnitude', 8002, 1001, 'PER', 'overlap', '8001'),
+            ('rate', 7002, 1001, 'PER', 'overlap', '7001'),
+            ('rate', 7003, 1001, 'PER', 'contained', '7004'),
+            ('rate', 7005, 1001, 'PER', 'observer_id', None),
+            ('rate', 7006, 1002, None, 'sun_above_horizon', '51'),
+        ]
+        assert discard_counts(imported_db, 'magnitude') == {'overlap': 1}
+
+        # the discards are replaced by the next normalization
+        imo_vmdb.normalize(imported_db, logger)
+        assert len(_table(imported_db, 'normalize_discard', 'obs_type, obs_id')) == 5
+
+    def test_sessions_are_copied(self, imported_db):
+        sn = SessionNormalizer(imported_db, logger)
+        sn.run()
+        sn.run()
+        assert (sn.counter_read, sn.counter_write, sn.counter_discard) == (4, 4, 0)
+        assert [r[:3] for r in _table(imported_db, 'obs_session')] == [
+            (1001, 11.582, 48.1351),
+            (1002, 13.405, 52.52),
+        ]
+
+    def test_discarded_record_does_not_replace_previous_record(self, imported_db):
+        imo_vmdb.normalize(imported_db, logger)
+        assert [r[0] for r in _table(imported_db, 'rate')] == [7001, 7004, 7007, 7008]
+
+    def test_rate_magnitude_relationship(self, imported_db):
+        imo_vmdb.normalize(imported_db, logger)
+        assert _table(imported_db, 'rate_magnitude', 'rate_id') == [(7001, 8001, 1), (7007, 8003, 0), (7008, 8003, 0)]
+        cur = imported_db.cursor()
+        cur.execute('SELECT id, lim_mag FROM magnitude ORDER BY id')
+        assert cur.fetchall() == [(8001, 6.2), (8003, 6.15)]
+
+        # the rates of 8003 have fewer meteors than the magnitude observation
+        cur.execute('UPDATE magnitude SET freq = 60 WHERE id = 8003')
+        create_rate_magn(imported_db)
+        assert _table(imported_db, 'rate_magnitude', 'rate_id') == [(7001, 8001, 1)]
+        cur.execute('SELECT lim_mag FROM magnitude WHERE id = 8003')
+        assert cur.fetchone() == (None,)
+
+    def test_parallel_run_matches_serial_run(self, imported_db, tmp_path, caplog):
+        with caplog.at_level(logging.DEBUG, logger='test'):
+            imo_vmdb.normalize(imported_db, logger)
+        serial = _normalized(imported_db)
+        serial_messages = _discard_messages(caplog)
+        caplog.clear()
+
+        parallel_db = DBAdapter({'database': str(tmp_path / 'parallel.db')})
+        imo_vmdb.initdb(parallel_db, logger)
+        CSVImporter(parallel_db, logger).run(IMPORT_FILES)
+        with caplog.at_level(logging.DEBUG, logger='test'):
+            imo_vmdb.normalize(parallel_db, logger, processes=2)
+
+        assert _normalized(parallel_db) == serial
+        assert _discard_messages(caplog) == serial_messages
+        parallel_db.close()
+
+    def test_session_ranges_do_not_change_the_result(self, imported_db):
+        SessionNormalizer(imported_db, logger).run()
+        showers = ShowerStorage(imported_db).load(RadiantStorage(imported_db).load())
+
+        rn = RateNormalizer(imported_db, logger, Sky(), showers)
+        rn.run()
+        expected = _table(imported_db, 'rate')
+
+        SessionNormalizer(imported_db, logger).run()
+        rn = RateNormalizer(imported_db, logger, Sky(), showers, chunk_size=1)
+        rn.run()
+        assert _table(imported_db, 'rate') == expected
+        assert (rn.counter_read, rn.counter_write, rn.counter_discard) == (8, 4, 4)
+
+    def test_epoch_columns_do_not_change_the_result(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        db_conn = DBAdapter({'database': str(tmp_path / 'epoch.db'), 'timestamp_storage': 'epoch'})
+        imo_vmdb.initdb(db_conn, logger)
+        CSVImporter(db_conn, logger).run(IMPORT_FILES)
+        imo_vmdb.normalize(db_conn, logger)
+        assert db_conn.epoch_columns and not imported_db.epoch_columns
+        assert _normalized(db_conn) == _normalized(imported_db)
+        cur = db_conn.cursor()
+        cur.execute("SELECT count(*) FROM rate WHERE period_start_epoch = CAST(strftime('%s', period_start) AS int)")
+        assert cur.fetchone()[0] == len(_table(db_conn, 'rate'))
+        db_conn.close()
+
+    def test_write_error_stops_pipeline(self, imported_db):
+        SessionNormalizer(imported_db, logger).run()
+        showers = ShowerStorage(imported_db).load(RadiantStorage(imported_db).load())
+        rn = RateNormalizer(imported_db, logger, Sky(), showers, chunk_size=1)
+        rn._insert_stmt = 'INSERT INTO missing_table VALUES (%(id)s)'
+        with pytest.raises(DBException):
+            rn.run()
+        assert not [t for t in threading.enumerate() if t.name.startswith('normalize-')]
+
+
+class TestWorkQueue:
+    def test_units_are_claimed_once(self, seeded_db):
+        queue = WorkQueue(seeded_db, worker_id='a')
+        assert queue.fill('rate', [(1, 2), (3, 4)]) == 2
+        first = queue.claim()
+        second = WorkQueue(seeded_db, worker_id='b').claim()
+        assert first.session_range == (1, 2)
+        assert second.session_range == (3, 4)
+        assert queue.claim() is None
+        assert queue.count_unfinished() == 2
+
+    def test_expired_lease_is_claimed_again(self, seeded_db):
+        queue = WorkQueue(seeded_db, lease_time=-1, worker_id='crashed')
+        queue.fill('rate', [(1, 2)])
+        lost = queue.claim()
+        # on SQLite, the claim is committed with the result of the unit
+        seeded_db.commit()
+        retry = WorkQueue(seeded_db, worker_id='b').claim()
+        seeded_db.commit()
+        assert retry.id == lost.id
+        assert retry.attempts == 2
+        assert not queue.complete(lost, 1, 1, 0)
+        assert WorkQueue(seeded_db).complete(retry, 1, 1, 0)
+        assert queue.count_unfinished() == 0
+        assert queue.counters('rate') == (1, 1, 0)
+
+    def test_locked_queue_is_polled(self, seeded_db, tmp_path):
+        queue = WorkQueue(seeded_db, worker_id='a')
+        queue.fill('rate', [(1, 2), (3, 4)])
+        first = queue.claim()
+        other_conn = DBAdapter({'database': str(tmp_path / 'seeded.db'), 'sqlite_busy_timeout': '100'})
+        other = WorkQueue(other_conn, worker_id='b')
+        try:
+            # the first worker holds the write lock until the unit is completed
+            assert other.claim() is None
+            assert other.count_unfinished() == 2
+            assert queue.complete(first, 1, 1, 0)
+            assert other.claim().session_range == (3, 4)
+            assert queue.count_unfinished() == 1
+        finally:
+            other_conn.close()
+
+    def test_fill_replaces_units_of_stage(self, seeded_db):
+        queue = WorkQueue(seeded_db)
+        queue.fill('rate', [(1, 2)])
+        queue.fill('magnitude', [(1, 2)])
+        queue.fill('rate', [(1, 1), (2, 2)])
+        assert queue.count_unfinished() == 3
+
+
+class TestDistributedNormalize:
+    def test_coordinator_matches_serial_run(self, imported_db, tmp_path):
+        result = imo_vmdb.normalize(imported_db, logger, distributed=True, unit_size=1)
+        assert result == 1
+        assert _normalized(imported_db) == _serial_result(tmp_path)
+        assert WorkQueue(imported_db).counters('rate') == (8, 4, 4)
+
+    def test_local_workers_match_serial_run(self, imported_db, tmp_path):
+        SessionNormalizer(imported_db, logger).run()
+        showers = ShowerStorage(imported_db).load(RadiantStorage(imported_db).load())
+        queue = WorkQueue(imported_db)
+        queue.fill('rate', RateNormalizer(imported_db, logger, Sky(), showers, chunk_size=1).session_ranges())
+        queue.fill('magnitude', MagnitudeNormalizer(imported_db, logger, Sky(), chunk_size=1).session_ranges())
+
+        db_path = str(tmp_path / 'imported.db')
+        workers = [multiprocessing.Process(target=_run_worker, args=(db_path,)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+            assert worker.exitcode == 0
+
+        assert queue.count_unfinished() == 0
+        create_rate_magn(imported_db)
+        assert _normalized(imported_db) == _serial_result(tmp_path)
+
+    def test_sessions_not_imported_again_are_kept(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        imo_vmdb.cleanup(imported_db, logger)
+        sessions = tmp_path / 'delta_sessions.csv'
+        sessions.write_text(
+            ''.join((FIXTURES / 'sessions.csv').read_text().splitlines(True)[:2]) +
+            '1003;44;Third Observer;50.0;10.0;100;Jena;Germany\n'
+        )
+        rates = tmp_path / 'delta_rates.csv'
+        rates.write_text(
+            TestIncrementalNormalize.RATE_HEADER +
+            '7001;42;1001;2020-08-12 21:00:00;2020-08-12 22:00:00;45.0;55.0;1.0;1.0;6.2;PER;visual;20\n'
+            '7009;44;1003;2020-08-12 22:00:00;2020-08-12 23:00:00;;;1.0;1.0;6.1;PER;visual;25\n'
+        )
+        CSVImporter(imported_db, logger).run([str(sessions), str(rates)])
+
+        imo_vmdb.normalize(imported_db, logger, distributed=True)
+        assert [r[0] for r in _table(imported_db, 'rate')] == [7001, 7007, 7008, 7009]
+
+
+class TestIncrementalNormalize:
+    RATE_HEADER = 'rate id;user id;obs session id;start date;end date;ra;decl;teff;f;lm;shower;method;number\n'
+
+    def _import_rates(self, db_conn, tmp_path, rows, do_delete=False):
+        path = tmp_path / 'delta_rates.csv'
+        path.write_text(self.RATE_HEADER + ''.join(row + '\n' for row in rows))
+        CSVImporter(db_conn, logger, do_delete=do_delete).run([str(path)])
+
+    def test_imports_mark_sessions_dirty(self, imported_db):
+        assert DirtySessions(imported_db).session_ids() == [1001, 1002]
+        imo_vmdb.normalize(imported_db, logger)
+        assert DirtySessions(imported_db).session_ids() == []
+
+    def test_incremental_matches_full_run(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        self._import_rates(imported_db, tmp_path, [
+            '7008;43;1002;2020-08-12 23:00:00;2020-08-13 00:30:00;;;1.5;1.0;6.2;PER;visual;40',
+        ])
+        assert DirtySessions(imported_db).session_ids() == [1002]
+
+        imo_vmdb.normalize(imported_db, logger, incremental=True)
+        incremental = _normalized(imported_db)
+        assert DirtySessions(imported_db).session_ids() == []
+
+        imo_vmdb.normalize(imported_db, logger)
+        assert _normalized(imported_db) == incremental
+        assert (7008, 8003, 0) not in incremental['rate_magnitude']
+
+    def test_unchanged_sessions_survive_cleanup(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        before = _normalized(imported_db)
+        imo_vmdb.cleanup(imported_db, logger)
+        self._import_rates(imported_db, tmp_path, [
+            '7009;43;1002;2020-08-13 00:00:00;2020-08-13 01:00:00;;;1.0;1.0;6.2;PER;visual;30',
+        ])
+
+        imo_vmdb.normalize(imported_db, logger, incremental=True)
+        after = _normalized(imported_db)
+        assert [r for r in after['rate'] if r[0] != 7009] == before['rate']
+        assert after['magnitude'] == before['magnitude']
+        assert 7009 in [r[0] for r in after['rate']]
+
+    def test_records_no_longer_imported_are_removed(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        sessions = tmp_path / 'delta_sessions.csv'
+        sessions.write_text(''.join((FIXTURES / 'sessions.csv').read_text().splitlines(True)[:2]))
+        CSVImporter(imported_db, logger, do_delete=True).run([str(sessions)])
+        self._import_rates(imported_db, tmp_path, [
+            '7001;42;1001;2020-08-12 21:00:00;2020-08-12 22:00:00;45.0;55.0;1.0;1.0;6.2;PER;visual;20',
+        ], do_delete=True)
+
+        imo_vmdb.normalize(imported_db, logger, incremental=True)
+        normalized = _normalized(imported_db)
+        assert [r[0] for r in _table(imported_db, 'obs_session')] == [1001]
+        assert [r[0] for r in normalized['rate']] == [7001]
+        assert [r[0] for r in normalized['magnitude']] == [8001]
+        assert normalized['rate_magnitude'] == [(7001, 8001, 1)]
+
+    def test_incremental_cannot_be_distributed(self, imported_db):
+        with pytest.raises(ValueError):
+            imo_vmdb.normalize(imported_db, logger, distributed=True, incremental=True)
+
+
+class TestTargetedNormalize:
+    def test_selection_of_sessions(self, imported_db):
+        assert Selection(imported_db, showers=['per']).session_ids == [1001, 1002]
+        assert Selection(imported_db, showers=['SPO']).session_ids == [1002]
+        assert Selection(imported_db, showers=['SPO'], period_start='2020-08-12 12:00').session_ids == []
+        assert Selection(imported_db, period_end='2020-08-12 21:00:00').session_ids == [1002]
+        assert Selection(imported_db, showers=['PER'], session_ids=[1002, 1003]).session_ids == [1002]
+        with pytest.raises(ValueError):
+            Selection(imported_db, showers=["PER' OR 1 = 1"])
+        with pytest.raises(ValueError):
+            Selection(imported_db, period_start='12.08.2020')
+
+    def test_selected_shower_matches_full_run(self, imported_db):
+        imo_vmdb.normalize(imported_db, logger)
+        full = _normalized(imported_db)
+        cur = imported_db.cursor()
+        cur.execute("DELETE FROM rate WHERE shower = 'PER'")
+        cur.execute("DELETE FROM magnitude WHERE shower = 'PER'")
+        cur.execute("DELETE FROM normalize_discard WHERE shower = 'PER'")
+
+        imo_vmdb.normalize(imported_db, logger, showers=['PER'])
+        assert _normalized(imported_db) == full
+        assert [r[0] for r in _table(imported_db, 'obs_session')] == [1001, 1002]
+
+    def test_other_sessions_are_kept(self, imported_db):
+        imo_vmdb.normalize(imported_db, logger)
+        before = _normalized(imported_db)
+        cur = imported_db.cursor()
+        cur.execute("UPDATE imported_rate SET lm = 5.0")
+        cur.execute("UPDATE imported_session SET city = 'Potsdam' WHERE id = 1002")
+
+        imo_vmdb.normalize(imported_db, logger, session_ids=[1002])
+        targeted = _normalized(imported_db)
+        assert [r for r in targeted['rate'] if r[6] == 1001] == [r for r in before['rate'] if r[6] == 1001]
+        assert [r[8] for r in targeted['rate'] if r[6] == 1002] == [5.0, 5.0]
+        assert [r[7] for r in _table(imported_db, 'obs_session')] == ['Munich', 'Potsdam']
+
+        imo_vmdb.normalize(imported_db, logger)
+        assert [r for r in _normalized(imported_db)['rate'] if r[6] == 1002] == \
+            [r for r in targeted['rate'] if r[6] == 1002]
+
+    def test_targeted_cannot_be_incremental(self, imported_db):
+        with pytest.raises(ValueError):
+            imo_vmdb.normalize(imported_db, logger, incremental=True, showers=['PER'])
+
+
+class TestRadiantNormalize:
+    RADIANT_HEADER = 'shower;ra;dec;day;month\n'
+
+    def _import_radiants(self, db_conn, tmp_path, rows):
+        path = tmp_path / 'delta_radiants.csv'
+        path.write_text(self.RADIANT_HEADER + ''.join(row + '\n' for row in rows))
+        CSVImporter(db_conn, logger).run([str(path)])
+
+    def test_changed_radiants_mark_showers(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        self._import_radiants(imported_db, tmp_path, ['PER;45;57;10;8', 'GEM;115;32;10;12'])
+        assert DirtySessions(imported_db).iau_codes() == ['GEM']
+        assert DirtySessions(imported_db).session_ids() == []
+
+    def test_incremental_matches_full_run(self, imported_db, tmp_path):
+        imo_vmdb.normalize(imported_db, logger)
+        before = _normalized(imported_db)
+        self._import_radiants(imported_db, tmp_path, ['PER;40;50;10;8', 'PER;55;52;15;8'])
+        assert DirtySessions(imported_db).iau_codes() == ['PER']
+
+        imo_vmdb.normalize(imported_db, logger, incremental=True)
+        incremental = _normalized(imported_db)
+        assert DirtySessions(imported_db).iau_codes() == []
+        assert incremental['rate'] != before['rate']
+
+        imo_vmdb.normalize(imported_db, logger)
+        assert _normalized(imported_db) == incremental
+
+    def test_rates_below_horizon_are_discarded(self, imported_db, tmp_path, caplog):
+        imo_vmdb.normalize(imported_db, logger)
+        self._import_radiants(imported_db, tmp_path, ['PER;45;-80;10;8', 'PER;45;-80;15;8'])
+
+        with caplog.at_level(logging.DEBUG, logger='test'):
+            assert imo_vmdb.normalize(imported_db, logger, incremental=True) == 1
+        assert any('7007 discarded - radiant is too far below' in m for m in _discard_messages(caplog))
+        incremental = _normalized(imported_db)
+        assert [r[0] for r in incremental['rate']] == []
+
+        imo_vmdb.normalize(imported_db, logger)
+        assert _normalized(imported_db) == incremental
+
+
+class TestResumeNormalize:
+    def test_checkpoints_are_removed_after_completion(self, imported_db):
+        imo_vmdb.normalize(imported_db, logger, checkpoint=1)
+        assert Checkpoints(imported_db).load() == {}
+
+    def test_resume_after_failure_matches_serial_run(self, imported_db, tmp_path, monkeypatch):
+        monkeypatch.setattr(imo_vmdb, 'RateNormalizer', functools.partial(RateNormalizer, chunk_size=1))
+        write_chunk = RateNormalizer._write_chunk
+        calls = []
+
+        def fail_second_chunk(normalizer, cur, chunk):
+            calls.append(chunk.last_session_id)
+            if len(calls) == 2:
+                raise DBException('connection lost')
+            write_chunk(normalizer, cur, chunk)
+
+        monkeypatch.setattr(RateNormalizer, '_write_chunk', fail_second_chunk)
+        with pytest.raises(DBException):
+            imo_vmdb.normalize(imported_db, logger, checkpoint=1)
+        imported_db.rollback()
+        assert Checkpoints(imported_db).load() == {'session': (None, True), 'rate': (1001, False)}
+        assert [r[0] for r in _table(imported_db, 'rate')] == [7001, 7004]
+
+        monkeypatch.setattr(RateNormalizer, '_write_chunk', write_chunk)
+        assert imo_vmdb.normalize(imported_db, logger, resume=True) == 1
+        assert calls == [1001, 1002]
+        assert _normalized(imported_db) == _serial_result(tmp_path)
+        assert Checkpoints(imported_db).load() == {}
+
+    def test_failure_after_checkpoint_keeps_indexes(self, imported_db, monkeypatch):
+        write_chunk = RateNormalizer._write_chunk
+        calls = []
+
+        def fail_second_chunk(normalizer, cur, chunk):
+            # fails within the transaction after the first checkpoint
+            write_chunk(normalizer, cur, chunk)
+            calls.append(chunk.last_session_id)
+            if len(calls) == 2:
+                raise DBException('connection lost')
+
+        monkeypatch.setattr(imo_vmdb, 'RateNormalizer', functools.partial(RateNormalizer, chunk_size=1))
+        monkeypatch.setattr(RateNormalizer, '_write_chunk', fail_second_chunk)
+        with pytest.raises(DBException):
+            imo_vmdb.normalize(imported_db, logger, checkpoint=1)
+        imported_db.rollback()
+        assert existing_indexes(imported_db) == dict((name, table) for name, table, columns in INDEXES)
+
+    def test_resume_cannot_be_distributed(self, imported_db):
+        with pytest.raises(ValueError):
+            imo_vmdb.normalize(imported_db, logger, distributed=True, resume=True)
+
+
+class TestShadowNormalize:
+    def test_copy_replaces_the_database(self, imported_db, tmp_path):
+        path = str(tmp_path / 'imported.db')
+        pool = DBPool({'database': path}, check_interval=0)
+        reader = pool.checkout()
+        reader.close()
+        generations = Generations({'database': path})
+        with generations.shadow() as db_conn:
+            assert imo_vmdb.normalize(db_conn, logger) == 1
+            assert _table(imported_db, 'rate') == []
+
+        assert generations.list() == (['imported.db', 'imported.gen1.db'], 'imported.gen1.db')
+        reader = pool.checkout()
+        assert reader.database_file == str(tmp_path / 'imported.gen1.db')
+        assert _normalized(reader) == _serial_result(tmp_path)
+        reader.close()
+        pool.close()
+
+    def test_failure_leaves_the_database_untouched(self, imported_db, tmp_path):
+        generations = Generations({'database': str(tmp_path / 'imported.db')})
+        with pytest.raises(DBException):
+            with generations.shadow() as db_conn:
+                imo_vmdb.normalize(db_conn, logger)
+                raise DBException('connection lost')
+
+        assert generations.list() == (['imported.db'], 'imported.db')
+        assert not (tmp_path / 'imported.gen1.db').exists()
+
+    def test_modification_discards_the_copy(self, imported_db, tmp_path):
+        generations = Generations({'database': str(tmp_path / 'imported.db')})
+        with pytest.raises(DBException):
+            with generations.shadow() as db_conn:
+                imo_vmdb.normalize(db_conn, logger)
+                imported_db.cursor().execute('DELETE FROM imported_rate')
+                imported_db.commit()
+
+        assert generations.list() == (['imported.db'], 'imported.db')
+
+    def test_checkpoint_of_write_ahead_log_keeps_the_copy(self, imported_db, tmp_path):
+        path = str(tmp_path / 'imported.db')
+        imported_db.cursor().execute('PRAGMA journal_mode = WAL')
+        imported_db.cursor().execute('DELETE FROM normalize_progress')
+        imported_db.commit()
+        generations = Generations({'database': path})
+        with generations.shadow() as db_conn:
+            imo_vmdb.normalize(db_conn, logger)
+            reader = DBAdapter({'database': path})
+            # as run automatically after commits
+            reader.cursor().execute('PRAGMA wal_checkpoint')
+            reader.close()
+
+        assert generations.list() == (['imported.db', 'imported.gen1.db'], 'imported.gen1.db')
+
+    def test_rollback_and_pruning(self, imported_db, tmp_path):
+        imported_db.close()
+        path = str(tmp_path / 'imported.db')
+        generations = Generations({'database': path}, keep=2)
+        for _ in range(3):
+            with generations.shadow() as db_conn:
+                imo_vmdb.normalize(db_conn, logger)
+
+        assert generations.list() == (['imported.gen2.db', 'imported.gen3.db'], 'imported.gen3.db')
+        assert generations.rollback() == 'imported.gen2.db'
+        assert generations.list() == (['imported.gen2.db'], 'imported.gen2.db')
+        db_conn = DBAdapter({'database': path})
+        assert _normalized(db_conn) == _serial_result(tmp_path)
+        db_conn.close()
+        with pytest.raises(DBException):
+            generations.rollback()